@@ -58,6 +58,12 @@ async def update_status(guild_count: int):
     )
 
 
+@bot.listen()
+async def on_starting(event: h.StartingEvent):
+    # Create any tables added since the db was set up before anything uses them
+    await schemas.upgrade_all()
+
+
 @bot.listen()
 async def on_start(event: lb.events.LightbulbStartedEvent):
     bot.d.guild_count = len(await bot.rest.fetch_my_guilds())
@@ -0,0 +1,191 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# Append only cold storage for mirrored message pairs pruned from the db
+#
+# Each call to `MessageArchive.append` writes one immutable segment made up of:
+#
+# - <n>.seg: zlib compressed blocks of rows, each row being the uint64s
+#   (source_msg, source_channel, dest_msg, dest_channel), sorted by source_msg
+# - <n>.idx: a sparse index with the min and max source_msg of the segment
+#   followed by the first source_msg, offset and length of each block
+#
+# Indexes are small and kept in memory, so a lookup only reads and decompresses
+# the few blocks that can contain the requested source message
+
+import asyncio
+import logging
+import os
+import sys
+import typing as t
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+
+# Number of uint64 fields per archived row
+ROW_WIDTH = 4
+# Rows per compressed block, ie the most rows decompressed per block read
+BLOCK_ROWS = 1024
+# Index header fields: min source_msg, max source_msg, number of rows
+INDEX_HEADER_WIDTH = 3
+
+
+def _to_bytes(values: array) -> bytes:
+    """Serialize a uint64 array as little endian bytes"""
+    if sys.byteorder == "big":
+        values = array("Q", values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(data: bytes) -> array:
+    """Deserialize little endian bytes into a uint64 array"""
+    values = array("Q")
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def _write_atomically(path: Path, data: bytes):
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class _Segment:
+    __slots__ = ("data_path", "min_key", "max_key", "first_keys", "offsets", "lengths")
+
+    def __init__(self, data_path: Path, index: array):
+        self.data_path = data_path
+        self.min_key, self.max_key, _ = index[:INDEX_HEADER_WIDTH]
+        blocks = index[INDEX_HEADER_WIDTH:]
+        self.first_keys = blocks[0::3]
+        self.offsets = blocks[1::3]
+        self.lengths = blocks[2::3]
+
+    def lookup(self, source_msg: int) -> t.List[t.Tuple[int, int]]:
+        """Return (dest_msg, dest_channel) pairs archived for source_msg"""
+        # Rows for source_msg may start at the tail of the last block that
+        # begins before it and run up to the last block that begins with it
+        start = max(bisect_left(self.first_keys, source_msg) - 1, 0)
+        end = bisect_right(self.first_keys, source_msg)
+
+        dests = []
+        with open(self.data_path, "rb") as f:
+            for block in range(start, end):
+                f.seek(self.offsets[block])
+                rows = _from_bytes(zlib.decompress(f.read(self.lengths[block])))
+                keys = rows[0::ROW_WIDTH]
+                for row in range(
+                    bisect_left(keys, source_msg), bisect_right(keys, source_msg)
+                ):
+                    row *= ROW_WIDTH
+                    dests.append((rows[row + 2], rows[row + 3]))
+        return dests
+
+
+class MessageArchive:
+    """Segmented, compressed archive of mirrored message pairs in a directory"""
+
+    def __init__(self, directory: str | os.PathLike, block_rows: int = BLOCK_ROWS):
+        self.directory = Path(directory)
+        self.block_rows = block_rows
+        self._segments: t.Optional[t.List[_Segment]] = None
+        self._lock = asyncio.Lock()
+
+    async def append(self, rows: t.Iterable[t.Tuple[int, int, int, int]]) -> int:
+        """Archive (source_msg, source_channel, dest_msg, dest_channel) rows
+
+        Writes a new segment and returns the number of rows archived"""
+        rows = sorted([int(field) for field in row] for row in rows)
+        if not rows:
+            return 0
+
+        segments = await self._get_segments()
+        async with self._lock:
+            segment = await asyncio.to_thread(self._write_segment, rows)
+            segments.append(segment)
+
+        logging.info(f"Archived {len(rows)} message pairs to {segment.data_path}")
+        return len(rows)
+
+    async def lookup(self, source_msg: int) -> t.List[t.Tuple[int, int]]:
+        """Return archived (dest_msg, dest_channel) pairs for source_msg"""
+        source_msg = int(source_msg)
+        candidates = [
+            segment
+            for segment in await self._get_segments()
+            if segment.min_key <= source_msg <= segment.max_key
+        ]
+        if not candidates:
+            return []
+
+        return await asyncio.to_thread(self._lookup_in, candidates, source_msg)
+
+    @staticmethod
+    def _lookup_in(
+        segments: t.List[_Segment], source_msg: int
+    ) -> t.List[t.Tuple[int, int]]:
+        # A pair may be archived more than once if a prune was retried
+        dests = {}
+        for segment in segments:
+            for dest_msg, dest_channel in segment.lookup(source_msg):
+                dests[dest_msg] = dest_channel
+        return list(dests.items())
+
+    async def _get_segments(self) -> t.List[_Segment]:
+        if self._segments is None:
+            async with self._lock:
+                if self._segments is None:
+                    self._segments = await asyncio.to_thread(self._load_segments)
+        return self._segments
+
+    def _load_segments(self) -> t.List[_Segment]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        segments = []
+        # The index is written last, so only segments with one are complete
+        for index_path in sorted(self.directory.glob("*.idx")):
+            data_path = index_path.with_suffix(".seg")
+            if not data_path.exists():
+                logging.warning(f"Skipping archive index without data {index_path}")
+                continue
+            segments.append(_Segment(data_path, _from_bytes(index_path.read_bytes())))
+        return segments
+
+    def _write_segment(self, rows: t.List[t.List[int]]) -> _Segment:
+        number = 1 + max(
+            (int(path.stem) for path in self.directory.glob("*.idx")), default=-1
+        )
+        data_path = self.directory / f"{number:08d}.seg"
+        index_path = data_path.with_suffix(".idx")
+
+        index = array("Q", [rows[0][0], rows[-1][0], len(rows)])
+        data = bytearray()
+        for start in range(0, len(rows), self.block_rows):
+            block = array("Q")
+            for row in rows[start : start + self.block_rows]:
+                block.extend(row)
+            compressed = zlib.compress(_to_bytes(block))
+            index.extend((block[0], len(data), len(compressed)))
+            data += compressed
+
+        _write_atomically(data_path, bytes(data))
+        _write_atomically(index_path, _to_bytes(index))
+        return _Segment(data_path, index)
@@ -0,0 +1,161 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# Micro-benchmarks for the hot paths of the schema layer
+#
+# Run with: python -m conduction.benchmark --rows 10000 100000 1000000
+#
+# WARNING: This drops and recreates all tables in the configured database
+# so only point DB_URL at a local or throwaway database, for example
+# DB_URL=sqlite:///bench.db
+
+import argparse
+import asyncio
+import datetime as dt
+import random
+from time import perf_counter
+
+from sqlalchemy.sql.expression import insert
+
+from . import cfg, schemas, utils
+from .schemas import MirroredChannel, MirroredMessage, ServerStatistics
+
+# Number of dests per src channel
+DESTS_PER_SRC = 1000
+# Number of dests mirrored to per fan-out wave
+WAVE_SIZE = 300
+# Number of times each benchmark is repeated per table size
+REPEATS = 50
+# Rows inserted per statement while populating tables
+POPULATE_CHUNK = 10000
+
+
+async def _insert_in_chunks(model, rows):
+    async with schemas.db_session() as session:
+        async with session.begin():
+            for i in range(0, len(rows), POPULATE_CHUNK):
+                await session.execute(insert(model), rows[i : i + POPULATE_CHUNK])
+
+
+async def populate(rows: int) -> tuple[list[int], list[int]]:
+    """Recreate all tables and fill them up to <rows> rows
+
+    Returns the src channel ids and source message ids populated"""
+    await schemas.recreate_all()
+
+    src_ids = list(range(1, max(rows // DESTS_PER_SRC, 1) + 1))
+    await _insert_in_chunks(
+        MirroredChannel,
+        [
+            {
+                "src_id": src_id,
+                "dest_id": dest_id,
+                "dest_server_id": dest_id,
+                "legacy": True,
+                "enabled": True,
+                "legacy_error_rate": 0,
+            }
+            for src_id in src_ids
+            for dest_id in range(src_id * 10**7, src_id * 10**7 + DESTS_PER_SRC)
+        ],
+    )
+    await _insert_in_chunks(
+        ServerStatistics,
+        [
+            {"id": dest_id, "population": random.randint(1, 10**6)}
+            for dest_id in range(10**7, 10**7 + DESTS_PER_SRC)
+        ],
+    )
+
+    # Half of the messages are old enough to be pruned
+    now = dt.datetime.now(tz=dt.timezone.utc)
+    old = now - dt.timedelta(days=30)
+    source_msgs = list(range(1, max(rows // WAVE_SIZE, 1) + 1))
+    await _insert_in_chunks(
+        MirroredMessage,
+        [
+            {
+                "dest_msg": source_msg * 10**4 + i,
+                "dest_channel": i,
+                "source_msg": source_msg,
+                "source_channel": 1,
+                "creation_datetime": old if source_msg % 2 else now,
+            }
+            for source_msg in source_msgs
+            for i in range(WAVE_SIZE)
+        ],
+    )
+
+    return src_ids, source_msgs
+
+
+async def _time(histogram: utils.LatencyHistogram, coro):
+    start_time = perf_counter()
+    await coro
+    histogram.record(perf_counter() - start_time)
+
+
+async def run(rows: int):
+    src_ids, source_msgs = await populate(rows)
+    results = {
+        "fetch_dests": utils.LatencyHistogram(),
+        "add_msgs_in_batch": utils.LatencyHistogram(),
+        "get_dest_msgs_and_channels": utils.LatencyHistogram(),
+        "prune": utils.LatencyHistogram(),
+    }
+
+    for repeat in range(REPEATS):
+        await _time(
+            results["fetch_dests"],
+            MirroredChannel.fetch_dests(random.choice(src_ids)),
+        )
+        source_msg = 10**12 + repeat
+        await _time(
+            results["add_msgs_in_batch"],
+            MirroredMessage.add_msgs_in_batch(
+                dest_msgs=[source_msg * 10**4 + i for i in range(WAVE_SIZE)],
+                dest_channels=list(range(WAVE_SIZE)),
+                source_msg=source_msg,
+                source_channel=1,
+            ),
+        )
+        await _time(
+            results["get_dest_msgs_and_channels"],
+            MirroredMessage.get_dest_msgs_and_channels(random.choice(source_msgs)),
+        )
+
+    # Pruning is destructive so it is only timed once per table size
+    await _time(results["prune"], MirroredMessage.prune())
+
+    for name, histogram in results.items():
+        print(f"{cfg.db_dialect:<10} {rows:>9,d} rows  {name:<28} {histogram}")
+
+
+async def main(rows_list: list[int]):
+    for rows in rows_list:
+        await run(rows)
+    await schemas.db_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Schema layer micro-benchmarks")
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 1_000_000],
+        help="Table sizes to benchmark at",
+    )
+    asyncio.run(main(parser.parse_args().rows))
@@ -16,7 +16,10 @@
 # Define our custom discord bot classes
 # This is the base h.CachedFetchBot but with added utility functions
 
+import asyncio
+import itertools
 import json
+import logging
 import typing as t
 
 import hikari as h
@@ -25,15 +28,153 @@ import miru as m
 from lightbulb.ext import tasks
 from yarl import URL
 
-from . import cfg, schemas, utils
+from . import cache, cfg, channel_index, router, schemas, snapshot, startup, utils
+
+
+# Bounds of the REST object caches of CachedFetchBot. Channels are looked up
+# for every mirror dest so get the most room. Messages are edited often, so
+# are kept briefly. 403/404s are cached for negative_ttl so that deleted or
+# inaccessible objects don't cost a request on every lookup. Channels updated or
+# deleted over the gateway are discarded by the channel index
+REST_CACHE_POLICIES: t.Dict[str, cache.CachePolicy] = {
+    "channel": cache.CachePolicy(max_entries=10_000, ttl=30 * 60, negative_ttl=5 * 60),
+    "guild": cache.CachePolicy(max_entries=5_000, ttl=30 * 60, negative_ttl=5 * 60),
+    "message": cache.CachePolicy(max_entries=2_000, ttl=5 * 60, negative_ttl=60),
+    "emoji": cache.CachePolicy(max_entries=1_000, ttl=60 * 60, negative_ttl=5 * 60),
+    "user": cache.CachePolicy(max_entries=2_000, ttl=30 * 60, negative_ttl=5 * 60),
+    "owner_ids": cache.CachePolicy(max_entries=1, ttl=60 * 60),
+}
+
+
+# Seconds after start to log the cache memory report at
+CACHE_REPORT_DELAY = 300
+
+# Hikari cache views by cache component, and whether each view is nested per guild
+_CACHE_VIEWS: t.Dict[str, t.Tuple[t.Callable[[h.api.Cache], t.Mapping], bool]] = {
+    "guilds": (lambda cache: cache.get_guilds_view(), False),
+    "guild channels": (lambda cache: cache.get_guild_channels_view(), False),
+    "threads": (lambda cache: cache.get_threads_view(), False),
+    "roles": (lambda cache: cache.get_roles_view(), False),
+    "emojis": (lambda cache: cache.get_emojis_view(), False),
+    "stickers": (lambda cache: cache.get_stickers_view(), False),
+    "members": (lambda cache: cache.get_members_view(), True),
+    "presences": (lambda cache: cache.get_presences_view(), True),
+    "voice states": (lambda cache: cache.get_voice_states_view(), True),
+    "invites": (lambda cache: cache.get_invites_view(), False),
+    "messages": (lambda cache: cache.get_messages_view(), False),
+    "users": (lambda cache: cache.get_users_view(), False),
+}
 
 
 class CachedFetchBot(lb.BotApp):
-    """lb.BotApp subclass with async methods that fetch objects from cache if possible"""
+    """lb.BotApp subclass with async methods that fetch objects from cache if possible
 
-    def __init__(self, *args, **kwargs):
+    Objects are looked up in the gateway cache first, then in rest_cache, which
+    holds objects fetched over REST for a limited time. Pass a cache.RestCache
+    with the same kinds as REST_CACHE_POLICIES as rest_cache to change bounds"""
+
+    def __init__(self, *args, rest_cache: t.Optional[cache.RestCache] = None, **kwargs):
         super().__init__(*args, **kwargs)
         self.cache: h.api.MutableCache
+        self.rest_cache = rest_cache or cache.RestCache(REST_CACHE_POLICIES)
+        # Concurrent misses for the same object share one REST request
+        self.rest_flights = cache.SingleFlight()
+        # What the mirror fan out needs to know about each visible channel
+        self.channel_index = channel_index.ChannelIndex(self.rest_cache["channel"])
+        self.channel_index.subscribe(self)
+
+        # Routes message events to the modules interested in their channel
+        self.message_router = router.MessageRouter(self)
+        # Modules loading data their commands need, started once the bot is
+        self.startup = startup.StartupOrchestrator(cfg.startup_concurrency)
+        self.listen(h.StartedEvent)(self._run_startup)
+        self.listen(h.StartedEvent)(self._report_cache_memory_after_start)
+
+        # In memory state saved on shutdown and periodically, restored on start
+        self.warm_start = snapshot.WarmStartSnapshot(cfg.warm_start_path)
+        self.warm_start.register(
+            "channel_index", self.channel_index.dump, self.channel_index.load
+        )
+        self.listen(h.StartingEvent)(self._load_warm_start)
+        self.listen(h.StoppingEvent)(self._save_warm_start)
+        tasks.task(
+            m=10,  # Interval at which to save the snapshot
+            auto_start=True,
+            wait_before_execution=True,
+        )(self._save_warm_start)
+
+    def cache_memory_report(self) -> t.List[t.Tuple[str, int, int]]:
+        """Return (component, entries, estimated bytes) for each non empty
+        component of the hikari cache"""
+        report = []
+        for component, (get_view, per_guild) in _CACHE_VIEWS.items():
+            view = get_view(self.cache)
+            if per_guild:
+                count = sum(len(guild_view) for guild_view in view.values())
+                objects = itertools.chain.from_iterable(
+                    guild_view.values() for guild_view in view.values()
+                )
+            else:
+                count = len(view)
+                objects = view.values()
+
+            if count:
+                report.append((component, count, cache.estimate_size(objects, count)))
+        return report
+
+    async def _run_startup(self, event: h.StartedEvent):
+        await self.startup.run(self)
+
+    async def _load_warm_start(self, event: h.StartingEvent):
+        await self.warm_start.load()
+
+    async def _save_warm_start(self, event: t.Optional[h.StoppingEvent] = None):
+        try:
+            size = await self.warm_start.save()
+        except Exception as e:
+            logging.exception(f"Could not save warm start snapshot: {e}")
+        else:
+            logging.info(f"Saved warm start snapshot ({size / 1024:.0f}KiB)")
+
+    async def _report_cache_memory_after_start(self, event: h.StartedEvent):
+        # Guilds keep streaming in after start, wait for most to be cached
+        await asyncio.sleep(CACHE_REPORT_DELAY)
+        self.log_cache_memory_report()
+
+    def log_cache_memory_report(self):
+        report = self.cache_memory_report()
+        logging.info(
+            "Estimated cache memory: "
+            + ", ".join(
+                f"{component}: {count} ({size / 2**20:.1f}MiB)"
+                for component, count, size in report
+            )
+            + f", total {sum(size for *_, size in report) / 2**20:.1f}MiB"
+        )
+
+    async def _fetch_with_rest_cache(
+        self, kind: str, key: t.Hashable, fetch: t.Callable[[], t.Awaitable[t.Any]]
+    ):
+        """Return the object of kind cached under key, calling fetch on a miss
+
+        Concurrent misses for the same key share a single call of fetch.
+        NotFoundErrors and ForbiddenErrors raised by fetch are cached too"""
+        rest_cache = self.rest_cache[kind]
+        obj = rest_cache.get(key)
+        if obj is not cache.MISSING:
+            return obj
+
+        async def fetch_and_cache():
+            try:
+                obj = await fetch()
+            except (h.NotFoundError, h.ForbiddenError) as e:
+                rest_cache.set_exception(key, e)
+                raise
+
+            rest_cache.set(key, obj)
+            return obj
+
+        return await self.rest_flights.do((kind, key), fetch_and_cache)
 
     async def fetch_channel(self, channel_id: int):
         """This method fetches a channel from the cache or from discord if not cached"""
@@ -41,12 +182,9 @@ class CachedFetchBot(lb.BotApp):
         if channel:
             return channel
 
-        channel = await self.rest.fetch_channel(channel_id)
-        if not isinstance(channel, h.GuildThreadChannel):
-            # GuildThreadChannels don't seem to be supported by the cache
-            self.cache.set_guild_channel(channel)
-
-        return channel
+        return await self._fetch_with_rest_cache(
+            "channel", int(channel_id), lambda: self.rest.fetch_channel(channel_id)
+        )
 
     async def fetch_guild(self, guild_id: int):
         """This method fetches a guild from the cache or from discord if not cached"""
@@ -54,10 +192,9 @@ class CachedFetchBot(lb.BotApp):
         if guild:
             return guild
 
-        guild = await self.rest.fetch_guild(guild_id)
-        self.cache.set_guild(guild)
-
-        return guild
+        return await self._fetch_with_rest_cache(
+            "guild", int(guild_id), lambda: self.rest.fetch_guild(guild_id)
+        )
 
     async def fetch_message(
         self, channel: h.SnowflakeishOr[h.TextableChannel], message_id: int
@@ -77,10 +214,11 @@ class CachedFetchBot(lb.BotApp):
         if message:
             return message
 
-        message = await self.rest.fetch_message(channel, message_id)
-        self.cache.set_message(message)
-
-        return message
+        return await self._fetch_with_rest_cache(
+            "message",
+            int(message_id),
+            lambda: self.rest.fetch_message(channel, message_id),
+        )
 
     async def fetch_emoji(self, guild_id, emoji_id):
         """This method fetches an emoji from the cache or from discord if not cached"""
@@ -90,14 +228,27 @@ class CachedFetchBot(lb.BotApp):
         if emoji:
             return emoji
 
-        emoji = await self.rest.fetch_emoji(guild_id, emoji_id)
-        self.cache.set_emoji(emoji)
-
-        return emoji
+        return await self._fetch_with_rest_cache(
+            "emoji", int(emoji_id), lambda: self.rest.fetch_emoji(guild_id, emoji_id)
+        )
 
     async def fetch_user(self, user_id: int):
         """This method fetches a user from the cache or from discord if not cached"""
-        return self.cache.get_user(user_id) or await self.rest.fetch_user(user_id)
+        return self.cache.get_user(user_id) or await self._fetch_with_rest_cache(
+            "user", int(user_id), lambda: self.rest.fetch_user(user_id)
+        )
+
+    async def fetch_owner_ids(self) -> t.Sequence[h.Snowflakeish]:
+        """Fetch the bot's owner ids, refreshing them from discord hourly"""
+        if self.owner_ids:
+            return self.owner_ids
+
+        async def fetch():
+            # Drop the application lightbulb keeps so that team changes show up
+            self.application = None
+            return await super(CachedFetchBot, self).fetch_owner_ids()
+
+        return await self._fetch_with_rest_cache("owner_ids", None, fetch)
 
     async def fetch_owner(self, index: int = 1) -> h.User:
         """This method fetches the owner of the bot from the cache or from
@@ -472,6 +623,8 @@ class ServerEmojiEnabledBot(CachedFetchBot):
         )(self.refresh_emoji)
 
         self.listen(h.StartingEvent)(self.refresh_emoji_with_event)
+        self._emoji_refresh: t.Optional[asyncio.Task] = None
+        self.warm_start.register("emoji", self._dump_emoji, self._load_emoji)
 
     async def refresh_emoji(self):
         for server in reversed(self._emoji_servers):
@@ -481,4 +634,33 @@ class ServerEmojiEnabledBot(CachedFetchBot):
 
     @classmethod
     async def refresh_emoji_with_event(cls, event: h.StartingEvent):
-        await cls.refresh_emoji(event.app)
+        bot: ServerEmojiEnabledBot = event.app
+        await bot.warm_start.loaded.wait()
+        if bot.emoji:
+            # Start with the emoji restored from the snapshot and refresh them
+            # without holding up startup
+            bot._emoji_refresh = asyncio.create_task(cls.refresh_emoji(bot))
+            bot._emoji_refresh.add_done_callback(bot._report_emoji_refresh)
+        else:
+            await cls.refresh_emoji(bot)
+
+    def _report_emoji_refresh(self, task: asyncio.Task):
+        if not task.cancelled() and (e := task.exception()) is not None:
+            e.add_note("Failed to refresh emoji after a warm start")
+            asyncio.create_task(utils.discord_error_logger(self, e))
+
+    def _dump_emoji(self) -> t.Dict[str, t.Tuple[int, bool]]:
+        return {
+            name: (int(emoji.id), bool(emoji.is_animated))
+            for name, emoji in self.emoji.items()
+            if isinstance(emoji, h.CustomEmoji)
+        }
+
+    def _load_emoji(self, emoji: t.Dict[str, t.Tuple[int, bool]]):
+        for name, (emoji_id, is_animated) in emoji.items():
+            self.emoji.setdefault(
+                name,
+                h.CustomEmoji(
+                    id=h.Snowflake(emoji_id), name=name, is_animated=is_animated
+                ),
+            )
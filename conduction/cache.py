@@ -0,0 +1,390 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# In process caches
+#
+# RecentMirrorCache keeps the message pairs of recently mirrored posts so that
+# edits and deletes, which mostly happen shortly after a post, can be repeated
+# without a round trip to the db
+#
+# PrefixTrie indexes values by string keys for prefix searches, eg autocomplete
+#
+# TTLCache and RestCache bound the objects CachedFetchBot fetches over REST by
+# age and count, including lookups that failed with 403/404
+#
+# SingleFlight shares one in flight request between concurrent callers asking
+# for the same key
+#
+# estimate_size approximates the memory held by a collection of cached objects
+
+import asyncio
+import copy
+import enum
+import sys
+import typing as t
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+from itertools import islice
+from time import monotonic
+
+# Rough per entry cost of the dict slot, key and array object on top of the
+# 8 bytes per stored id, used to bound the cache size in bytes
+ENTRY_OVERHEAD = 200
+
+
+class RecentMirrorCache:
+    """LRU of source message id -> (dest message, dest channel) pairs
+
+    Pairs are stored interleaved in an `array("Q")` per source message, ie
+    16 bytes per pair instead of the ~100 bytes a tuple of ints takes.
+
+    Entries are only created by `start`, at the beginning of the first fan out
+    of a source message, and `extend` drops pairs for entries that are not
+    present (eg after eviction). This ensures an entry always holds every pair
+    of its fan outs so far, so a hit can be served without consulting the db"""
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[int, array] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, source_msg: int) -> bool:
+        return source_msg in self._entries
+
+    @staticmethod
+    def _size(pairs: array) -> int:
+        return ENTRY_OVERHEAD + pairs.itemsize * len(pairs)
+
+    def start(self, source_msg: int, first_fan_out: bool = True):
+        """Begin tracking the pairs of a fan out for source_msg
+
+        The pairs of a repeated fan out (eg /mirror_send or a retried send)
+        are added to the existing entry. Without one, an entry is only created
+        for the first fan out, since earlier pairs would otherwise be missing"""
+        if source_msg in self._entries:
+            self._entries.move_to_end(source_msg)
+            return
+        if not first_fan_out:
+            return
+
+        pairs = array("Q")
+        self._entries[source_msg] = pairs
+        self.bytes += self._size(pairs)
+        self._evict()
+
+    def extend(
+        self,
+        source_msg: int,
+        dest_msgs: t.Iterable[int],
+        dest_channels: t.Iterable[int],
+    ):
+        """Add pairs to the entry of source_msg if it is still cached"""
+        pairs = self._entries.get(source_msg)
+        if pairs is None:
+            return
+
+        self.bytes -= self._size(pairs)
+        for dest_msg, dest_channel in zip(dest_msgs, dest_channels):
+            pairs.append(dest_msg)
+            pairs.append(dest_channel)
+        self.bytes += self._size(pairs)
+        self._entries.move_to_end(source_msg)
+        self._evict()
+
+    def get(self, source_msg: int) -> t.Optional[t.List[t.Tuple[int, int]]]:
+        """Return the (dest_msg, dest_channel) pairs of source_msg
+
+        Returns None on a miss, as opposed to an empty list for a cached post
+        that was not mirrored anywhere (yet)"""
+        pairs = self._entries.get(source_msg)
+        if pairs is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(source_msg)
+        return list(zip(pairs[::2], pairs[1::2]))
+
+    def discard(self, source_msg: int):
+        pairs = self._entries.pop(source_msg, None)
+        if pairs is not None:
+            self.bytes -= self._size(pairs)
+
+    def _evict(self):
+        # Always keep the most recent entry, even if it is over the byte bound
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or self.bytes > self.max_bytes
+        ):
+            _, pairs = self._entries.popitem(last=False)
+            self.bytes -= self._size(pairs)
+            self.evictions += 1
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"entries={len(self)}/{self.max_entries} "
+            + f"size={self.bytes / 1024:.0f}/{self.max_bytes / 1024:.0f}KiB "
+            + f"hits={self.hits} misses={self.misses} "
+            + f"({self.hit_rate:.0%}) evictions={self.evictions}"
+        )
+
+
+class PrefixTrie:
+    """Trie of string keys to lists of values, for prefix lookups
+
+    Each node is a dict of the next character to the child node, with the
+    values stored at a node under the `None` key"""
+
+    def __init__(self):
+        self._root: dict = {}
+
+    def insert(self, key: str, value):
+        node = self._root
+        for char in key:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(value)
+
+    def find(self, prefix: str) -> list:
+        """Return all values whose keys start with prefix, in key order"""
+        node = self._root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+
+        found = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            found.extend(node.get(None, ()))
+            # Push in reverse so that children are visited in sorted order
+            stack.extend(
+                node[char] for char in sorted(filter(None, node), reverse=True)
+            )
+        return found
+
+
+# Returned by TTLCache.get for keys that are not cached
+MISSING = object()
+
+
+class CachePolicy(t.NamedTuple):
+    max_entries: int
+    # Seconds an entry is served for after being set
+    ttl: float
+    # Seconds a cached exception is re-raised for, None to not cache exceptions
+    negative_ttl: t.Optional[float] = None
+
+
+class TTLCache:
+    """Size bounded LRU whose entries expire ttl seconds after being set
+
+    Exceptions can be cached too (negative caching), `get` raises a copy of
+    the cached exception until it expires"""
+
+    def __init__(self, policy: CachePolicy):
+        self.policy = policy
+        # key -> (expiry time, value, whether value is a cached exception)
+        self._entries: OrderedDict[t.Hashable, t.Tuple[float, t.Any, bool]] = (
+            OrderedDict()
+        )
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: t.Hashable):
+        """Return the value cached for key, or MISSING"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+
+        expires_at, value, is_exception = entry
+        if expires_at <= monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return MISSING
+
+        self._entries.move_to_end(key)
+        if is_exception:
+            self.negative_hits += 1
+            # Raise a copy so that notes and tracebacks added by callers
+            # don't accumulate on the cached exception
+            raise copy.copy(value)
+
+        self.hits += 1
+        return value
+
+    def peek(self, key: t.Hashable):
+        """Return the unexpired value cached for key or MISSING, without
+        counting the lookup, refreshing its LRU position or raising"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= monotonic() or entry[2]:
+            return MISSING
+        return entry[1]
+
+    def set(self, key: t.Hashable, value):
+        self._set(key, value, self.policy.ttl, False)
+
+    def set_exception(self, key: t.Hashable, exception: BaseException):
+        """Cache exception for key if this cache caches exceptions"""
+        if self.policy.negative_ttl is None:
+            return
+
+        exception = copy.copy(exception)
+        exception.__dict__.pop("__notes__", None)
+        self._set(key, exception, self.policy.negative_ttl, True)
+
+    def _set(self, key: t.Hashable, value, ttl: float, is_exception: bool):
+        self._entries[key] = (monotonic() + ttl, value, is_exception)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.policy.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, key: t.Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __str__(self) -> str:
+        return (
+            f"entries={len(self)}/{self.policy.max_entries} "
+            + f"hits={self.hits} negative_hits={self.negative_hits} "
+            + f"misses={self.misses} evictions={self.evictions} "
+            + f"expirations={self.expirations}"
+        )
+
+
+class RestCache:
+    """A TTLCache per kind of REST object, eg "channel" or "guild"
+
+    Each kind is bounded by its own policy, so the total number of objects
+    held is at most the sum of the max_entries of all policies"""
+
+    def __init__(self, policies: t.Mapping[str, CachePolicy]):
+        self.caches: t.Dict[str, TTLCache] = {
+            kind: TTLCache(policy) for kind, policy in policies.items()
+        }
+
+    def __getitem__(self, kind: str) -> TTLCache:
+        return self.caches[kind]
+
+    def __str__(self) -> str:
+        return "\n".join(f"{kind}: {cache}" for kind, cache in self.caches.items())
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into one call
+
+    The first caller for a key starts the call, callers arriving while it is
+    in flight wait for and share its result or exception. The call is
+    shielded, so cancelling one caller does not cancel it for the others"""
+
+    def __init__(self):
+        self._flights: t.Dict[t.Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def do(self, key: t.Hashable, call: t.Callable[[], t.Awaitable[t.Any]]):
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            flight = asyncio.ensure_future(call())
+            self._flights[key] = flight
+            flight.add_done_callback(lambda _: self._land(key, flight))
+
+        return await asyncio.shield(flight)
+
+    def _land(self, key: t.Hashable, flight: asyncio.Future):
+        # Retrieved here too, or an exception raised after every caller was
+        # cancelled is logged as never retrieved
+        if not flight.cancelled():
+            flight.exception()
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+
+# Types whose instances hold no references worth following
+_ATOMIC_TYPES = (str, bytes, int, float, bool, type(None), enum.Enum, type)
+
+
+def deep_sizeof(obj, skip_attributes: t.Container[str] = ("app", "_app")) -> int:
+    """Approximate bytes held by obj and everything it references
+
+    Attributes named in skip_attributes are not followed, eg references from
+    hikari entities back to the bot"""
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, _ATOMIC_TYPES):
+            continue
+        elif isinstance(obj, Mapping):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        else:
+            attributes = dict(getattr(obj, "__dict__", {}))
+            for cls in type(obj).__mro__:
+                slots = getattr(cls, "__slots__", ())
+                for slot in (slots,) if isinstance(slots, str) else slots:
+                    if not slot.startswith("__") and hasattr(obj, slot):
+                        attributes[slot] = getattr(obj, slot)
+            stack.extend(
+                value
+                for name, value in attributes.items()
+                if name not in skip_attributes
+            )
+    return size
+
+
+def estimate_size(objects: t.Iterable, count: int, sample_size: int = 50) -> int:
+    """Estimate the bytes held by count objects from the first sample_size"""
+    sample = list(islice(objects, sample_size))
+    if not sample:
+        return 0
+    return sum(map(deep_sizeof, sample)) * count // len(sample)
@@ -48,11 +48,52 @@ def _test_env(var_name: str) -> list[int] | bool:
     return test_env
 
 
+# Gateway intents and hikari cache components of each CACHE_PROFILE
+#
+# minimal: Only what the modules read, ie guilds, channels, roles (for
+#          permission checks), emojis, the bot's own user and member and a
+#          small window of messages. Skips caching every member, presence,
+#          voice state, invite, sticker and thread of every guild
+# full:    All unprivileged intents and hikari's default cache
+_cache_profiles = {
+    "minimal": (
+        h.Intents.GUILDS
+        | h.Intents.GUILD_EMOJIS
+        | h.Intents.GUILD_MESSAGES
+        | h.Intents.MESSAGE_CONTENT,
+        h.api.CacheComponents.GUILDS
+        | h.api.CacheComponents.GUILD_CHANNELS
+        | h.api.CacheComponents.ROLES
+        | h.api.CacheComponents.EMOJIS
+        | h.api.CacheComponents.MEMBERS
+        | h.api.CacheComponents.MESSAGES
+        | h.api.CacheComponents.ME,
+    ),
+    "full": (
+        h.Intents.ALL_UNPRIVILEGED | h.Intents.MESSAGE_CONTENT,
+        h.api.CacheComponents.ALL,
+    ),
+}
+
+
 def _lightbulb_params() -> dict:
-    intents = h.Intents.ALL_UNPRIVILEGED | h.Intents.MESSAGE_CONTENT
+    try:
+        intents, cache_components = _cache_profiles[cache_profile]
+    except KeyError:
+        raise ValueError(
+            f"Unknown CACHE_PROFILE {cache_profile}, "
+            + f"must be one of {', '.join(_cache_profiles)}"
+        )
+
     lightbulb_params = {
         "token": discord_token,
         "intents": intents,
+        "cache_settings": h.impl.CacheSettings(
+            components=cache_components,
+            max_messages=cache_max_messages,
+            # The bot's own member is the only one read from the cache
+            only_my_member=cache_profile != "full",
+        ),
         "max_rate_limit": 600,
     }
     # Only use the test env for testing if it is specified
@@ -61,17 +102,63 @@ def _lightbulb_params() -> dict:
     return lightbulb_params
 
 
-def _db_urls(var_name: str, var_name_alternative) -> tuple[str, str]:
-    try:
-        db_url = _getenv(var_name)
-    except ValueError:
-        db_url = _getenv(var_name_alternative)
+# Async driver used for each supported database backend
+_db_async_drivers = {
+    "mysql": "mysql+asyncmy",
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def _db_urls(*var_names: str) -> tuple[str, str, str]:
+    """Return the sync url, async url and dialect name of the database
+
+    The url is read from the first of var_names that is set. The backend is
+    picked from the url scheme, ie mysql://..., postgres(ql)://... or
+    sqlite:///path/to/file.db for local runs"""
+    for var_name in var_names[:-1]:
+        try:
+            db_url = _getenv(var_name)
+        except ValueError:
+            continue
+        else:
+            break
+    else:
+        db_url = _getenv(var_names[-1])
+
+    return _parse_db_url(db_url)
+
 
+def _db_replica_urls(var_name: str) -> tuple[str, str] | tuple[None, None]:
+    """Return the sync and async url of the optional read replica
+
+    The replica must use the same backend as the primary database"""
+    db_replica_url = _getenv(var_name, "")
+    if not db_replica_url:
+        return None, None
+
+    db_replica_url, db_replica_url_async, db_replica_dialect = _parse_db_url(
+        db_replica_url
+    )
+    if db_replica_dialect != db_dialect:
+        raise ValueError(
+            f"Read replica backend {db_replica_dialect} does not match "
+            + f"primary backend {db_dialect}"
+        )
+    return db_replica_url, db_replica_url_async
+
+
+def _parse_db_url(db_url: str) -> tuple[str, str, str]:
     __repl_till = db_url.find("://")
+    db_dialect = db_url[:__repl_till].split("+")[0]
+    db_dialect = "postgresql" if db_dialect == "postgres" else db_dialect
+    if db_dialect not in _db_async_drivers:
+        raise ValueError(f"Unsupported database backend {db_dialect}")
+
     db_url = db_url[__repl_till:]
-    db_url_async = "mysql+asyncmy" + db_url
-    db_url = "mysql" + db_url
-    return db_url, db_url_async
+    db_url_async = _db_async_drivers[db_dialect] + db_url
+    db_url = db_dialect + db_url
+    return db_url, db_url_async, db_dialect
 
 
 def _legacy_db_url(var_name: str) -> tuple[str, str]:
@@ -83,7 +170,7 @@ def _legacy_db_url(var_name: str) -> tuple[str, str]:
     return legacy_db_url, legacy_db_url_async
 
 
-def _db_config():
+def _db_config(db_dialect: str):
     db_session_kwargs_sync = {
         "expire_on_commit": False,
     }
@@ -92,7 +179,7 @@ def _db_config():
     }
 
     db_connect_args = {}
-    if _getenv("MYSQL_SSL", "true") == "true":
+    if db_dialect != "sqlite" and _getenv("MYSQL_SSL", "true") == "true":
         ssl_ctx = ssl.create_default_context(
             cafile="/etc/ssl/certs/ca-certificates.crt"
         )
@@ -100,11 +187,20 @@ def _db_config():
         db_connect_args.update({"ssl": ssl_ctx})
 
     db_engine_args = {
-        "max_overflow": -1,
+        # Bound the pool so that bursts of db calls queue up (first come first
+        # served) for a connection instead of opening unlimited connections
+        "pool_size": int(_getenv("DB_POOL_SIZE", "10")),
+        "max_overflow": int(_getenv("DB_POOL_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(_getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_use_lifo": False,
         "isolation_level": "READ COMMITTED",
         "pool_pre_ping": True,
         "pool_recycle": 3600,
     }
+    if db_dialect == "sqlite":
+        # SQLite only supports SERIALIZABLE & READ UNCOMMITTED
+        db_engine_args.pop("isolation_level")
+
     return db_session_kwargs, db_session_kwargs_sync, db_connect_args, db_engine_args
 
 
@@ -143,6 +239,22 @@ logging.basicConfig(
 test_env = _test_env("TEST_ENV")
 discord_token = _getenv("DISCORD_TOKEN")
 disable_bad_channels = str(_getenv("DISABLE_BAD_CHANNELS")).lower() == "true"
+# Which gateway events to receive and objects to cache, see _cache_profiles
+cache_profile = _getenv("CACHE_PROFILE", "minimal").lower()
+# Most recent messages kept in the cache, used for edits and deletes. The full
+# profile defaults to hikari's own default
+cache_max_messages = int(
+    _getenv(
+        "CACHE_MAX_MESSAGES",
+        "100" if cache_profile != "full" else str(h.impl.CacheSettings().max_messages),
+    )
+)
+# File the warm start snapshot of in memory caches is saved to and loaded from
+warm_start_path = _getenv("WARM_START_PATH", "warm_start.snapshot")
+# Directory NavPages pages are stored in, so restarts only fetch new messages
+nav_store_dir = _getenv("NAV_STORE_DIR", "nav_store")
+# Modules loading data (eg navigator pages) concurrently on startup
+startup_concurrency = int(_getenv("STARTUP_CONCURRENCY", "3"))
 
 # Discord control server config
 control_discord_server_id = int(_getenv("CONTROL_DISCORD_SERVER_ID"))
@@ -159,7 +271,22 @@ default_url = _getenv("DEFAULT_URL")
 navigator_timeout = int(_getenv("NAVIGATOR_TIMEOUT") or 120)
 
 # Database URLs
-db_url, db_url_async = _db_urls("MYSQL_PRIVATE_URL", "MSQL_URL")
+db_url, db_url_async, db_dialect = _db_urls("DB_URL", "MYSQL_PRIVATE_URL", "MSQL_URL")
+# Read only queries are sent here if set, defaults to the primary database
+db_replica_url, db_replica_url_async = _db_replica_urls("DB_REPLICA_URL")
+# Directory pruned message pairs are archived to, archiving is disabled if unset
+message_archive_dir = _getenv("MESSAGE_ARCHIVE_DIR", "") or None
+# Directory of the local spool for db writes made while the db is unreachable
+db_spool_dir = _getenv("DB_SPOOL_DIR", "db_spool")
+# Statements slower than this (seconds) are reported to the alerts channel
+db_slow_query_seconds = float(_getenv("DB_SLOW_QUERY_SECONDS", "1"))
+# Use Postgres array parameters (UNNEST / ANY) and COPY for bulk statements
+db_postgres_bulk = _getenv("DB_POSTGRES_BULK", "false").lower() == "true"
+# Days after which disabled mirrors are moved to mirrored_channel_history
+mirror_compaction_age = dt.timedelta(days=int(_getenv("MIRROR_COMPACTION_DAYS", "30")))
+# Bounds of the in memory cache of recently mirrored posts used by edits/deletes
+recent_mirror_cache_entries = int(_getenv("RECENT_MIRROR_CACHE_ENTRIES", "256"))
+recent_mirror_cache_bytes = int(_getenv("RECENT_MIRROR_CACHE_MB", "32")) * 1024 * 1024
 
 # Sheets credentials & URLs
 gsheets_credentials = _sheets_credentials(
@@ -183,7 +310,12 @@ sheets_ls_url = _getenv("SHEETS_LS_URL")
     db_session_kwargs_sync,
     db_connect_args,
     db_engine_args,
-) = _db_config()
+) = _db_config(db_dialect)
+# Number of connections to open ahead of known peaks such as the daily reset
+db_pool_prewarm = min(
+    int(_getenv("DB_POOL_PREWARM", str(db_engine_args["pool_size"]))),
+    db_engine_args["pool_size"],
+)
 lightbulb_params = _lightbulb_params()
 reset_time_tolerance = dt.timedelta(minutes=60)
 url_regex = re.compile(
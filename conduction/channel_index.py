@@ -0,0 +1,290 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# Compact index of the guild channels the bot can see, kept current from
+# gateway events
+#
+# The mirror fan out only needs to know whether a dest is textable, whether it
+# is a news channel (to crosspost) and whether the bot may send there. Keeping
+# just that in a slotted entry per channel costs a small fraction of a full
+# hikari channel object and never needs a REST request
+
+import logging
+import typing as t
+from array import array
+
+import hikari as h
+
+from . import cache
+
+TEXTABLE_TYPES = frozenset(
+    (
+        h.ChannelType.GUILD_TEXT,
+        h.ChannelType.GUILD_NEWS,
+        h.ChannelType.GUILD_VOICE,
+        h.ChannelType.GUILD_STAGE,
+        h.ChannelType.GUILD_NEWS_THREAD,
+        h.ChannelType.GUILD_PUBLIC_THREAD,
+        h.ChannelType.GUILD_PRIVATE_THREAD,
+    )
+)
+SEND_PERMISSIONS = h.Permissions.VIEW_CHANNEL | h.Permissions.SEND_MESSAGES
+
+
+class IndexedChannel:
+    """What the fan out needs to know about a channel
+
+    permissions is None when it is not known, eg for threads or after the
+    bot's roles changed, in which case callers should just try"""
+
+    __slots__ = ("guild_id", "is_textable", "is_news", "permissions", "epoch")
+
+    def __init__(
+        self,
+        guild_id: int,
+        is_textable: bool,
+        is_news: bool,
+        permissions: t.Optional[int],
+        epoch: int,
+    ):
+        self.guild_id = guild_id
+        self.is_textable = is_textable
+        self.is_news = is_news
+        self.permissions = permissions
+        self.epoch = epoch
+
+    @property
+    def can_send(self) -> bool:
+        """False only if the bot is known to be unable to send messages here"""
+        return self.permissions is None or (
+            self.permissions & SEND_PERMISSIONS == SEND_PERMISSIONS
+        )
+
+
+class _GuildPermissions:
+    """The bot's guild wide permissions, used to compute channel permissions"""
+
+    __slots__ = ("member_id", "role_ids", "base", "is_owner", "epoch")
+
+    def __init__(
+        self,
+        member_id: int,
+        role_ids: t.FrozenSet[int],
+        base: int,
+        is_owner: bool,
+        epoch: int,
+    ):
+        self.member_id = member_id
+        self.role_ids = role_ids
+        self.base = base
+        self.is_owner = is_owner
+        self.epoch = epoch
+
+    def permissions_in(self, channel: h.PermissibleGuildChannel) -> int:
+        """Apply channel overwrites to the base permissions, as discord does"""
+        if self.is_owner or self.base & h.Permissions.ADMINISTRATOR:
+            return int(h.Permissions.all_permissions())
+
+        permissions = self.base
+        overwrites = channel.permission_overwrites
+
+        everyone = overwrites.get(channel.guild_id)
+        if everyone:
+            permissions = (permissions & ~int(everyone.deny)) | int(everyone.allow)
+
+        allow = deny = 0
+        for role_id in self.role_ids:
+            overwrite = overwrites.get(role_id)
+            if overwrite:
+                allow |= int(overwrite.allow)
+                deny |= int(overwrite.deny)
+        permissions = (permissions & ~deny) | allow
+
+        member = overwrites.get(self.member_id)
+        if member:
+            permissions = (permissions & ~int(member.deny)) | int(member.allow)
+
+        return permissions
+
+
+class ChannelIndex:
+    """Index of channel id -> IndexedChannel for every channel the bot can see
+
+    Call `subscribe` with the bot to keep it current. Entries of a guild are
+    (re)built on GuildAvailable and updated by channel and thread events.
+    When the bot's roles or role permissions change, permissions in the
+    guild become unknown until the guild is next available
+
+    Channels changed or deleted by gateway events are also discarded from
+    rest_cache if given, eg the bot's cache of channels fetched over REST"""
+
+    def __init__(self, rest_cache: t.Optional[cache.TTLCache] = None):
+        self._channels: t.Dict[int, IndexedChannel] = {}
+        self._rest_cache = rest_cache
+        self._guilds: t.Dict[int, _GuildPermissions] = {}
+        # Incremented for each new _GuildPermissions so that entries computed
+        # from an older one are recognisably stale
+        self._epoch = 0
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+    def get(self, channel_id: int) -> t.Optional[IndexedChannel]:
+        entry = self._channels.get(channel_id)
+        if entry is not None and entry.permissions is not None:
+            guild = self._guilds.get(entry.guild_id)
+            if guild is None or guild.epoch != entry.epoch:
+                entry.permissions = None
+        return entry
+
+    def dump(self) -> bytes:
+        """Serialise the channels as (id, guild_id, flags) uint64 triples
+
+        Permissions are left out, they are recomputed once guilds are available"""
+        rows = array("Q")
+        for channel_id, entry in self._channels.items():
+            rows.extend(
+                (channel_id, entry.guild_id, entry.is_textable | entry.is_news << 1)
+            )
+        return rows.tobytes()
+
+    def load(self, data: bytes):
+        """Add channels from dump that are not known yet"""
+        rows = array("Q")
+        rows.frombytes(data)
+        for i in range(0, len(rows), 3):
+            channel_id, guild_id, flags = rows[i : i + 3]
+            if channel_id not in self._channels:
+                self._channels[channel_id] = IndexedChannel(
+                    guild_id, bool(flags & 1), bool(flags & 2), None, 0
+                )
+
+    def subscribe(self, bot: h.GatewayBot):
+        bot.subscribe(h.GuildAvailableEvent, self.on_guild_available)
+        bot.subscribe(h.GuildJoinEvent, self.on_guild_available)
+        bot.subscribe(h.GuildLeaveEvent, self.on_guild_leave)
+        bot.subscribe(h.GuildChannelCreateEvent, self.on_channel)
+        bot.subscribe(h.GuildChannelUpdateEvent, self.on_channel)
+        bot.subscribe(h.GuildChannelDeleteEvent, self.on_channel_delete)
+        bot.subscribe(h.GuildThreadCreateEvent, self.on_thread)
+        bot.subscribe(h.GuildThreadUpdateEvent, self.on_thread)
+        bot.subscribe(h.GuildThreadAccessEvent, self.on_thread)
+        bot.subscribe(h.GuildThreadDeleteEvent, self.on_thread_delete)
+        bot.subscribe(h.RoleUpdateEvent, self.on_role_change)
+        bot.subscribe(h.RoleDeleteEvent, self.on_role_change)
+        bot.subscribe(h.MemberUpdateEvent, self.on_member_update)
+
+    def _forget_fetched(self, channel_id: int):
+        if self._rest_cache is not None:
+            self._rest_cache.discard(channel_id)
+
+    def _set_channel(self, channel: h.GuildChannel | h.GuildThreadChannel):
+        guild = self._guilds.get(channel.guild_id)
+        permissions = None
+        # Threads have no overwrites of their own and are left unknown
+        if guild is not None and hasattr(channel, "permission_overwrites"):
+            permissions = guild.permissions_in(channel)
+
+        self._channels[int(channel.id)] = IndexedChannel(
+            int(channel.guild_id),
+            channel.type in TEXTABLE_TYPES,
+            channel.type == h.ChannelType.GUILD_NEWS,
+            permissions,
+            guild.epoch if guild is not None else 0,
+        )
+
+    def _drop_guild(self, guild_id: int):
+        self._guilds.pop(guild_id, None)
+        for channel_id in [
+            channel_id
+            for channel_id, entry in self._channels.items()
+            if entry.guild_id == guild_id
+        ]:
+            del self._channels[channel_id]
+
+    async def on_guild_available(
+        self, event: h.GuildAvailableEvent | h.GuildJoinEvent
+    ):
+        guild_id = int(event.guild_id)
+        self._drop_guild(guild_id)
+
+        me = event.app.get_me()
+        member = event.members.get(me.id) if me else None
+        if member is not None:
+            everyone = event.roles.get(event.guild_id)
+            base = int(everyone.permissions) if everyone else 0
+            for role_id in member.role_ids:
+                role = event.roles.get(role_id)
+                if role:
+                    base |= int(role.permissions)
+
+            self._epoch += 1
+            self._guilds[guild_id] = _GuildPermissions(
+                int(me.id),
+                frozenset(int(role_id) for role_id in member.role_ids),
+                base,
+                event.guild.owner_id == me.id,
+                self._epoch,
+            )
+        else:
+            logging.warning(f"Own member missing from guild {guild_id}")
+
+        for channel in event.channels.values():
+            self._set_channel(channel)
+        for thread in event.threads.values():
+            self._set_channel(thread)
+
+    async def on_guild_leave(self, event: h.GuildLeaveEvent):
+        self._drop_guild(int(event.guild_id))
+
+    async def on_channel(
+        self, event: h.GuildChannelCreateEvent | h.GuildChannelUpdateEvent
+    ):
+        self._set_channel(event.channel)
+        self._forget_fetched(int(event.channel.id))
+
+    async def on_channel_delete(self, event: h.GuildChannelDeleteEvent):
+        self._channels.pop(int(event.channel_id), None)
+        self._forget_fetched(int(event.channel_id))
+
+    async def on_thread(
+        self,
+        event: h.GuildThreadCreateEvent
+        | h.GuildThreadUpdateEvent
+        | h.GuildThreadAccessEvent,
+    ):
+        self._set_channel(event.thread)
+        self._forget_fetched(int(event.thread.id))
+
+    async def on_thread_delete(self, event: h.GuildThreadDeleteEvent):
+        self._channels.pop(int(event.thread_id), None)
+        self._forget_fetched(int(event.thread_id))
+
+    async def on_role_change(self, event: h.RoleUpdateEvent | h.RoleDeleteEvent):
+        guild = self._guilds.get(event.guild_id)
+        if guild is not None and (
+            event.role_id == event.guild_id or event.role_id in guild.role_ids
+        ):
+            # Overwrites aren't kept, so permissions can't be recomputed here
+            del self._guilds[event.guild_id]
+
+    async def on_member_update(self, event: h.MemberUpdateEvent):
+        guild = self._guilds.get(event.guild_id)
+        if (
+            guild is not None
+            and event.user_id == guild.member_id
+            and frozenset(event.member.role_ids) != guild.role_ids
+        ):
+            del self._guilds[event.guild_id]
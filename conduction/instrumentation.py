@@ -0,0 +1,120 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# Statement level timing for sqlalchemy engines
+#
+# Every statement is timed with cursor execute events and attributed to the
+# schema method that ran it (see utils.ensure_session). Statements slower than
+# a threshold are collected by statement shape, ie with literal values and
+# expanded IN / VALUES lists collapsed, so that the same slow query is only
+# reported once per cooldown however often it runs
+
+import logging
+import typing as t
+from collections import defaultdict
+from time import monotonic, perf_counter
+
+import attr
+import regex as re
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import utils
+
+# Bind placeholders of the supported drivers: ?, %s, $1 and %(name)s
+_placeholder = r"(?:\?|%s|\$\d+|%\(\w+\)s)"
+# A parenthesised list of placeholders, eg an expanded IN list or a VALUES row
+_placeholder_list = re.compile(rf"\(\s*{_placeholder}(?:\s*,\s*{_placeholder})*\s*\)")
+_repeated_lists = re.compile(r"\(\?\)(?:\s*,\s*\(\?\))+")
+_whitespace = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    """Return statement with placeholder lists and whitespace collapsed"""
+    shape = _placeholder_list.sub("(?)", statement)
+    shape = _repeated_lists.sub("(?)", shape)
+    return _whitespace.sub(" ", shape).strip()
+
+
+@attr.s
+class SlowQuery:
+    caller: str = attr.ib()
+    shape: str = attr.ib()
+    count: int = attr.ib(default=0)
+    max_seconds: float = attr.ib(default=0.0)
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.max_seconds = max(self.max_seconds, seconds)
+
+
+class QueryInstrumentation:
+    """Per caller latency histograms and a deduplicated slow query log"""
+
+    def __init__(self, slow_threshold: float, report_cooldown: float = 600):
+        self.slow_threshold = slow_threshold
+        self.report_cooldown = report_cooldown
+        self.latencies: t.Dict[str, utils.LatencyHistogram] = defaultdict(
+            utils.LatencyHistogram
+        )
+        # Slow queries seen since they were last reported, by (caller, shape)
+        self._slow_queries: t.Dict[t.Tuple[str, str], SlowQuery] = {}
+        self._last_reported: t.Dict[t.Tuple[str, str], float] = {}
+
+    def attach(self, engine: AsyncEngine):
+        event.listen(engine.sync_engine, "before_cursor_execute", self._before)
+        event.listen(engine.sync_engine, "after_cursor_execute", self._after)
+        event.listen(engine.sync_engine, "handle_error", self._on_error)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_times", []).append(perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = perf_counter() - conn.info["query_start_times"].pop()
+        caller = utils.get_db_caller() or "<unknown>"
+        self.latencies[caller].record(seconds)
+
+        if seconds >= self.slow_threshold:
+            key = (caller, statement_shape(statement))
+            if key not in self._slow_queries:
+                self._slow_queries[key] = SlowQuery(*key)
+            self._slow_queries[key].record(seconds)
+            logging.warning(f"Slow query ({seconds:.2f}s) from {caller}: {key[1]}")
+
+    def _on_error(self, exception_context):
+        # Drop the start time of the statement that failed
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_start_times"):
+            connection.info["query_start_times"].pop()
+
+    def drain_slow_queries(self) -> t.List[SlowQuery]:
+        """Return slow queries that are due to be reported, slowest first
+
+        A query shape is due if it was not reported within the cooldown, queries
+        that are not due keep accumulating until they are"""
+        now = monotonic()
+        due = [
+            key
+            for key in self._slow_queries
+            if now - self._last_reported.get(key, -self.report_cooldown)
+            >= self.report_cooldown
+        ]
+        for key in due:
+            self._last_reported[key] = now
+        return sorted(
+            (self._slow_queries.pop(key) for key in due),
+            key=lambda query: query.max_seconds,
+            reverse=True,
+        )
@@ -0,0 +1,140 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# Bulk export and import of mirrors as JSONL or CSV
+#
+# Run with: python -m conduction.mirror_io export mirrors.jsonl
+#      or : python -m conduction.mirror_io import mirrors.csv
+#
+# Each row holds the src_id, dest_id, dest_server_id, legacy and enabled
+# fields of a mirror. Exports page through the table and imports are written
+# with batched multi row upserts, so neither holds all mirrors in memory
+
+import argparse
+import asyncio
+import csv
+import json
+import typing as t
+
+from . import schemas
+from .schemas import MirroredChannel
+
+FIELDS = ("src_id", "dest_id", "dest_server_id", "legacy", "enabled")
+FORMATS = ("jsonl", "csv")
+BATCH_SIZE = 5000
+
+
+def format_from_path(path: str) -> str:
+    """Return the format for a file name based on its extension"""
+    extension = path.rsplit(".", 1)[-1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Unsupported mirror file format {extension}")
+    return extension
+
+
+async def export_mirrors(
+    file: t.TextIO, format: str = "jsonl", batch_size: int = BATCH_SIZE
+) -> int:
+    """Write all mirrors to file and return the number written"""
+    if format not in FORMATS:
+        raise ValueError(f"Unsupported mirror file format {format}")
+
+    if format == "csv":
+        writer = csv.writer(file)
+        writer.writerow(FIELDS)
+
+    rows_written = 0
+    last_mirror = None
+    while mirrors := await MirroredChannel.fetch_mirrors_page(
+        after=last_mirror, limit=batch_size
+    ):
+        for src_id, dest_id, dest_server_id, legacy, enabled in mirrors:
+            if format == "csv":
+                writer.writerow(
+                    (src_id, dest_id, dest_server_id or "", int(legacy), int(enabled))
+                )
+            else:
+                file.write(
+                    json.dumps(
+                        dict(
+                            zip(
+                                FIELDS,
+                                (src_id, dest_id, dest_server_id, legacy, enabled),
+                            )
+                        )
+                    )
+                    + "\n"
+                )
+        rows_written += len(mirrors)
+        last_mirror = mirrors[-1][:2]
+
+    return rows_written
+
+
+def read_mirrors(file: t.Iterable[str], format: str = "jsonl") -> t.Iterator[dict]:
+    """Lazily parse mirrors from the lines of a JSONL or CSV file"""
+    if format == "csv":
+        for row in csv.DictReader(file):
+            yield {
+                "src_id": int(row["src_id"]),
+                "dest_id": int(row["dest_id"]),
+                "dest_server_id": int(row["dest_server_id"])
+                if row.get("dest_server_id")
+                else None,
+                "legacy": row["legacy"].strip().lower() in ("1", "true"),
+                "enabled": row.get("enabled", "1").strip().lower() in ("1", "true"),
+            }
+    elif format == "jsonl":
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError(f"Unsupported mirror file format {format}")
+
+
+async def import_mirrors(
+    file: t.Iterable[str], format: str = "jsonl", batch_size: int = BATCH_SIZE
+) -> int:
+    """Add or update all mirrors in file in one transaction
+
+    Returns the number of mirrors written"""
+    return await MirroredChannel.add_mirrors_in_batch(
+        read_mirrors(file, format), batch_size=batch_size
+    )
+
+
+async def _main(args: argparse.Namespace):
+    format = args.format or format_from_path(args.path)
+    try:
+        if args.action == "export":
+            with open(args.path, "w", newline="") as file:
+                count = await export_mirrors(file, format)
+        else:
+            with open(args.path, newline="") as file:
+                count = await import_mirrors(file, format)
+    finally:
+        await schemas.db_engine.dispose()
+
+    print(f"{args.action.capitalize()}ed {count} mirrors")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk mirror export and import")
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("path", help="File to write to or read from")
+    parser.add_argument(
+        "--format", choices=FORMATS, help="Defaults to the file extension"
+    )
+    asyncio.run(_main(parser.parse_args()))
@@ -20,6 +20,7 @@ import lightbulb as lb
 
 from .. import cfg
 from ..nav import NavigatorView, NavPages, NO_DATA_HERE_EMBED
+from ..startup import requires_ready
 from .autoposts import autopost_command_group, follow_control_command_maker
 
 REFERENCE_DATE = dt.datetime(2023, 7, 14, 17, tzinfo=dt.timezone.utc)
@@ -29,10 +30,10 @@ FOLLOWABLE_CHANNEL = cfg.followables["ada"]
 SINGLE_PAGE_MODE = True
 
 
-async def on_start(event: h.StartedEvent):
+async def on_start(bot: lb.BotApp):
     global ada_pages
     ada_pages = await NavPages.from_channel(
-        event.app,
+        bot,
         FOLLOWABLE_CHANNEL,
         history_len=12,
         period=dt.timedelta(days=7),
@@ -43,9 +44,13 @@ async def on_start(event: h.StartedEvent):
 
 if SINGLE_PAGE_MODE:
 
-    @lb.command("ada", "Find out about ada's weekly items", auto_defer=True)
+    @lb.command("ada", "Find out about ada's weekly items")
     @lb.implements(lb.SlashCommand)
+    @requires_ready("ada")
     async def ada_command(ctx: lb.Context):
+        # Deferred here rather than with auto_defer so that the warming up
+        # reply of requires_ready can still be ephemeral
+        await ctx.respond(h.ResponseType.DEFERRED_MESSAGE_CREATE)
         page_no = 0
         while True:
             try:
@@ -66,6 +71,7 @@ else:
 
     @lb.command("ada", "Find out about ada's weekly items")
     @lb.implements(lb.SlashCommand)
+    @requires_ready("ada")
     async def ada_command(ctx: lb.Context):
         navigator = NavigatorView(pages=ada_pages, timeout=60)
         await navigator.send(ctx.interaction)
@@ -73,7 +79,7 @@ else:
 
 def register(bot):
     bot.command(ada_command)
-    bot.listen()(on_start)
+    bot.startup.add("ada", on_start)
 
     autopost_command_group.child(
         follow_control_command_maker(
@@ -62,8 +62,16 @@ async def legacy_follow(ctx: lb.Context, source: h.GuildChannel, prefix: str):
     bot: CachedFetchBot = ctx.app
     guild = ctx.get_guild() or await ctx.app.rest.fetch_guild(ctx.guild_id)
 
-    for channel in await get_channels(bot, guild, prefix):
-        await MirroredChannel.add_mirror(source.id, channel.id, guild.id, legacy=True)
+    channels = await get_channels(bot, guild, prefix)
+    await MirroredChannel.add_mirrors_in_batch(
+        {
+            "src_id": source.id,
+            "dest_id": channel.id,
+            "dest_server_id": guild.id,
+            "legacy": True,
+        }
+        for channel in channels
+    )
 
     await ctx.respond("Done")
 
@@ -16,11 +16,11 @@
 import datetime as dt
 import typing as t
 
-import hikari as h
 import lightbulb as lb
 
 from .. import cfg
 from ..nav import NavigatorView, NavPages
+from ..startup import requires_ready
 from .autoposts import autopost_command_group, follow_control_command_maker
 
 REFERENCE_DATE = dt.datetime(2023, 7, 18, 17, tzinfo=dt.timezone.utc)
@@ -28,10 +28,10 @@ REFERENCE_DATE = dt.datetime(2023, 7, 18, 17, tzinfo=dt.timezone.utc)
 EVERVERSE_WEEKLY = cfg.followables["eververse"]
 
 
-async def on_start(event: h.StartedEvent):
+async def on_start(bot: lb.BotApp):
     global evweekly
     evweekly = await NavPages.from_channel(
-        event.app,
+        bot,
         EVERVERSE_WEEKLY,
         history_len=4,
         period=dt.timedelta(days=7),
@@ -48,6 +48,7 @@ async def eververse_group(ctx: lb.Context):
 @eververse_group.child
 @lb.command("weekly", "Find out about this weeks eververse items")
 @lb.implements(lb.SlashSubCommand)
+@requires_ready("eververse")
 async def eververse_weekly(ctx: lb.Context):
     navigator = NavigatorView(pages=evweekly, autodefer=True)
     await navigator.send(ctx.interaction)
@@ -55,7 +56,7 @@ async def eververse_weekly(ctx: lb.Context):
 
 def register(bot):
     bot.command(eververse_group)
-    bot.listen()(on_start)
+    bot.startup.add("eververse", on_start)
 
     autopost_command_group.child(
         follow_control_command_maker(
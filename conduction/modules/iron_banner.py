@@ -15,12 +15,12 @@
 
 import datetime as dt
 
-import hikari as h
 import lightbulb as lb
 from hmessage import HMessage as MessagePrototype
 
 from .. import cfg
 from ..nav import NavigatorView, NavPages
+from ..startup import requires_ready
 from .autoposts import autopost_command_group, follow_control_command_maker
 
 REFERENCE_DATE = dt.datetime(2023, 12, 12, 17, tzinfo=dt.timezone.utc)
@@ -28,10 +28,10 @@ REFERENCE_DATE = dt.datetime(2023, 12, 12, 17, tzinfo=dt.timezone.utc)
 FOLLOWABLE_CHANNEL = cfg.followables["iron_banner"]
 
 
-async def on_start(event: h.StartedEvent):
+async def on_start(bot: lb.BotApp):
     global iron_banner_pages
     iron_banner_pages = await NavPages.from_channel(
-        event.app,
+        bot,
         FOLLOWABLE_CHANNEL,
         history_len=1,
         period=dt.timedelta(days=7),
@@ -50,6 +50,7 @@ async def iron(ctx: lb.Context):
 @iron.child
 @lb.command("banner", "Iron banner infographic for when it's active")
 @lb.implements(lb.SlashSubCommand)
+@requires_ready("iron_banner")
 async def banner(ctx: lb.Context):
     navigator = NavigatorView(
         pages=iron_banner_pages,
@@ -60,7 +61,7 @@ async def banner(ctx: lb.Context):
 
 def register(bot):
     bot.command(iron)
-    bot.listen()(on_start)
+    bot.startup.add("iron_banner", on_start)
 
     autopost_command_group.child(
         follow_control_command_maker(
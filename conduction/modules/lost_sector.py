@@ -27,6 +27,7 @@ from hmessage import HMessage as MessagePrototype
 from .. import cfg, utils
 from ..bot import CachedFetchBot, ServerEmojiEnabledBot, UserCommandBot
 from ..nav import NO_DATA_HERE_EMBED, NavigatorView, NavPages
+from ..startup import requires_ready
 from ..utils import space
 from .autoposts import autopost_command_group, follow_control_command_maker
 
@@ -319,10 +320,10 @@ class SectorMessages(NavPages):
         return lookahead_dict
 
 
-async def on_start(event: h.StartedEvent):
+async def on_start(bot: lb.BotApp):
     global sectors
     sectors = await SectorMessages.from_channel(
-        event.app,
+        bot,
         FOLLOWABLE_CHANNEL,
         history_len=14,
         lookahead_len=7,
@@ -340,6 +341,7 @@ async def ls_group():
 @ls_group.child
 @lb.command("today", "Find out about today's lost sector")
 @lb.implements(lb.SlashSubCommand)
+@requires_ready("lost_sector")
 async def ls_today_command(ctx: lb.Context):
     navigator = NavigatorView(pages=sectors)
     await navigator.send(ctx.interaction)
@@ -354,6 +356,7 @@ async def ls_group_2():
 @ls_group_2.child
 @lb.command("sector", "Find out about today's lost sector")
 @lb.implements(lb.SlashSubCommand)
+@requires_ready("lost_sector")
 async def lost_sector_command(ctx: lb.Context):
     navigator = NavigatorView(pages=sectors)
     await navigator.send(ctx.interaction)
@@ -362,7 +365,7 @@ async def lost_sector_command(ctx: lb.Context):
 def register(bot: t.Union[CachedFetchBot, UserCommandBot]):
     bot.command(ls_group)
     bot.command(ls_group_2)
-    bot.listen()(on_start)
+    bot.startup.add("lost_sector", on_start)
 
     autopost_command_group.child(
         follow_control_command_maker(
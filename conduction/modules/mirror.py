@@ -14,11 +14,15 @@
 # conduction-tines. If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio as aio
+import datetime as dt
+import io
 import logging
+from collections import defaultdict
+from pathlib import Path
 from random import randint
 from time import perf_counter
 from types import TracebackType
-from typing import Any, Coroutine, Optional, Type
+from typing import Any, Coroutine, Dict, List, Optional, Tuple, Type
 
 import attr
 import dateparser
@@ -27,8 +31,8 @@ import lightbulb as lb
 import regex as re
 from lightbulb.ext import tasks
 
-from .. import bot, cfg, utils
-from ..schemas import MirroredChannel, MirroredMessage, ServerStatistics
+from .. import bot, cache, cfg, mirror_io, schemas, spool, utils
+from ..schemas import MirroredChannel, MirroredMessage, ServerStatistics, db_session
 
 re_markdown_link = re.compile(r"\[(.*?)\]\(.*?\)")
 
@@ -59,6 +63,149 @@ class TimedSemaphore(aio.Semaphore):
 discord_api_semaphore = TimedSemaphore()
 
 
+class MirrorHealthTracker:
+    """Collects legacy mirror outcomes in memory and writes them in bulk
+
+    Outcomes are kept per (src_id, dest_id) pair as (reset, failures), ie
+    whether the pair succeeded since the last flush and how many times it
+    failed after that (or since the last flush if it did not succeed)"""
+
+    def __init__(self):
+        self._pending: Dict[Tuple[int, int], Tuple[bool, int]] = {}
+        self._lock = aio.Lock()
+
+    def record_success(self, src_id: int, dest_id: int):
+        self._pending[(int(src_id), int(dest_id))] = (True, 0)
+
+    def record_failure(self, src_id: int, dest_id: int):
+        pair = (int(src_id), int(dest_id))
+        reset, failures = self._pending.get(pair, (False, 0))
+        self._pending[pair] = (reset, failures + 1)
+
+    async def flush(self) -> List[Tuple[int, int]]:
+        """Write pending outcomes to the db and handle newly failing mirrors
+
+        Only pairs that failed since the last flush are checked against the
+        failure threshold. These are disabled if cfg.disable_bad_channels is
+        set and are returned either way"""
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return []
+
+            # Pairs with the same outcome are written with the same statement
+            outcomes: Dict[Tuple[bool, int], list] = defaultdict(list)
+            for pair, outcome in pending.items():
+                outcomes[outcome].append(pair)
+            failed_pairs = [pair for pair, (_, failures) in pending.items() if failures]
+
+            try:
+                async with utils.unit_of_work(db_session):
+                    for (reset, failures), pairs in outcomes.items():
+                        await MirroredChannel.log_legacy_mirror_results(
+                            pairs, failures, reset
+                        )
+
+                    if not failed_pairs:
+                        failing_mirrors = []
+                    elif cfg.disable_bad_channels:
+                        failing_mirrors = (
+                            await MirroredChannel.disable_legacy_failing_mirrors(
+                                pairs=failed_pairs
+                            )
+                        )
+                    else:
+                        failing_mirrors = (
+                            await MirroredChannel.get_legacy_failing_mirrors(
+                                pairs=failed_pairs
+                            )
+                        )
+            except Exception:
+                # Keep the outcomes for the next flush, ordered before newer ones
+                for pair, (reset, failures) in self._pending.items():
+                    old_reset, old_failures = pending.get(pair, (False, 0))
+                    pending[pair] = (
+                        (True, failures) if reset else (old_reset, old_failures + failures)
+                    )
+                self._pending = pending
+                raise
+
+        if failing_mirrors:
+            logging.warning(
+                ("Disabled " if cfg.disable_bad_channels else "Would disable ")
+                + str(len(failing_mirrors))
+                + " mirrors: "
+                + ", ".join(
+                    [f"{mirror.src_id}: {mirror.dest_id}" for mirror in failing_mirrors]
+                )
+            )
+        return failing_mirrors
+
+
+mirror_health = MirrorHealthTracker()
+
+# Message pairs of recent fan outs, so edits and deletes can skip the db
+recent_mirrors = cache.RecentMirrorCache(
+    cfg.recent_mirror_cache_entries, cfg.recent_mirror_cache_bytes
+)
+
+# Background reloads of srcs restored from the warm start snapshot
+src_filter_reload_tasks = set()
+
+# Message pairs that could not be written to the db, replayed by a task
+message_spool = spool.WriteSpool(Path(cfg.db_spool_dir) / "mirrored_message.jsonl")
+
+
+async def log_mirrored_msgs(
+    source_msg: int,
+    source_channel: int,
+    dest_msgs: List[int],
+    dest_channels: List[int],
+):
+    """Log message pairs to the db, spooling them locally if that fails
+
+    While the spool has records pending replay, pairs go straight to the spool
+    so that fan outs don't wait on a db that is down"""
+    if not message_spool.pending:
+        try:
+            await MirroredMessage.add_msgs_in_batch(
+                dest_msgs=dest_msgs,
+                dest_channels=dest_channels,
+                source_msg=source_msg,
+                source_channel=source_channel,
+            )
+            return
+        except Exception as e:
+            logging.error(f"Error logging mirrored messages in db, spooling: {e}")
+
+    creation_datetime = dt.datetime.utcnow().isoformat()
+    try:
+        await message_spool.append(
+            {
+                "dest_msg": int(dest_msg),
+                "dest_channel": int(dest_channel),
+                "source_msg": int(source_msg),
+                "source_channel": int(source_channel),
+                "creation_datetime": creation_datetime,
+            }
+            for dest_msg, dest_channel in zip(dest_msgs, dest_channels)
+        )
+    except Exception as e:
+        logging.error(f"Error spooling mirrored messages: {e}")
+
+
+async def replay_spooled_msgs(records: List[dict]):
+    await MirroredMessage.upsert_msgs(
+        {
+            **record,
+            "creation_datetime": dt.datetime.fromisoformat(
+                record["creation_datetime"]
+            ),
+        }
+        for record in records
+    )
+
+
 @attr.s
 class KernelWorkDone:
     """Class to hold the result of a creation kernel"""
@@ -248,26 +395,16 @@ async def log_mirror_progress_to_discord(
             await aio.sleep(5**tries)
 
 
-def ignore_non_src_channels(func):
-    async def wrapped_func(event: h.MessageEvent):
-        if isinstance(event, h.MessageCreateEvent) or isinstance(
-            event, h.MessageUpdateEvent
-        ):
-            msg = event.message
-        elif isinstance(event, h.MessageDeleteEvent):
-            msg = event.old_message
-
-        if (
-            msg
-            and int(msg.channel_id) in await MirroredChannel.get_or_fetch_all_srcs()
-            # also keep going if we are running in a test env
-            # keep this towards the end so short circuiting in test_env
-            # does not hide logic errors
-            or cfg.test_env
-        ):
-            return await func(event)
-
-    return wrapped_func
+def is_src_channel(channel_id: int) -> bool:
+    # Runs synchronously for every message event the bot sees, before any
+    # handler is called, so must never do any I/O
+    return (
+        MirroredChannel.is_legacy_src(channel_id)
+        # also keep going if we are running in a test env
+        # keep this towards the end so short circuiting in test_env
+        # does not hide logic errors
+        or cfg.test_env
+    )
 
 
 def ignore_self(func):
@@ -281,7 +418,6 @@ def ignore_self(func):
     return wrapped_func
 
 
-@ignore_non_src_channels
 @ignore_self
 async def message_create_repeater(event: h.MessageCreateEvent):
     await message_create_repeater_impl(
@@ -296,6 +432,7 @@ async def message_create_repeater_impl(
     bot: bot.CachedFetchBot,
     channel: h.TextableChannel,
     wait_for_crosspost: bool = True,
+    first_fan_out: bool = True,
 ):
     backoff_timer = 30
     while True:
@@ -346,15 +483,27 @@ async def message_create_repeater_impl(
         await aio.sleep(delay)
 
         try:
-            channel: h.TextableChannel = await bot.fetch_channel(mirror_ch_id)
+            # Resolve the dest from the gateway fed index, falling back to
+            # fetching it for channels the index doesn't know (yet)
+            destination = bot.channel_index.get(mirror_ch_id)
+            if destination is not None:
+                is_textable = destination.is_textable
+                is_news = destination.is_news
+                if not destination.can_send:
+                    raise ValueError("Missing permissions to send to channel")
+            else:
+                dest_channel = await bot.fetch_channel(mirror_ch_id)
+                is_textable = isinstance(dest_channel, h.TextableChannel)
+                is_news = isinstance(dest_channel, h.GuildNewsChannel)
 
-            if not isinstance(channel, h.TextableChannel):
+            if not is_textable:
                 # Ignore non textable channels
                 raise ValueError("Channel is not textable")
 
             async with discord_api_semaphore:
                 # Send the message
-                mirrored_msg = await channel.send(
+                mirrored_msg = await bot.rest.create_message(
+                    mirror_ch_id,
                     msg.content,
                     attachments=msg.attachments,
                     components=msg.components,
@@ -373,7 +522,7 @@ async def message_create_repeater_impl(
                 retries=current_retries,
             )
 
-        if isinstance(channel, h.GuildNewsChannel):
+        if is_news:
             # If the channel is a news channel then crosspost the message as well
             crosspost_backoff = 30
             for _ in range(3):
@@ -411,6 +560,7 @@ async def message_create_repeater_impl(
     # Always guard against infinite loops through posting to the source channel
     mirrors = list(filter(lambda x: x != channel.id, mirrors))
 
+    recent_mirrors.start(msg.id, first_fan_out)
     announce_jobs = [aio.create_task(kernel(mirror_ch_id)) for mirror_ch_id in mirrors]
     return_in = 10  # seconds
     max_retries = 2
@@ -464,32 +614,24 @@ async def message_create_repeater_impl(
                 # to be logged in the db
                 successes_to_log.append(result)
 
-        # Log successes, failures and message pairs to the db
-        maybe_exceptions = await aio.gather(
-            MirroredChannel.log_legacy_mirror_failure_in_batch(
-                channel.id,
-                [failure.dest_channel_id for failure in failures_to_log],
-            ),
-            MirroredChannel.log_legacy_mirror_success_in_batch(
+        # Mirror health is written in bulk by mirror_health.flush
+        for failure in failures_to_log:
+            mirror_health.record_failure(channel.id, failure.dest_channel_id)
+        for success in successes_to_log:
+            mirror_health.record_success(channel.id, success.dest_channel_id)
+
+        # Log message pairs to the db, or to the local spool if the db is down
+        if successes_to_log:
+            recent_mirrors.extend(
+                msg.id,
+                [success.dest_message_id for success in successes_to_log],
+                [success.dest_channel_id for success in successes_to_log],
+            )
+            await log_mirrored_msgs(
+                msg.id,
                 channel.id,
+                [success.dest_message_id for success in successes_to_log],
                 [success.dest_channel_id for success in successes_to_log],
-            ),
-            MirroredMessage.add_msgs_in_batch(
-                dest_msgs=[success.dest_message_id for success in successes_to_log],
-                dest_channels=[success.dest_channel_id for success in successes_to_log],
-                source_msg=msg.id,
-                source_channel=channel.id,
-            ),
-            return_exceptions=True,
-        )
-
-        # Log exceptions working with the db to the console
-        if any(maybe_exceptions):
-            logging.error(
-                "Error logging mirror success/failure in db: "
-                + ", ".join(
-                    [str(exception) for exception in maybe_exceptions if exception]
-                )
             )
 
         successes.extend(successes_to_log)
@@ -526,22 +668,14 @@ async def message_create_repeater_impl(
 
     logging.info("Completed all mirrors in " + str(perf_counter() - mirror_start_time))
 
-    # Auto disable persistently failing mirrors
-    if cfg.disable_bad_channels:
-        disabled_mirrors = await MirroredChannel.disable_legacy_failing_mirrors()
-
-    if disabled_mirrors:
-        logging.warning(
-            ("Disabled " if cfg.disable_bad_channels else "Would disable ")
-            + str(len(disabled_mirrors))
-            + " mirrors: "
-            + ", ".join(
-                [f"{mirror.src_id}: {mirror.dest_id}" for mirror in disabled_mirrors]
-            )
-        )
+    # Write this fan out's mirror health and auto disable persistently
+    # failing mirrors
+    try:
+        await mirror_health.flush()
+    except Exception as e:
+        logging.error(f"Error logging mirror success/failure in db: {e}")
 
 
-@ignore_non_src_channels
 @ignore_self
 async def message_update_repeater(event: h.MessageUpdateEvent):
     await message_update_repeater_impl(event.message, event.app)
@@ -549,19 +683,21 @@ async def message_update_repeater(event: h.MessageUpdateEvent):
 
 async def message_update_repeater_impl(msg: h.Message, bot: bot.CachedFetchBot):
     backoff_timer = 30
-    while True:
+    # Recently mirrored posts are served from memory without touching the db
+    msgs_to_update = recent_mirrors.get(msg.id)
+    while msgs_to_update is None:
         try:
-            msgs_to_update = await MirroredMessage.get_dest_msgs_and_channels(msg.id)
-            if not msgs_to_update:
-                # Return if this message was not mirrored for any reason
-                return
-
+            msgs_to_update = (
+                await MirroredMessage.get_recent_dest_msgs_and_channels(msg.id)
+            )
         except Exception as e:
             await utils.discord_error_logger(bot, e)
             await aio.sleep(backoff_timer)
             backoff_timer += 30 / backoff_timer
-        else:
-            break
+
+    if not msgs_to_update:
+        # Return if this message was not mirrored for any reason
+        return
 
     mirror_start_time = perf_counter()
 
@@ -684,7 +820,6 @@ async def message_update_repeater_impl(msg: h.Message, bot: bot.CachedFetchBot):
             break
 
 
-@ignore_non_src_channels
 async def message_delete_repeater(event: h.MessageDeleteEvent):
     msg_id = event.message_id
     msg = event.old_message
@@ -697,19 +832,21 @@ async def message_delete_repeater_impl(
     msg_id: int, msg: Optional[h.Message], bot: bot.CachedFetchBot
 ):
     backoff_timer = 30
-    while True:
+    # Recently mirrored posts are served from memory without touching the db
+    msgs_to_delete = recent_mirrors.get(msg_id)
+    while msgs_to_delete is None:
         try:
-            msgs_to_delete = await MirroredMessage.get_dest_msgs_and_channels(msg_id)
-            if not msgs_to_delete:
-                # Return if this message was not mirrored for any reason
-                return
-
+            msgs_to_delete = (
+                await MirroredMessage.get_recent_dest_msgs_and_channels(msg_id)
+            )
         except Exception as e:
             await utils.discord_error_logger(bot, e)
             await aio.sleep(backoff_timer)
             backoff_timer += 30 / backoff_timer
-        else:
-            break
+
+    if not msgs_to_delete:
+        # Return if this message was not mirrored for any reason
+        return
 
     mirror_start_time = perf_counter()
 
@@ -837,33 +974,8 @@ async def refresh_server_sizes(bot: bot.CachedFetchBot):
                 except Exception as e:
                     logging.exception(e)
 
-            existing_servers = await ServerStatistics.fetch_server_ids()
-            existing_servers = list(
-                set(existing_servers).intersection(set(server_populations.keys()))
-            )
-            new_servers = list(set(server_populations.keys()) - set(existing_servers))
-
-            new_servers_bins = [
-                new_servers[i : i + 50] for i in range(0, len(new_servers), 50)
-            ]
-            for new_servers_bin in new_servers_bins:
-                await ServerStatistics.add_servers_in_batch(
-                    new_servers_bin,
-                    [server_populations[server_id] for server_id in new_servers_bin],
-                )
-
-            existing_servers_bins = [
-                existing_servers[i : i + 50]
-                for i in range(0, len(existing_servers), 50)
-            ]
-            for existing_servers_bin in existing_servers_bins:
-                await ServerStatistics.update_population_in_batch(
-                    existing_servers_bin,
-                    [
-                        server_populations[server_id]
-                        for server_id in existing_servers_bin
-                    ],
-                )
+            # Write all populations with a handful of bulk upserts
+            await ServerStatistics.upsert_populations(server_populations.items())
 
         except Exception as e:
             should_retry_ = backoff_timer <= 24 * 60 * 60
@@ -888,6 +1000,80 @@ async def refresh_server_sizes(bot: bot.CachedFetchBot):
             break
 
 
+@tasks.task(tasks.CronTrigger("55 16 * * *"), auto_start=True, pass_app=True)
+async def prewarm_db_pool(bot: bot.CachedFetchBot):
+    # Open db connections ahead of the daily reset at 17:00 UTC
+    # so that the fan-outs at reset do not have to wait on new connections
+    try:
+        await schemas.prewarm_pool()
+    except Exception as e:
+        e.add_note("Exception while prewarming the db connection pool")
+        await utils.discord_error_logger(bot, e)
+
+
+@tasks.task(s=30, auto_start=True, pass_app=True)
+async def reload_changed_mirrors(bot: bot.CachedFetchBot):
+    # Pick up mirror changes made by other processes or directly in the db
+    try:
+        if not MirroredChannel.legacy_srcs_loaded():
+            # Loading the srcs at startup failed
+            await MirroredChannel.load_legacy_srcs()
+        changed_srcs = await MirroredChannel.reload_changed_srcs()
+    except Exception as e:
+        e.add_note("Exception while reloading changed mirrors")
+        await utils.discord_error_logger(bot, e)
+    else:
+        if changed_srcs:
+            logging.info(f"Reloaded mirrors for {len(changed_srcs)} srcs")
+
+
+async def load_src_filter(event: h.StartingEvent):
+    # The src filter must be filled before the gateway delivers any messages
+    # Srcs restored from the warm start snapshot may be stale, so they are
+    # served while being replaced with the db's in the background
+    await event.app.warm_start.loaded.wait()
+    if MirroredChannel.legacy_srcs_loaded():
+        src_filter_reload_tasks.add(aio.create_task(reload_src_filter(event.app)))
+    else:
+        await reload_src_filter(event.app)
+
+
+async def reload_src_filter(bot: bot.CachedFetchBot):
+    try:
+        srcs = await MirroredChannel.load_legacy_srcs()
+    except Exception as e:
+        e.add_note("Exception while loading mirror srcs")
+        await utils.discord_error_logger(bot, e)
+    else:
+        logging.info(f"Loaded {len(srcs)} mirror srcs")
+    finally:
+        src_filter_reload_tasks.discard(aio.current_task())
+
+
+@tasks.task(s=30, auto_start=True, pass_app=True)
+async def replay_message_spool(bot: bot.CachedFetchBot):
+    if not message_spool.pending:
+        return
+
+    try:
+        replayed = await message_spool.replay(replay_spooled_msgs)
+    except Exception as e:
+        # The db is most likely still unreachable, try again later
+        logging.warning(f"Could not replay spooled mirrored messages yet: {e}")
+    else:
+        logging.info(f"Replayed {replayed} spooled mirrored messages into the db")
+
+
+@tasks.task(m=1, auto_start=True, pass_app=True)
+async def flush_mirror_health(bot: bot.CachedFetchBot):
+    # Write outcomes of long running fan outs (retries take minutes) periodically
+    try:
+        await mirror_health.flush()
+    except Exception as e:
+        e.add_note("Exception while flushing mirror health to the db")
+        await utils.discord_error_logger(bot, e)
+
+
 @tasks.task(d=1, auto_start=True, wait_before_execution=False, pass_app=True)
 async def prune_message_db(bot: bot.CachedFetchBot):
     await aio.sleep(randint(120, 1800))
@@ -898,6 +1084,18 @@ async def prune_message_db(bot: bot.CachedFetchBot):
         await utils.discord_error_logger(bot, e)
 
 
+@tasks.task(d=1, auto_start=True, wait_before_execution=False, pass_app=True)
+async def compact_mirror_db(bot: bot.CachedFetchBot):
+    await aio.sleep(randint(120, 1800))
+    try:
+        compacted = await MirroredChannel.compact_disabled(cfg.mirror_compaction_age)
+    except Exception as e:
+        e.add_note("Exception during routine compaction of MirroredChannel")
+        await utils.discord_error_logger(bot, e)
+    else:
+        logging.info(f"Moved {compacted} disabled mirrors to the history table")
+
+
 # Command group for all mirror commands
 mirror_group = lb.command(
     "mirror",
@@ -959,6 +1157,53 @@ async def manual_add(ctx: lb.Context, src: str, dest: str, dest_server_id: str):
     await ctx.respond("Added mirror")
 
 
+@mirror_group.child
+@lb.option(
+    "format", description="File format", choices=mirror_io.FORMATS, default="jsonl"
+)
+@lb.command(
+    "export",
+    description="Export all mirrors to a file",
+    guilds=[cfg.control_discord_server_id],
+    pass_options=True,
+    auto_defer=True,
+)
+@lb.implements(lb.SlashSubCommand)
+async def mirror_export(ctx: lb.Context, format: str):
+    if not ctx.author.id in await ctx.bot.fetch_owner_ids():
+        await ctx.respond("You are not allowed to use this command...")
+        return
+
+    file = io.StringIO()
+    count = await mirror_io.export_mirrors(file, format)
+    await ctx.respond(
+        f"Exported {count} mirrors",
+        attachment=h.Bytes(file.getvalue().encode(), f"mirrors.{format}"),
+    )
+
+
+@mirror_group.child
+@lb.option("file", description="JSONL or CSV file of mirrors", type=h.Attachment)
+@lb.command(
+    "import",
+    description="Add or update mirrors in bulk from an exported file",
+    guilds=[cfg.control_discord_server_id],
+    pass_options=True,
+    auto_defer=True,
+)
+@lb.implements(lb.SlashSubCommand)
+async def mirror_import(ctx: lb.Context, file: h.Attachment):
+    if not ctx.author.id in await ctx.bot.fetch_owner_ids():
+        await ctx.respond("You are not allowed to use this command...")
+        return
+
+    format = mirror_io.format_from_path(file.filename)
+    lines = io.StringIO((await file.read()).decode(), newline="")
+    count = await mirror_io.import_mirrors(lines, format)
+    logging.info(f"Imported {count} mirrors from {file.filename}")
+    await ctx.respond(f"Imported {count} mirrors")
+
+
 @lb.command(
     "mirror_send",
     description="Manually mirror a message",
@@ -979,6 +1224,8 @@ async def manual_mirror_send(ctx: lb.MessageContext):
         ctx.app,
         await ctx.app.fetch_channel(ctx.channel_id),
         wait_for_crosspost=False,
+        # The message may have been mirrored before
+        first_fan_out=False,
     )
     await ctx.edit_last_response("Mirrored message.")
 
@@ -1031,9 +1278,21 @@ async def manual_mirror_delete(ctx: lb.SlashContext, message_id: str):
 
 
 def register(bot):
-    bot.listen(h.MessageCreateEvent)(message_create_repeater)
-    bot.listen(h.MessageUpdateEvent)(message_update_repeater)
-    bot.listen(h.MessageDeleteEvent)(message_delete_repeater)
+    # Srcs change at runtime, so these see all channels and filter on the srcs
+    # before ignore_self or anything else runs
+    bot.message_router.subscribe_all_channels(
+        h.MessageCreateEvent, message_create_repeater, is_src_channel
+    )
+    bot.message_router.subscribe_all_channels(
+        h.MessageUpdateEvent, message_update_repeater, is_src_channel
+    )
+    bot.message_router.subscribe_all_channels(
+        h.MessageDeleteEvent, message_delete_repeater, is_src_channel
+    )
+    bot.listen(h.StartingEvent)(load_src_filter)
+    bot.warm_start.register(
+        "mirror_srcs", MirroredChannel.dump_src_caches, MirroredChannel.load_src_caches
+    )
 
     bot.command(mirror_group)
     bot.command(manual_mirror_send)
@@ -37,12 +37,12 @@ async def message_tracer(event: h.MessageCreateEvent):
         # Not a crosspost
         return
 
+    # Only crossposts of followables are routed here
     if not (
-        event.message.message_reference
-        and event.message.message_reference.guild_id in followable_servers_list
+        event.message.message_reference.guild_id in followable_servers_list
         and event.message.message_reference.channel_id in non_legacy_mirrors
     ):
-        # Not a crosspost from our servers
+        # Not a crosspost from our servers, or its mirrors are not loaded yet
         return
 
     src_ch_id = event.message.message_reference.channel_id
@@ -89,5 +89,6 @@ async def on_start(event: h.StartedEvent):
 
 
 def register(bot: lb.BotApp):
-    bot.listen(h.MessageCreateEvent)(message_tracer)
+    for followable in cfg.followables.values():
+        bot.message_router.subscribe_crossposts(followable, message_tracer)
     bot.listen(h.StartedEvent)(on_start)
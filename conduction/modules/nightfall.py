@@ -23,6 +23,7 @@ from hmessage import HMessage as MessagePrototype
 
 from .. import cfg, utils
 from ..nav import NavigatorView, NavPages
+from ..startup import requires_ready
 from .autoposts import autopost_command_group, follow_control_command_maker
 
 REFERENCE_DATE = dt.datetime(2023, 7, 18, 17, tzinfo=dt.timezone.utc)
@@ -63,10 +64,10 @@ class NightfallPages(NavPages):
         return msg_proto
 
 
-async def on_start(event: h.StartedEvent):
+async def on_start(bot: lb.BotApp):
     global nightfall_pages
     nightfall_pages = await NightfallPages.from_channel(
-        event.app,
+        bot,
         FOLLOWABLE_CHANNEL,
         history_len=12,
         period=dt.timedelta(days=7),
@@ -76,6 +77,7 @@ async def on_start(event: h.StartedEvent):
 
 @lb.command("nightfall", "Find out about this weeks nightfall")
 @lb.implements(lb.SlashCommand)
+@requires_ready("nightfall")
 async def weekly_reset_command(ctx: lb.Context):
     navigator = NavigatorView(pages=nightfall_pages)
     await navigator.send(ctx.interaction)
@@ -83,7 +85,7 @@ async def weekly_reset_command(ctx: lb.Context):
 
 def register(bot):
     bot.command(weekly_reset_command)
-    bot.listen()(on_start)
+    bot.startup.add("nightfall", on_start)
 
     autopost_command_group.child(
         follow_control_command_maker(
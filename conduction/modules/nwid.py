@@ -22,6 +22,7 @@ from hmessage import HMessage as MessagePrototype
 
 from .. import cfg, utils
 from ..nav import NavigatorView, NavPages
+from ..startup import requires_ready
 from .autoposts import autopost_command_group, follow_control_command_maker
 
 REFERENCE_DATE = dt.datetime(2023, 7, 18, 17, tzinfo=dt.timezone.utc)
@@ -77,10 +78,10 @@ class NWIDPages(NavPages):
         return msg
 
 
-async def on_start(event: h.StartedEvent):
+async def on_start(bot: lb.BotApp):
     global evweekly
     evweekly = await NWIDPages.from_channel(
-        event.app,
+        bot,
         FOLLOWABLE_CHANNEL,
         history_len=4,
         period=dt.timedelta(days=7),
@@ -91,6 +92,7 @@ async def on_start(event: h.StartedEvent):
 
 @lb.command("nwid", 'Find out what\'s going on "Next week in Destiny"')
 @lb.implements(lb.SlashCommand)
+@requires_ready("nwid")
 async def nwid(ctx: lb.Context):
     navigator = NavigatorView(pages=evweekly, autodefer=True)
     await navigator.send(ctx.interaction)
@@ -98,7 +100,7 @@ async def nwid(ctx: lb.Context):
 
 def register(bot):
     bot.command(nwid)
-    bot.listen()(on_start)
+    bot.startup.add("nwid", on_start)
 
     autopost_command_group.child(
         follow_control_command_maker(
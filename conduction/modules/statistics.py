@@ -13,14 +13,18 @@
 # You should have received a copy of the GNU Affero General Public License along with
 # conduction-tines. If not, see <https://www.gnu.org/licenses/>.
 
+import datetime as dt
+import logging
 import typing as t
 
+import attr
 import hikari as h
 import lightbulb as lb
-import math
+from lightbulb.ext import tasks
 
-from .. import cfg, schemas
+from .. import cfg, schemas, utils
 from ..bot import CachedFetchBot
+from .mirror import recent_mirrors
 
 
 @lb.command("stats", "Bot statistics command group", auto_defer=True, hidden=True)
@@ -29,6 +33,86 @@ async def stats_command_group(ctx: lb.Context):
     pass
 
 
+# Number of most populous servers listed by name in /stats populations
+TOP_SERVERS = 7
+
+
+@attr.s
+class StatisticsSnapshot:
+    """Precomputed data for the /stats autoposts and populations commands"""
+
+    # Followable name -> number of (non legacy) followers and (legacy) mirrors
+    followers: t.Dict[str, int] = attr.ib()
+    mirrors: t.Dict[str, int] = attr.ib()
+    total_population: int = attr.ib()
+    # (server name or id, population) of the most populous servers
+    top_servers: t.List[t.Tuple[str | int, int]] = attr.ib()
+    # (lower bound, number of servers) per logarithmic population bin
+    population_bins: t.List[t.Tuple[int, int]] = attr.ib()
+    taken_at: dt.datetime = attr.ib(factory=lambda: dt.datetime.now(tz=dt.timezone.utc))
+
+
+statistics_snapshot: t.Optional[StatisticsSnapshot] = None
+
+
+async def take_statistics_snapshot(bot: CachedFetchBot) -> StatisticsSnapshot:
+    global statistics_snapshot
+
+    # Share one read only session across all the queries
+    async with (schemas.db_replica_session or schemas.db_session)() as session:
+        dest_counts = await schemas.MirroredChannel.count_dests_by_src(
+            cfg.followables.values(), session=session
+        )
+        top_populations = await schemas.ServerStatistics.fetch_top_populations(
+            TOP_SERVERS, session=session
+        )
+        (
+            total_population,
+            population_bins,
+        ) = await schemas.ServerStatistics.fetch_population_histogram(session=session)
+
+    top_servers = []
+    for server_id, population in top_populations:
+        try:
+            top_servers.append(((await bot.fetch_guild(server_id)).name, population))
+        except Exception:
+            top_servers.append((server_id, population))
+
+    statistics_snapshot = StatisticsSnapshot(
+        followers={
+            name: dest_counts.get((channel_id, False), 0)
+            for name, channel_id in cfg.followables.items()
+        },
+        mirrors={
+            name: dest_counts.get((channel_id, True), 0)
+            for name, channel_id in cfg.followables.items()
+        },
+        total_population=total_population,
+        top_servers=top_servers,
+        population_bins=population_bins,
+    )
+    return statistics_snapshot
+
+
+async def fetch_statistics_snapshot(bot: CachedFetchBot) -> StatisticsSnapshot:
+    """Return the latest snapshot, taking one if none was taken yet"""
+    return statistics_snapshot or await take_statistics_snapshot(bot)
+
+
+@tasks.task(m=5, auto_start=True, wait_before_execution=False, pass_app=True)
+async def refresh_statistics_snapshot(bot: CachedFetchBot):
+    # The previous snapshot is kept and served if this one fails
+    try:
+        await take_statistics_snapshot(bot)
+    except Exception as e:
+        e.add_note("Exception while refreshing the statistics snapshot")
+        await utils.discord_error_logger(bot, e)
+
+
+def _snapshot_footer(snapshot: StatisticsSnapshot) -> str:
+    return f"As of {snapshot.taken_at:%Y-%m-%d %H:%M} UTC"
+
+
 @stats_command_group.child
 @lb.command(
     "populations",
@@ -38,52 +122,41 @@ async def stats_command_group(ctx: lb.Context):
 )
 @lb.implements(lb.SlashSubCommand)
 async def populations_command(ctx: lb.Context):
-    bot: CachedFetchBot = ctx.bot
-
-    populations: list = await schemas.ServerStatistics.fetch_server_populations()
-    populations.sort(key=lambda x: x[1], reverse=True)
-    top_7 = populations[:7]
-    rest = sum(map(lambda x: x[1], populations[7:]))
-
-    for server_id, population in top_7:
-        try:
-            server = await bot.fetch_guild(server_id)
-            top_7[top_7.index((server_id, population))] = (server.name, population)
-        except:
-            top_7[top_7.index((server_id, population))] = (server_id, population)
-
-    # Logarithmic breakdown
-    logs = {}
-    for _, population in populations:
-        log = math.floor(math.log10(population))
-        if log in logs:
-            logs[log] += 1
-        else:
-            logs[log] = 1
+    snapshot = await fetch_statistics_snapshot(ctx.bot)
+    rest = snapshot.total_population - sum(
+        population for _, population in snapshot.top_servers
+    )
 
     log_breakdown_text = ""
-    for log_key in sorted(logs.keys()):
-        log_breakdown_text += (
-            f"\nBetween **{10**log_key:,d}** and "
-            + f"**{10**(log_key+1):,d}**: "
-            + f"{logs[log_key]:,d}"
-        )
+    for i, (lower_bound, count) in enumerate(snapshot.population_bins):
+        if not count:
+            continue
+        if lower_bound == 0:
+            log_breakdown_text += f"\nEmpty or unknown: {count:,d}"
+        elif i + 1 < len(snapshot.population_bins):
+            log_breakdown_text += (
+                f"\nBetween **{lower_bound:,d}** and "
+                + f"**{snapshot.population_bins[i + 1][0]:,d}**: "
+                + f"{count:,d}"
+            )
+        else:
+            log_breakdown_text += f"\n**{lower_bound:,d}** or more: {count:,d}"
 
     await ctx.respond(
         h.Embed(
             title="Server populations",
             description=""
-            + f"\n**Total**: {sum(map(lambda x: x[1], populations)):,d}"
-            + f"\n**Top 7 servers by population**\n"
+            + f"\n**Total**: {snapshot.total_population:,d}"
+            + f"\n**Top {TOP_SERVERS} servers by population**\n"
             + "\n".join(
                 f"{i+1}. **{server_name}**: {population:,d}"
-                for i, (server_name, population) in enumerate(top_7)
+                for i, (server_name, population) in enumerate(snapshot.top_servers)
             )
             + f"\n**Other servers**: {rest:,d}"
             + "\n\n**Logarithmic breakdown of server populations**"
             + log_breakdown_text,
             color=cfg.embed_default_color,
-        )
+        ).set_footer(_snapshot_footer(snapshot))
     )
 
 
@@ -92,16 +165,7 @@ async def populations_command(ctx: lb.Context):
 @lb.implements(lb.SlashSubCommand)
 async def mirror_stats_command(ctx: lb.Context):
     """Get the number of destinations for each cfg.followables channel"""
-    dest_legacy_statistics: t.Dict[str, int] = {}
-    dest_non_legacy_statistics: t.Dict[str, int] = {}
-
-    for name, channel_id in cfg.followables.items():
-        dest_legacy_statistics[name] = await schemas.MirroredChannel.count_dests(
-            channel_id, legacy_only=True
-        )
-        dest_non_legacy_statistics[name] = await schemas.MirroredChannel.count_dests(
-            channel_id, legacy_only=False
-        )
+    snapshot = await fetch_statistics_snapshot(ctx.bot)
 
     embed = h.Embed(
         title="Autopost statistics",
@@ -109,18 +173,160 @@ async def mirror_stats_command(ctx: lb.Context):
         + "It will only be aware of autoposts for servers it is in "
         + "and for channels it can see.",
         color=cfg.embed_default_color,
-    )
+    ).set_footer(_snapshot_footer(snapshot))
 
-    for name in dest_legacy_statistics.keys():
+    for name in cfg.followables.keys():
         embed.add_field(
             name=name.capitalize(),
-            value=f"```Followers : {dest_non_legacy_statistics[name]}\n"
-            + f"Mirrors   : {dest_legacy_statistics[name]}```",
+            value=f"```Followers : {snapshot.followers[name]}\n"
+            + f"Mirrors   : {snapshot.mirrors[name]}```",
+            inline=True,
+        )
+
+    await ctx.respond(embed)
+
+
+@stats_command_group.child
+@lb.command("database", "Database connection statistics", auto_defer=True, hidden=True)
+@lb.implements(lb.SlashSubCommand)
+async def database_stats_command(ctx: lb.Context):
+    embed = h.Embed(title="Database statistics", color=cfg.embed_default_color)
+
+    engines = {"Primary": schemas.db_engine}
+    if schemas.db_replica_engine is not None:
+        engines["Replica"] = schemas.db_replica_engine
+
+    for name, engine in engines.items():
+        pool_statistics = schemas.pool_statistics(engine)
+        embed.add_field(
+            name,
+            "```"
+            + f"Pool size        : {pool_statistics['size']}\n"
+            + f"Checked out      : {pool_statistics['checked_out']}\n"
+            + f"Overflow         : {pool_statistics['overflow']}\n"
+            + f"Waiting          : {pool_statistics['waiters']}\n"
+            + f"Checkout timeouts: {pool_statistics['timeouts']}\n"
+            + f"Checkout latency : {pool_statistics['checkout_latency']}"
+            + "```",
+        )
+
+    # Schema methods that spent the most time in the db
+    latencies = sorted(
+        schemas.query_instrumentation.latencies.items(),
+        key=lambda item: item[1].total,
+        reverse=True,
+    )[:8]
+    if latencies:
+        embed.add_field(
+            "Query latency by caller",
+            "```"
+            + "\n".join(f"{caller}\n  {histogram}" for caller, histogram in latencies)
+            + "```",
+        )
+
+    embed.add_field(
+        "Recent mirrors cache",
+        f"```{recent_mirrors}```",
+    )
+
+    await ctx.respond(embed)
+
+
+@stats_command_group.child
+@lb.command("caches", "In memory cache statistics", auto_defer=True, hidden=True)
+@lb.implements(lb.SlashSubCommand)
+async def cache_stats_command(ctx: lb.Context):
+    bot: CachedFetchBot = ctx.bot
+    embed = h.Embed(title="Cache statistics", color=cfg.embed_default_color)
+    for kind, rest_cache in bot.rest_cache.caches.items():
+        embed.add_field(
+            f"REST {kind}s",
+            "```"
+            + f"Entries     : {len(rest_cache)}/{rest_cache.policy.max_entries}\n"
+            + f"Hits        : {rest_cache.hits}\n"
+            + f"Negative    : {rest_cache.negative_hits}\n"
+            + f"Misses      : {rest_cache.misses}\n"
+            + f"Evictions   : {rest_cache.evictions}\n"
+            + f"Expirations : {rest_cache.expirations}"
+            + "```",
             inline=True,
         )
 
+    embed.add_field(
+        "REST request coalescing",
+        "```"
+        + f"Requests  : {bot.rest_flights.calls}\n"
+        + f"Coalesced : {bot.rest_flights.coalesced}\n"
+        + f"In flight : {len(bot.rest_flights)}"
+        + "```",
+    )
+    embed.add_field("Channel index", f"```Channels  : {len(bot.channel_index)}```")
+
+    all_ready_after = bot.startup.all_ready_after
+    embed.add_field(
+        "Startup"
+        + (f" (all ready in {all_ready_after:.1f}s)" if all_ready_after else ""),
+        "```"
+        + "\n".join(
+            f"{name:<13}: "
+            + (
+                f"{ready_after:>6.1f}s"
+                if ready_after is not None
+                else bot.startup.status(name)
+            )
+            + (f" {failures} failures" if failures else "")
+            for name, ready_after, failures in bot.startup.report()
+        )
+        + "```",
+    )
+
+    cache_report = bot.cache_memory_report()
+    embed.add_field(
+        f"Gateway cache ({cfg.cache_profile} profile)",
+        "```"
+        + "\n".join(
+            f"{component:<13}: {count:>8} ~{size / 2**20:.1f}MiB"
+            for component, count, size in cache_report
+        )
+        + f"\n{'total':<13}: {sum(size for *_, size in cache_report) / 2**20:.1f}MiB"
+        + "```",
+    )
+
     await ctx.respond(embed)
 
 
+# Most slow queries sent to the alerts channel per report, the rest are counted
+MAX_SLOW_QUERY_ALERTS = 5
+
+
+@tasks.task(m=1, auto_start=True, pass_app=True)
+async def report_slow_queries(bot: CachedFetchBot):
+    slow_queries = schemas.query_instrumentation.drain_slow_queries()
+    # Drained queries are logged first so they are not lost if the alerts fail
+    for slow_query in slow_queries:
+        logging.warning(
+            f"Slow query from {slow_query.caller}: {slow_query.count} run(s), "
+            + f"max {slow_query.max_seconds:.2f}s: {slow_query.shape}"
+        )
+
+    try:
+        for slow_query in slow_queries[:MAX_SLOW_QUERY_ALERTS]:
+            await bot.rest.create_message(
+                cfg.alerts_channel,
+                f"Slow query from `{slow_query.caller}`: "
+                + f"{slow_query.count} run(s), max {slow_query.max_seconds:.2f}s"
+                + f"\n```sql\n{slow_query.shape[:1500]}\n```",
+            )
+        if len(slow_queries) > MAX_SLOW_QUERY_ALERTS:
+            await bot.rest.create_message(
+                cfg.alerts_channel,
+                f"{len(slow_queries) - MAX_SLOW_QUERY_ALERTS} more slow queries, "
+                + "see the logs for details",
+            )
+    except Exception as e:
+        e.add_note("Exception while reporting slow queries")
+        await utils.discord_error_logger(bot, e)
+
+
 def register(bot: lb.BotApp):
     bot.command(stats_command_group)
@@ -15,12 +15,12 @@
 
 import datetime as dt
 
-import hikari as h
 import lightbulb as lb
 from hmessage import HMessage as MessagePrototype
 
 from .. import cfg
 from ..nav import NavigatorView, NavPages
+from ..startup import requires_ready
 from .autoposts import autopost_command_group, follow_control_command_maker
 
 REFERENCE_DATE = dt.datetime(2024, 1, 9, 17, tzinfo=dt.timezone.utc)
@@ -28,10 +28,10 @@ REFERENCE_DATE = dt.datetime(2024, 1, 9, 17, tzinfo=dt.timezone.utc)
 FOLLOWABLE_CHANNEL = cfg.followables["trials"]
 
 
-async def on_start(event: h.StartedEvent):
+async def on_start(bot: lb.BotApp):
     global trials_pages
     trials_pages = await NavPages.from_channel(
-        event.app,
+        bot,
         FOLLOWABLE_CHANNEL,
         history_len=12,
         period=dt.timedelta(days=7),
@@ -45,6 +45,7 @@ async def on_start(event: h.StartedEvent):
 
 @lb.command("trials", "Find out about this weeks Trials weapon and map")
 @lb.implements(lb.SlashCommand)
+@requires_ready("trials")
 async def trials_command(ctx: lb.Context):
     navigator = NavigatorView(
         pages=trials_pages,
@@ -55,7 +56,7 @@ async def trials_command(ctx: lb.Context):
 
 def register(bot):
     bot.command(trials_command)
-    bot.listen()(on_start)
+    bot.startup.add("trials", on_start)
 
     autopost_command_group.child(
         follow_control_command_maker(
@@ -22,6 +22,7 @@ from hmessage import HMessage as MessagePrototype
 
 from .. import cfg, utils
 from ..nav import NavigatorView, NavPages
+from ..startup import requires_ready
 from .autoposts import autopost_command_group, follow_control_command_maker
 
 REFERENCE_DATE = dt.datetime(2023, 7, 18, 17, tzinfo=dt.timezone.utc)
@@ -78,10 +79,10 @@ class TWIDPages(NavPages):
         return msg
 
 
-async def on_start(event: h.StartedEvent):
+async def on_start(bot: lb.BotApp):
     global twidpages
     twidpages = await TWIDPages.from_channel(
-        event.app,
+        bot,
         FOLLOWABLE_CHANNEL,
         history_len=4,
         period=dt.timedelta(days=7),
@@ -91,6 +92,7 @@ async def on_start(event: h.StartedEvent):
 
 @lb.command("twid", "Find out about This Week In Destiny (formerly the TWAB)")
 @lb.implements(lb.SlashCommand)
+@requires_ready("twab")
 async def twid(ctx: lb.Context):
     navigator = NavigatorView(pages=twidpages, autodefer=True)
     await navigator.send(ctx.interaction)
@@ -98,6 +100,7 @@ async def twid(ctx: lb.Context):
 
 @lb.command("twab", "Find out about This Week In Destiny (formerly the TWAB)")
 @lb.implements(lb.SlashCommand)
+@requires_ready("twab")
 async def twab(ctx: lb.Context):
     navigator = NavigatorView(pages=twidpages, autodefer=True)
     await navigator.send(ctx.interaction)
@@ -106,7 +109,7 @@ async def twab(ctx: lb.Context):
 def register(bot):
     bot.command(twid)
     bot.command(twab)
-    bot.listen()(on_start)
+    bot.startup.add("twab", on_start)
 
     autopost_command_group.child(
         follow_control_command_maker(
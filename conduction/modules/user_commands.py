@@ -18,6 +18,7 @@ import hikari as h
 import lightbulb as lb
 import typing as t
 import traceback as tb
+from lightbulb.ext import tasks
 
 from .. import cfg, utils
 from ..schemas import UserCommand, db_session
@@ -72,7 +73,7 @@ async def layer_name_autocomplete(
             # do not autocomplete
             return
 
-        # Get autocompletions from the db
+        # Get autocompletions from the in memory command catalog
         cmds = await UserCommand._autocomplete(l1_name, l2_name, l3_name)
         # Return names from the right layer depth
         options = [
@@ -532,6 +533,17 @@ async def rename_command_or_group(
         )
 
 
+@tasks.task(s=30, auto_start=True, pass_app=True)
+async def reload_changed_user_commands(bot: lb.BotApp):
+    # Pick up command changes made by other processes so autocomplete stays current
+    try:
+        if await UserCommand.reload_catalog_if_changed():
+            logging.info("Reloaded user command catalog")
+    except Exception as e:
+        e.add_note("Exception while reloading the user command catalog")
+        await utils.discord_error_logger(bot, e)
+
+
 def register(bot):
     for command in [
         command_group,
@@ -23,6 +23,7 @@ from hmessage import HMessage as MessagePrototype
 
 from .. import cfg, utils
 from ..nav import NavigatorView, NavPages
+from ..startup import requires_ready
 from .autoposts import autopost_command_group, follow_control_command_maker
 
 REFERENCE_DATE = dt.datetime(2023, 7, 18, 17, tzinfo=dt.timezone.utc)
@@ -54,10 +55,10 @@ class ResetPages(NavPages):
         return msg_proto
 
 
-async def on_start(event: h.StartedEvent):
+async def on_start(bot: lb.BotApp):
     global reset_pages
     reset_pages = await ResetPages.from_channel(
-        event.app,
+        bot,
         FOLLOWABLE_CHANNEL,
         history_len=12,
         period=dt.timedelta(days=7),
@@ -74,6 +75,7 @@ async def weekly_reset_command_group(ctx: lb.Context):
 @weekly_reset_command_group.child
 @lb.command("reset", "Find out about this weeks reset")
 @lb.implements(lb.SlashSubCommand)
+@requires_ready("weekly_reset")
 async def weekly_reset_command(ctx: lb.Context):
     navigator = NavigatorView(pages=reset_pages)
     await navigator.send(ctx.interaction)
@@ -81,7 +83,7 @@ async def weekly_reset_command(ctx: lb.Context):
 
 def register(bot):
     bot.command(weekly_reset_command_group)
-    bot.listen()(on_start)
+    bot.startup.add("weekly_reset", on_start)
 
     autopost_command_group.child(
         follow_control_command_maker(
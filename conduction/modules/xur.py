@@ -24,6 +24,7 @@ from hmessage import MultiImageEmbedList
 
 from .. import cfg, utils
 from ..nav import NavigatorView, NavPages
+from ..startup import requires_ready
 from .autoposts import autopost_command_group, follow_control_command_maker
 
 REFERENCE_DATE = dt.datetime(2023, 7, 14, 17, tzinfo=dt.timezone.utc)
@@ -74,10 +75,10 @@ class XurPages(NavPages):
         return msg_proto
 
 
-async def on_start(event: h.StartedEvent):
+async def on_start(bot: lb.BotApp):
     global xur_pages
     xur_pages = await XurPages.from_channel(
-        event.app,
+        bot,
         FOLLOWABLE_CHANNEL,
         history_len=12,
         period=dt.timedelta(days=7),
@@ -87,6 +88,7 @@ async def on_start(event: h.StartedEvent):
 
 @lb.command("xur", "Find out what Xur has and where Xur is")
 @lb.implements(lb.SlashCommand)
+@requires_ready("xur")
 async def xur_command(ctx: lb.Context):
     navigator = NavigatorView(pages=xur_pages)
     await navigator.send(ctx.interaction)
@@ -94,7 +96,7 @@ async def xur_command(ctx: lb.Context):
 
 def register(bot):
     bot.command(xur_command)
-    bot.listen()(on_start)
+    bot.startup.add("xur", on_start)
 
     autopost_command_group.child(
         follow_control_command_maker(FOLLOWABLE_CHANNEL, "xur", "Xur", "Xur auto posts")
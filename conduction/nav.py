@@ -15,6 +15,9 @@
 
 # Define our custom navigator classes
 import datetime as dt
+import functools
+import hashlib
+import inspect
 import logging
 import typing as t
 from asyncio import sleep
@@ -29,10 +32,20 @@ from miru.ext import nav
 
 from . import utils
 from .bot import CachedFetchBot
-from .cfg import embed_default_color, navigator_timeout, reset_time_tolerance, url_regex
+from .cfg import (
+    embed_default_color,
+    nav_store_dir,
+    navigator_timeout,
+    reset_time_tolerance,
+    url_regex,
+)
+from .nav_store import NavPagesStore, StoredPages
 
 NO_DATA_HERE_EMBED = h.Embed(title="No data here!", color=embed_default_color)
 
+# Preprocessed pages of all NavPages, so that restarts only fetch new messages
+page_store = NavPagesStore(nav_store_dir)
+
 
 class DateRangeDict(t.Dict[dt.datetime, MessagePrototype]):
     """Dict with keys that are contiguous date ranges up to limits
@@ -353,6 +366,40 @@ class NavPages(DateRangeDict):
         self._reference_date = reference_date
         self._suppress_content_autoembeds = suppress_content_autoembeds
         self.no_data_message = no_data_message
+        # Newest message the history was built from, stored with the pages
+        self._last_message_id: t.Optional[int] = None
+
+    # Bump to discard stored pages when rendering changes outside of the
+    # modules hashed by _render_key, eg with a new hikari-message version
+    render_version = 1
+
+    @functools.cached_property
+    def _render_key(self) -> t.Optional[str]:
+        """Identifies the code and settings the pages are rendered with
+
+        Hashes the source of the modules defining this class and its NavPages
+        bases, so pages stored by a different version of preprocess_messages
+        (or of anything else in those modules) are rebuilt rather than served.
+        None if the source is not available, in which case pages are not stored
+        """
+        digest = hashlib.sha256(
+            f"{self.render_version}|{self.period}|{self._reference_date}|"
+            f"{self._suppress_content_autoembeds}".encode()
+        )
+        modules = []
+        for cls in type(self).__mro__:
+            module = inspect.getmodule(cls)
+            if module not in modules:
+                modules.append(module)
+            if cls is NavPages:
+                break
+        try:
+            for module in modules:
+                digest.update(inspect.getsource(module).encode())
+        except (OSError, TypeError) as e:
+            logging.warning(f"Not storing {type(self).__name__} pages: {e}")
+            return None
+        return digest.hexdigest()
 
     def __getitem__(self, key: dt.datetime | int) -> MessagePrototype:
         try:
@@ -411,11 +458,49 @@ class NavPages(DateRangeDict):
         return self
 
     async def _populate_history(self):
+        stored = self._render_key and await page_store.load(
+            type(self).__name__, self.channel.id, self._render_key
+        )
+        if stored is not None and (
+            h.Snowflake(stored.last_message_id).created_at >= self.limits[0]
+        ):
+            await self._sync_history(stored)
+        else:
+            await self._fetch_history()
+        await self._store_history()
+
+    async def _sync_history(self, stored: StoredPages):
+        """Restore stored pages and refresh the periods with newer messages"""
+        history_end = self._history_end
+        for start_of_period, page in stored.pages.items():
+            if self.limits[0] <= start_of_period <= history_end:
+                self[start_of_period] = page
+        self._last_message_id = stored.last_message_id
+
+        changed_periods = set()
+        async for msg in self.channel.fetch_history(
+            after=h.Snowflake(stored.last_message_id)
+        ):
+            self._last_message_id = max(self._last_message_id, msg.id)
+            start_of_period = self.round_down(msg.timestamp)
+            if self.limits[0] <= start_of_period <= self.limits[1]:
+                changed_periods.add(start_of_period)
+
+        for start_of_period in sorted(changed_periods):
+            await self._refresh_period(start_of_period)
+
+        logging.info(
+            f"Restored {len(stored.pages)} {type(self).__name__} pages, "
+            + f"refreshed {len(changed_periods)}"
+        )
+
+    async def _fetch_history(self):
         # Find start time
         after = self.limits[0]
 
         # Bin messages into periods
         async for msg in self.channel.fetch_history(after=after - reset_time_tolerance):
+            self._last_message_id = max(self._last_message_id or 0, msg.id)
             msg_time = msg.timestamp
 
             start_of_period = self.round_down(msg_time)
@@ -435,9 +520,6 @@ class NavPages(DateRangeDict):
     async def _update_history(self, event: h.MessageCreateEvent | h.MessageUpdateEvent):
         """Updates the history with any changes or new messages in self.channel"""
 
-        if not event.channel_id == self.channel.id:
-            return
-
         logging.info(
             ("Update " if isinstance(event, h.MessageUpdateEvent) else "Create ")
             + f"event received in channel id {event.channel_id} "
@@ -467,15 +549,8 @@ class NavPages(DateRangeDict):
                     return
 
                 # Get all messages in this event's message's period
-                from_ = self.round_down(msg.timestamp)
-                until_ = from_ + self.period
-                msgs_from_api = []
-                async for msg_from_api in self.channel.fetch_history(after=from_):
-                    if msg_from_api.timestamp > until_:
-                        break
-                    msgs_from_api.append(msg_from_api)
-
-                self[from_] = self.preprocess_messages(msgs_from_api)
+                self._last_message_id = max(self._last_message_id or 0, msg.id)
+                await self._refresh_period(self.round_down(msg.timestamp))
 
             except Exception as e:
                 await utils.discord_error_logger(self.bot, e)
@@ -483,6 +558,55 @@ class NavPages(DateRangeDict):
             else:
                 break
 
+        await self._store_history()
+
+    async def _refresh_period(self, from_: dt.datetime):
+        """Rebuild the page of the period starting at from_ from the api"""
+        until_ = from_ + self.period
+        msgs_from_api = []
+        async for msg_from_api in self.channel.fetch_history(
+            after=from_ - reset_time_tolerance
+        ):
+            if msg_from_api.timestamp > until_:
+                break
+            if self.round_down(msg_from_api.timestamp) == from_:
+                msgs_from_api.append(msg_from_api)
+
+        if msgs_from_api:
+            self[from_] = self.preprocess_messages(msgs_from_api)
+        else:
+            self.pop(from_, None)
+
+    @property
+    def _history_end(self) -> dt.datetime:
+        # Start of the last period built from history rather than lookahead
+        return self.limits[1] - self.period * self.lookahead_len
+
+    async def _store_history(self):
+        if self._last_message_id is None or self._render_key is None:
+            # Nothing posted in the history window, or no way to tell which
+            # version of the code rendered the pages
+            return
+
+        history_end = self._history_end
+        try:
+            await page_store.save(
+                type(self).__name__,
+                self.channel.id,
+                self._render_key,
+                StoredPages(
+                    int(self._last_message_id),
+                    {
+                        start_of_period: page
+                        for start_of_period, page in self.items()
+                        if start_of_period <= history_end
+                    },
+                ),
+            )
+        except Exception as e:
+            e.add_note(f"Exception while storing {type(self).__name__} pages")
+            logging.exception(e)
+
     async def _update_lookahead(self):
         if self.lookahead_len <= 0:
             return
@@ -495,12 +619,10 @@ class NavPages(DateRangeDict):
 
     def _setup_autoupdate(self):
         if self.history_len > 0:
-
-            @self.bot.listen()
-            async def history_updater(
-                event: h.MessageCreateEvent | h.MessageUpdateEvent,
-            ):
-                await self._update_history(event)
+            for event_type in (h.MessageCreateEvent, h.MessageUpdateEvent):
+                self.bot.message_router.subscribe(
+                    event_type, self.channel.id, self._update_history
+                )
 
         if self.lookahead_len > 0:
 
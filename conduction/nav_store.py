@@ -0,0 +1,91 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# Local store of preprocessed NavPages pages, so that restarts only need to
+# fetch the messages posted since the last stored message
+#
+# Each NavPages class and channel pair has its own VersionedFile, with a
+# payload of pickle((render key, last message id, {period: page})). The render
+# key identifies the code and settings the pages were rendered with, pages
+# stored under another key are rebuilt from the channel history.
+#
+# Pages are hikari-message prototypes, which hold hikari embeds and
+# attachments, so unlike the warm start snapshot this needs pickle. The files
+# are only ever written by the bot itself
+
+import asyncio
+import datetime as dt
+import logging
+import os
+import pickle
+import typing as t
+from collections import defaultdict
+from pathlib import Path
+
+from .versioned_file import VersionedFile
+
+MAGIC = b"CTNAVP\x00\x00"
+# Bump when the layout of the stored pages changes incompatibly
+FORMAT_VERSION = 1
+
+
+class StoredPages(t.NamedTuple):
+    # Id of the newest message the pages were built from
+    last_message_id: int
+    # Preprocessed page of each period, by the start of the period
+    pages: t.Dict[dt.datetime, t.Any]
+
+
+class NavPagesStore:
+    """Persists the pages of NavPages by (name, channel id) and period"""
+
+    def __init__(self, directory: str | os.PathLike):
+        self.directory = Path(directory)
+        # Serialises writes to each file, which share a temporary file
+        self._locks: t.Dict[Path, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    def _file(self, name: str, channel_id: int) -> VersionedFile:
+        return VersionedFile(
+            self.directory / f"{name}-{int(channel_id)}.pages", MAGIC, FORMAT_VERSION
+        )
+
+    async def load(
+        self, name: str, channel_id: int, render_key: str
+    ) -> t.Optional[StoredPages]:
+        """Return the stored pages, or None if there are none usable
+
+        Pages rendered under a different render_key are not usable"""
+        file = self._file(name, channel_id)
+        try:
+            payload = await asyncio.to_thread(file.read)
+            if payload is None:
+                return None
+            stored_render_key, *stored = pickle.loads(payload)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable stored pages {file.path}: {e}")
+            return None
+
+        if stored_render_key != render_key:
+            logging.info(f"Ignoring {file.path} rendered by a different version")
+            return None
+        return StoredPages(*stored)
+
+    async def save(
+        self, name: str, channel_id: int, render_key: str, stored: StoredPages
+    ):
+        file = self._file(name, channel_id)
+        payload = pickle.dumps((render_key, *stored), pickle.HIGHEST_PROTOCOL)
+        async with self._locks[file.path]:
+            await asyncio.to_thread(file.write, payload)
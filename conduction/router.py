@@ -0,0 +1,143 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# Routes message events to the handlers interested in their channel
+#
+# hikari runs every listener of an event in its own task, so a listener per
+# module for every message in every guild costs a task spawn per module even
+# though almost all of them only check the channel and return. The router is
+# the only listener for the message events it routes, and looks handlers up by
+# channel id, so messages in channels nobody is interested in cost one dict
+# lookup
+
+import asyncio
+import logging
+import typing as t
+from collections import defaultdict
+
+import hikari as h
+
+MessageEventT = t.TypeVar("MessageEventT", bound=h.MessageEvent)
+Handler = t.Callable[[MessageEventT], t.Coroutine[t.Any, t.Any, None]]
+ChannelFilter = t.Callable[[int], bool]
+
+
+class MessageRouter:
+    """Dispatches message events to handlers by channel id
+
+    Handlers subscribed for a channel only receive events from that channel.
+    Crosspost handlers receive MessageCreateEvents of crossposts of the given
+    source channel, in whichever channel they were crossposted to. Handlers
+    subscribed to all channels can pass a synchronous channel filter, which
+    runs before the handler is called so that filtered out events never start
+    a coroutine"""
+
+    def __init__(self, bot: h.GatewayBot):
+        self._bot = bot
+        self._routes: t.Dict[
+            t.Type[h.MessageEvent], t.Dict[int, t.List[Handler]]
+        ] = defaultdict(lambda: defaultdict(list))
+        self._crosspost_routes: t.Dict[int, t.List[Handler]] = defaultdict(list)
+        self._all_channels: t.Dict[
+            t.Type[h.MessageEvent],
+            t.List[t.Tuple[Handler, t.Optional[ChannelFilter]]],
+        ] = defaultdict(list)
+        self._listening: t.Set[t.Type[h.MessageEvent]] = set()
+        self.routed = 0
+        self.dropped = 0
+
+    def subscribe(
+        self,
+        event_type: t.Type[MessageEventT],
+        channel_id: int,
+        handler: Handler[MessageEventT],
+    ):
+        self._routes[event_type][int(channel_id)].append(handler)
+        self._listen(event_type)
+
+    def unsubscribe(
+        self,
+        event_type: t.Type[MessageEventT],
+        channel_id: int,
+        handler: Handler[MessageEventT],
+    ):
+        handlers = self._routes[event_type].get(int(channel_id), [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if not handlers:
+            self._routes[event_type].pop(int(channel_id), None)
+
+    def subscribe_crossposts(
+        self, src_channel_id: int, handler: Handler[h.MessageCreateEvent]
+    ):
+        self._crosspost_routes[int(src_channel_id)].append(handler)
+        self._listen(h.MessageCreateEvent)
+
+    def subscribe_all_channels(
+        self,
+        event_type: t.Type[MessageEventT],
+        handler: Handler[MessageEventT],
+        channel_filter: t.Optional[ChannelFilter] = None,
+    ):
+        self._all_channels[event_type].append((handler, channel_filter))
+        self._listen(event_type)
+
+    def _listen(self, event_type: t.Type[h.MessageEvent]):
+        if event_type in self._listening:
+            return
+
+        async def dispatch(event: h.MessageEvent):
+            await self.dispatch(event_type, event)
+
+        self._bot.subscribe(event_type, dispatch)
+        self._listening.add(event_type)
+
+    def handlers_for(
+        self, event_type: t.Type[h.MessageEvent], event: h.MessageEvent
+    ) -> t.List[Handler]:
+        handlers = self._routes[event_type].get(event.channel_id, [])
+        if self._crosspost_routes and event_type is h.MessageCreateEvent:
+            reference = event.message.message_reference
+            if reference is not None and reference.channel_id in self._crosspost_routes:
+                handlers = handlers + self._crosspost_routes[reference.channel_id]
+        if self._all_channels[event_type]:
+            handlers = handlers + [
+                handler
+                for handler, channel_filter in self._all_channels[event_type]
+                if channel_filter is None or channel_filter(event.channel_id)
+            ]
+        return handlers
+
+    async def dispatch(self, event_type: t.Type[h.MessageEvent], event: h.MessageEvent):
+        handlers = self.handlers_for(event_type, event)
+        if not handlers:
+            self.dropped += 1
+            return
+
+        self.routed += 1
+        if len(handlers) == 1:
+            # Already running in the listener's task, no need for another
+            return await handlers[0](event)
+
+        # Run concurrently so that a slow handler does not hold up the others
+        results = await asyncio.gather(
+            *(handler(event) for handler in handlers), return_exceptions=True
+        )
+        for handler, result in zip(handlers, results):
+            if isinstance(result, Exception):
+                logging.error(
+                    f"Exception in message handler {handler.__qualname__}",
+                    exc_info=result,
+                )
@@ -17,26 +17,248 @@ from __future__ import annotations
 
 import asyncio
 import datetime as dt
+import functools
 import logging
 from collections import defaultdict
-from typing import List, Optional, Set, Tuple
+from contextlib import AsyncExitStack
+from itertools import islice
+from time import perf_counter
+from typing import (
+    Any,
+    Callable,
+    ClassVar,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import regex as re
 from pytz import utc
+from sqlalchemy import event, inspect
+from sqlalchemy import exc as sql_exc
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker, validates
-from sqlalchemy.sql.expression import and_, delete, desc, insert, select, update
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql.expression import column as sql_column
+from sqlalchemy.sql.expression import table as sql_table
+from sqlalchemy.sql.expression import (
+    and_,
+    any_,
+    bindparam,
+    case,
+    delete,
+    desc,
+    insert,
+    literal,
+    select,
+    text,
+    tuple_,
+    update,
+)
 from sqlalchemy.sql.functions import coalesce, func
 from sqlalchemy.sql.schema import CheckConstraint, Column, UniqueConstraint
 from sqlalchemy.sql.sqltypes import BigInteger, Boolean, DateTime, Integer, String, Text
 
-from . import cfg, utils
+from . import archive, cache, cfg, instrumentation, utils
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """Bounded connection pool that keeps checkout statistics
+
+    Checkouts beyond pool_size + max_overflow wait in a first come first served
+    queue for up to pool_timeout seconds before raising a TimeoutError"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiters = 0
+        self.checkout_timeouts = 0
+        self.checkout_latency = utils.LatencyHistogram()
+
+    def _is_full(self) -> bool:
+        # A max_overflow of -1 means unbounded, checkouts never wait
+        return self._max_overflow != -1 and (
+            self.checkedout() >= self.size() + self._max_overflow
+        )
+
+    def connect(self):
+        start_time = perf_counter()
+        # Only checkouts made while every connection is in use wait for one
+        waiting = self._is_full()
+        self.waiters += waiting
+        try:
+            return super().connect()
+        except sql_exc.TimeoutError:
+            self.checkout_timeouts += 1
+            raise
+        finally:
+            self.waiters -= waiting
+            self.checkout_latency.record(perf_counter() - start_time)
+
 
 Base = declarative_base()
 db_engine = create_async_engine(
-    cfg.db_url_async, connect_args=cfg.db_connect_args, **cfg.db_engine_args
+    cfg.db_url_async,
+    connect_args=cfg.db_connect_args,
+    poolclass=InstrumentedQueuePool,
+    **cfg.db_engine_args,
 )
 db_session = sessionmaker(db_engine, **cfg.db_session_kwargs)
+# Read only queries go to the replica when one is configured
+if cfg.db_replica_url_async:
+    db_replica_engine = create_async_engine(
+        cfg.db_replica_url_async,
+        connect_args=cfg.db_connect_args,
+        poolclass=InstrumentedQueuePool,
+        **cfg.db_engine_args,
+    )
+    db_replica_session = sessionmaker(db_replica_engine, **cfg.db_session_kwargs)
+else:
+    db_replica_engine = None
+    db_replica_session = None
+
+# Statement latencies by schema method and slow query reports
+query_instrumentation = instrumentation.QueryInstrumentation(cfg.db_slow_query_seconds)
+query_instrumentation.attach(db_engine)
+if db_replica_engine is not None:
+    query_instrumentation.attach(db_replica_engine)
+
+# Cold storage for message pairs pruned from MirroredMessage
+message_archive = (
+    archive.MessageArchive(cfg.message_archive_dir)
+    if cfg.message_archive_dir
+    else None
+)
+
+
+def pool_statistics(engine=db_engine) -> dict:
+    """Return a snapshot of connection usage for the engine's pool"""
+    pool: InstrumentedQueuePool = engine.sync_engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "waiters": pool.waiters,
+        "timeouts": pool.checkout_timeouts,
+        "checkout_latency": pool.checkout_latency,
+    }
+
+
+async def prewarm_pool(connections: int = cfg.db_pool_prewarm):
+    """Open up to <connections> pooled connections ahead of a known peak
+
+    The connections are pinged and returned to the pool so that the peak does not
+    have to wait on new connections being set up"""
+    async with AsyncExitStack() as stack:
+        await asyncio.gather(
+            *[
+                stack.enter_async_context(db_engine.connect())
+                for _ in range(connections)
+            ]
+        )
+
+
+def upsert(model, values: List[dict], update: Callable[[Any], dict]):
+    """Build a dialect native multi row upsert for <model>
+
+    ie INSERT ... ON DUPLICATE KEY UPDATE for MySQL and
+    INSERT ... ON CONFLICT (<primary key>) DO UPDATE for Postgres and SQLite
+
+    update is called with the proposed row (the inserted / excluded pseudo
+    table) and must return a mapping of columns to the values to set on
+    existing rows"""
+    dialect = db_engine.dialect.name
+    if dialect == "mysql":
+        stmt = mysql_insert(model).values(values)
+        return stmt.on_duplicate_key_update(**update(stmt.inserted))
+    elif dialect in ("postgresql", "sqlite"):
+        insert_ = postgresql_insert if dialect == "postgresql" else sqlite_insert
+        stmt = insert_(model).values(values)
+        return stmt.on_conflict_do_update(
+            index_elements=[column.name for column in model.__table__.primary_key],
+            set_=update(stmt.excluded),
+        )
+    else:
+        raise NotImplementedError(f"Upserts are not supported for {dialect}")
+
+
+async def copy_upsert(
+    session: AsyncSession, model, values: List[dict], update: Callable[[Any], dict]
+):
+    """Postgres only version of `upsert` that loads the rows with COPY
+
+    The rows are streamed into a temporary staging table with COPY instead of
+    being bound as parameters, then upserted from it with a single
+    INSERT ... SELECT ... ON CONFLICT DO UPDATE. values must be keyed by
+    column name"""
+    target = model.__table__
+    staging_name = f"_staging_{target.name}"
+    columns = list(values[0].keys())
+
+    await session.execute(
+        text(
+            f"CREATE TEMPORARY TABLE IF NOT EXISTS {staging_name} "
+            + f"(LIKE {target.name} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+        )
+    )
+    # Rows staged earlier in the same transaction are still there
+    await session.execute(text(f"TRUNCATE {staging_name}"))
+
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        staging_name,
+        records=[tuple(row[name] for name in columns) for row in values],
+        columns=columns,
+    )
+
+    staging = sql_table(staging_name, *[sql_column(name) for name in columns])
+    stmt = postgresql_insert(target).from_select(columns, select(staging))
+    await session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[column.name for column in target.primary_key],
+            set_=update(stmt.excluded),
+        )
+    )
+
+
+def use_postgres_bulk() -> bool:
+    """Whether to use the Postgres only bulk statements (array parameters and
+    COPY), these are opt in with DB_POSTGRES_BULK"""
+    return db_engine.dialect.name == "postgresql" and cfg.db_postgres_bulk
+
+
+def bigint_array(values: Iterable[int]):
+    """Bind values as a single Postgres BIGINT[] parameter, eg for UNNEST or ANY"""
+    return bindparam(None, [int(value) for value in values], type_=ARRAY(BigInteger))
+
+
+def in_bigints(column, values: List[int]):
+    """Return column IN (values)
+
+    With use_postgres_bulk this is column = ANY(<array>), a single parameter
+    for any number of values"""
+    if use_postgres_bulk():
+        return column == any_(bigint_array(values))
+    return column.in_(values)
+
+
+# Rows per tuple IN (...) predicate, keeps statements well within bind limits
+PAIR_BATCH_SIZE = 500
+
+
+def batched(iterable: Iterable, batch_size: int) -> Iterable[list]:
+    """Yield lists of up to <batch_size> items from iterable"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
 
 
 rgx_cmd_name_is_valid = re.compile("^[a-z][a-z0-9_-]{1,31}$")
@@ -66,7 +288,15 @@ class MirroredChannel(Base):
     legacy_disable_for_failure_on_date = Column(
         "legacy_disable_for_failure_on_date", DateTime, default=None
     )
-    _legacy_srcs_cache = set()
+    # When the mirror was disabled, for compacting long disabled mirrors
+    disabled_on = Column("disabled_on", DateTime, default=None)
+    # Srcs with legacy mirrors, replaced rather than mutated on every change so
+    # that message events can be filtered on it synchronously
+    _legacy_srcs_cache: ClassVar[FrozenSet[int]] = frozenset()
+    # Until the srcs are loaded in full, _legacy_srcs_cache is empty
+    _legacy_srcs_loaded: ClassVar[bool] = False
+    # config_version versions of srcs as of the last reload_changed_srcs
+    _src_versions: Dict[int, int] = {}
 
     def __init__(
         self,
@@ -82,6 +312,7 @@ class MirroredChannel(Base):
         self.dest_server_id = dest_server_id and int(dest_server_id)
         self.legacy = bool(legacy)
         self.enabled = bool(enabled)
+        self.disabled_on = None if self.enabled else dt.datetime.now(tz=utc)
 
     @classmethod
     @utils.ensure_session(db_session)
@@ -99,12 +330,99 @@ class MirroredChannel(Base):
         await session.merge(
             cls(src_id, dest_id, dest_server_id, legacy, enabled=enabled)
         )
+        await ConfigVersion.bump_mirrors([src_id], session=session)
 
-        if legacy and src_id not in cls._legacy_srcs_cache:
-            cls._legacy_srcs_cache.add(src_id)
+        if legacy:
+            cls._update_legacy_srcs(add=[src_id])
 
     @classmethod
     @utils.ensure_session(db_session)
+    async def add_mirrors_in_batch(
+        cls,
+        mirrors: Iterable[dict],
+        batch_size: int = 5000,
+        session: Optional[AsyncSession] = None,
+    ) -> int:
+        """Add or update mirrors in bulk
+
+        mirrors is an iterable (eg a generator) of dicts with the src_id, dest_id,
+        dest_server_id, legacy and (optionally) enabled values of each mirror and
+        is consumed <batch_size> rows at a time, each batch being written with a
+        single multi row upsert statement. Caches and config versions are updated
+        once at the end
+
+        Returns the number of rows written"""
+        rows_written = 0
+        src_ids = set()
+        legacy_src_ids = set()
+
+        def update_existing(proposed) -> dict:
+            return {
+                "dest_server_id": proposed.dest_server_id,
+                "legacy": proposed.legacy,
+                "enabled": proposed.enabled,
+                "disabled_on": proposed.disabled_on,
+            }
+
+        for batch in batched(mirrors, batch_size):
+            batch = [
+                {
+                    "src_id": int(mirror["src_id"]),
+                    "dest_id": int(mirror["dest_id"]),
+                    "dest_server_id": mirror["dest_server_id"]
+                    and int(mirror["dest_server_id"]),
+                    "legacy": bool(mirror["legacy"]),
+                    "enabled": bool(mirror.get("enabled", True)),
+                    "disabled_on": None
+                    if mirror.get("enabled", True)
+                    else dt.datetime.now(tz=utc),
+                }
+                for mirror in batch
+            ]
+            if use_postgres_bulk():
+                await copy_upsert(session, cls, batch, update_existing)
+            else:
+                await session.execute(upsert(cls, batch, update_existing))
+            rows_written += len(batch)
+            src_ids.update(mirror["src_id"] for mirror in batch)
+            legacy_src_ids.update(
+                mirror["src_id"] for mirror in batch if mirror["legacy"]
+            )
+
+        await ConfigVersion.bump_mirrors(src_ids, session=session)
+        cls._update_legacy_srcs(add=legacy_src_ids)
+
+        return rows_written
+
+    @classmethod
+    @utils.ensure_session(db_session, db_replica_session)
+    async def fetch_mirrors_page(
+        cls,
+        after: Optional[Tuple[int, int]] = None,
+        limit: int = 5000,
+        session: Optional[AsyncSession] = None,
+    ) -> List[Tuple[int, int, int, bool, bool]]:
+        """Return up to <limit> mirrors ordered by (src_id, dest_id) after <after>
+
+        Mirrors are returned as (src_id, dest_id, dest_server_id, legacy, enabled)
+        Pass the (src_id, dest_id) of the last mirror of a page to get the next
+        page, for going through all mirrors without loading them all at once
+        """
+        query = select(
+            cls.src_id, cls.dest_id, cls.dest_server_id, cls.legacy, cls.enabled
+        )
+        if after is not None:
+            query = query.where(
+                tuple_(cls.src_id, cls.dest_id) > tuple_(int(after[0]), int(after[1]))
+            )
+        return (
+            await session.execute(
+                query.order_by(cls.src_id, cls.dest_id).limit(limit)
+            )
+        ).fetchall()
+
+    @classmethod
+    @utils.ensure_session(db_session, db_replica_session)
     async def fetch_dests(
         cls,
         src_id: int,
@@ -183,14 +501,74 @@ class MirroredChannel(Base):
 
         If you need to ensure that the returned src_ids are valid, use
         fetch_all_srcs instead"""
-        if legacy and cls._legacy_srcs_cache:
+        if legacy and cls._legacy_srcs_loaded:
             return cls._legacy_srcs_cache
         else:
             srcs = await cls.fetch_all_srcs(legacy=legacy, session=session)
             if legacy:
-                cls._legacy_srcs_cache = set(srcs)
+                cls._set_legacy_srcs(srcs)
             return srcs
 
+    @classmethod
+    def is_legacy_src(cls, channel_id: int) -> bool:
+        """Check whether channel_id is a legacy src without any I/O
+
+        Always False until the srcs are loaded, see load_legacy_srcs"""
+        return channel_id in cls._legacy_srcs_cache
+
+    @classmethod
+    def legacy_srcs_loaded(cls) -> bool:
+        return cls._legacy_srcs_loaded
+
+    @classmethod
+    async def load_legacy_srcs(cls) -> FrozenSet[int]:
+        """Load all legacy srcs from the db, replacing the cached srcs"""
+        cls._set_legacy_srcs(await cls.fetch_all_srcs(legacy=True))
+        return cls._legacy_srcs_cache
+
+    @classmethod
+    def invalidate_legacy_srcs(cls):
+        cls._legacy_srcs_cache = frozenset()
+        cls._legacy_srcs_loaded = False
+
+    @classmethod
+    def _set_legacy_srcs(cls, srcs: Iterable[int]):
+        cls._legacy_srcs_cache = frozenset(srcs)
+        cls._legacy_srcs_loaded = True
+
+    @classmethod
+    def _update_legacy_srcs(cls, add: Iterable[int] = (), remove: Iterable[int] = ()):
+        # Srcs that are not loaded yet are loaded in full when first used, so
+        # are left as is
+        if cls._legacy_srcs_loaded:
+            cls._legacy_srcs_cache = cls._legacy_srcs_cache.difference(remove).union(
+                add
+            )
+
+    @classmethod
+    def dump_src_caches(cls) -> Dict[str, Any]:
+        """Return the cached legacy srcs and src versions for a warm start
+
+        legacy_srcs is None if the srcs were never loaded, since an empty set
+        would be restored as no srcs at all"""
+        return {
+            "legacy_srcs": (
+                list(cls._legacy_srcs_cache) if cls._legacy_srcs_loaded else None
+            ),
+            "src_versions": dict(cls._src_versions),
+        }
+
+    @classmethod
+    def load_src_caches(cls, data: Dict[str, Any]):
+        """Restore caches from dump_src_caches if they have not been loaded yet
+
+        The restored caches may be stale, reload_changed_srcs and
+        load_legacy_srcs bring them up to date once the db is reachable"""
+        if not cls._legacy_srcs_loaded and data["legacy_srcs"] is not None:
+            cls._set_legacy_srcs(data["legacy_srcs"])
+        if not cls._src_versions:
+            cls._src_versions = dict(data["src_versions"])
+
     @classmethod
     @utils.ensure_session(db_session)
     async def fetch_all_srcs(
@@ -206,7 +584,7 @@ class MirroredChannel(Base):
         return set(srcs)
 
     @classmethod
-    @utils.ensure_session(db_session)
+    @utils.ensure_session(db_session, db_replica_session)
     async def count_dests(
         cls,
         src_id: int,
@@ -232,7 +610,26 @@ class MirroredChannel(Base):
         return dests_count
 
     @classmethod
-    @utils.ensure_session(db_session)
+    @utils.ensure_session(db_session, db_replica_session)
+    async def count_dests_by_src(
+        cls,
+        src_ids: Iterable[int],
+        session: Optional[AsyncSession] = None,
+    ) -> Dict[Tuple[int, bool], int]:
+        """Count the dests of all src_ids in one query
+
+        Returns (src_id, legacy) -> number of dests. Pairs without dests are
+        left out"""
+        src_ids = [int(src_id) for src_id in src_ids]
+        counts = await session.execute(
+            select(cls.src_id, cls.legacy, func.count())
+            .where(cls.src_id.in_(src_ids))
+            .group_by(cls.src_id, cls.legacy)
+        )
+        return {(src_id, bool(legacy)): count for src_id, legacy, count in counts}
+
+    @classmethod
+    @utils.ensure_session(db_session, db_replica_session)
     async def count_total_dests(
         cls,
         legacy_only: bool | None = True,
@@ -266,12 +663,18 @@ class MirroredChannel(Base):
             .where(and_(cls.src_id == src_id, cls.dest_id == dest_id))
             .values(legacy=legacy)
         )
+        await ConfigVersion.bump_mirrors([src_id], session=session)
         if legacy:
-            if src_id not in cls._legacy_srcs_cache:
-                cls._legacy_srcs_cache.add(src_id)
-        else:
-            if src_id in cls._legacy_srcs_cache:
-                cls._legacy_srcs_cache.remove(src_id)
+            cls._update_legacy_srcs(add=[src_id])
+        elif not (
+            # The src stays a legacy src while it has other legacy mirrors
+            await session.execute(
+                select(cls.src_id)
+                .where(and_(cls.src_id == src_id, cls.legacy == True))
+                .limit(1)
+            )
+        ).first():
+            cls._update_legacy_srcs(remove=[src_id])
 
     @classmethod
     @utils.ensure_session(db_session)
@@ -285,8 +688,9 @@ class MirroredChannel(Base):
             .where(
                 and_(cls.src_id == src_id, cls.dest_id == dest_id, cls.enabled == True)
             )
-            .values(enabled=False)
+            .values(enabled=False, disabled_on=dt.datetime.now(tz=utc))
         )
+        await ConfigVersion.bump_mirrors([src_id], session=session)
 
         # Note: We deliberately don't remove the src_id from the _all_srcs_cache
         # since we don't know if there are other mirrors with the same src_id
@@ -301,12 +705,13 @@ class MirroredChannel(Base):
         cls, dest_id: int, session: Optional[AsyncSession] = None
     ) -> None:
         dest_id = int(dest_id)
-        src_ids = await cls.fetch_srcs(dest_id)
+        src_ids = await cls.fetch_srcs(dest_id, session=session)
         await session.execute(
             update(cls)
             .where(and_(cls.dest_id == dest_id, cls.enabled == True))
-            .values(enabled=False)
+            .values(enabled=False, disabled_on=dt.datetime.now(tz=utc))
         )
+        await ConfigVersion.bump_mirrors(src_ids, session=session)
 
         # Note: We deliberately don't remove the src_ids from the _all_srcs_cache
         # since we don't know if there are other mirrors with the same src_id
@@ -355,7 +760,7 @@ class MirroredChannel(Base):
             .where(
                 and_(
                     cls.src_id == src_id,
-                    cls.dest_id.in_(dest_ids),
+                    in_bigints(cls.dest_id, dest_ids),
                     cls.enabled == True,
                     cls.legacy == True,
                 )
@@ -403,7 +808,7 @@ class MirroredChannel(Base):
             .where(
                 and_(
                     cls.src_id == src_id,
-                    cls.dest_id.in_(dest_ids),
+                    in_bigints(cls.dest_id, dest_ids),
                     cls.enabled == True,
                     cls.legacy == True,
                 )
@@ -411,58 +816,130 @@ class MirroredChannel(Base):
             .values(legacy_error_rate=cls.legacy_error_rate + 1)
         )
 
+    @classmethod
+    @utils.ensure_session(db_session)
+    async def log_legacy_mirror_results(
+        cls,
+        pairs: Iterable[Tuple[int, int]],
+        failures: int,
+        reset: bool = False,
+        session: Optional[AsyncSession] = None,
+    ):
+        """Log the outcome of several uses of (src_id, dest_id) mirror pairs
+
+        Equivalent to logging a success for each pair if `reset` is set and then
+        logging `failures` failures, ie the error rate is set to `failures`
+        if `reset` is set and otherwise increased by `failures`
+        """
+        error_rate = failures if reset else cls.legacy_error_rate + failures
+        for pairs_match in cls._match_pairs(pairs):
+            await session.execute(
+                update(cls)
+                .where(
+                    and_(
+                        pairs_match,
+                        cls.enabled == True,
+                        cls.legacy == True,
+                    )
+                )
+                .values(legacy_error_rate=error_rate)
+            )
+
+    @classmethod
+    def _match_pairs(cls, pairs: Iterable[Tuple[int, int]]):
+        """Yield predicates that together match exactly the given (src_id, dest_id) pairs
+
+        With use_postgres_bulk a single predicate joins against the pairs passed
+        as two UNNESTed array parameters, so any number of pairs takes one
+        statement. Otherwise the pairs are matched by tuple IN (...) predicates
+        in batches
+        """
+        if use_postgres_bulk():
+            pairs = list(pairs)
+            if not pairs:
+                return
+            src_ids, dest_ids = zip(*pairs)
+            unnested = select(
+                func.unnest(bigint_array(src_ids)).label("src_id"),
+                func.unnest(bigint_array(dest_ids)).label("dest_id"),
+            ).subquery("pairs")
+            yield and_(
+                cls.src_id == unnested.c.src_id, cls.dest_id == unnested.c.dest_id
+            )
+            return
+
+        for batch in batched(pairs, PAIR_BATCH_SIZE):
+            yield tuple_(cls.src_id, cls.dest_id).in_(
+                [(int(src_id), int(dest_id)) for src_id, dest_id in batch]
+            )
+
     @classmethod
     @utils.ensure_session(db_session)
     async def get_legacy_failing_mirrors(
         cls,
         threshold: int = 7,
+        pairs: Optional[Iterable[Tuple[int, int]]] = None,
         session: Optional[AsyncSession] = None,
     ) -> List[Tuple[int, int]]:
         """Return mirrors that have failed too many times
 
         Mirrors that have failed more than `threshold` times are disabled
+        Only the given (src_id, dest_id) pairs are checked if `pairs` is passed
         """
-        disabled_mirrors = await session.execute(
-            select(cls.src_id, cls.dest_id).where(
-                and_(
-                    cls.enabled == True,
-                    cls.legacy == True,
-                    cls.legacy_error_rate >= threshold,
-                )
-            )
+        failing = and_(
+            cls.enabled == True,
+            cls.legacy == True,
+            cls.legacy_error_rate >= threshold,
         )
-        disabled_mirrors = disabled_mirrors if disabled_mirrors else []
-        disabled_mirrors = disabled_mirrors.fetchall()
-
-        return disabled_mirrors
+        if pairs is None:
+            return (
+                await session.execute(select(cls.src_id, cls.dest_id).where(failing))
+            ).fetchall()
+
+        failing_mirrors = []
+        for pairs_match in cls._match_pairs(pairs):
+            failing_mirrors.extend(
+                (
+                    await session.execute(
+                        select(cls.src_id, cls.dest_id).where(
+                            and_(failing, pairs_match)
+                        )
+                    )
+                ).fetchall()
+            )
+        return failing_mirrors
 
     @classmethod
     @utils.ensure_session(db_session)
     async def disable_legacy_failing_mirrors(
         cls,
         threshold: int = 7,
+        pairs: Optional[Iterable[Tuple[int, int]]] = None,
         session: Optional[AsyncSession] = None,
     ) -> List[Tuple[int, int]]:
         """Disable mirrors that have failed too many times
 
         Mirrors that have failed more than `threshold` times are disabled
+        Only the given (src_id, dest_id) pairs are checked if `pairs` is passed
         Returns the disabled mirrors
         """
         mirrors_to_disable = await cls.get_legacy_failing_mirrors(
-            threshold=threshold, session=session
+            threshold=threshold, pairs=pairs, session=session
         )
-        await session.execute(
-            update(cls)
-            .where(
-                and_(
-                    cls.src_id.in_([mirror[0] for mirror in mirrors_to_disable]),
-                    cls.dest_id.in_([mirror[1] for mirror in mirrors_to_disable]),
+        for pairs_match in cls._match_pairs(mirrors_to_disable):
+            await session.execute(
+                update(cls)
+                .where(pairs_match)
+                .values(
+                    enabled=False,
+                    legacy_disable_for_failure_on_date=dt.datetime.now(
+                        tz=dt.timezone.utc
+                    ),
+                    disabled_on=dt.datetime.now(tz=utc),
                 )
             )
-            .values(
-                enabled=False,
-                legacy_disable_for_failure_on_date=dt.datetime.now(tz=dt.timezone.utc),
-            )
+        await ConfigVersion.bump_mirrors(
+            [src_id for src_id, _ in mirrors_to_disable], session=session
         )
 
         # Note: We deliberately don't remove the src_id from the _all_srcs_cache
@@ -513,25 +990,202 @@ class MirroredChannel(Base):
         mirrors_to_enable = await cls.get_legacy_mirrors_disabled_for_failure(
             since=since, session=session
         )
-        await session.execute(
-            update(cls)
-            .where(
-                and_(
-                    cls.src_id.in_([mirror[0] for mirror in mirrors_to_enable]),
-                    cls.dest_id.in_([mirror[1] for mirror in mirrors_to_enable]),
+        for pairs_match in cls._match_pairs(mirrors_to_enable):
+            await session.execute(
+                update(cls)
+                .where(pairs_match)
+                .values(
+                    enabled=True,
+                    legacy_error_rate=0,
+                    disabled_on=None,
                 )
             )
-            .values(
-                enabled=True,
-                legacy_error_rate=0,
+
+        # Mirrors that have since been compacted are restored from the history
+        restored_mirrors = await MirroredChannelHistory.pop_disabled_for_failure(
+            since=since, session=session
+        )
+        if restored_mirrors:
+            await session.execute(
+                upsert(
+                    cls,
+                    [
+                        {
+                            **mirror._asdict(),
+                            "enabled": True,
+                            "legacy_error_rate": 0,
+                            "disabled_on": None,
+                        }
+                        for mirror in restored_mirrors
+                    ],
+                    lambda proposed: {
+                        "enabled": proposed.enabled,
+                        "legacy_error_rate": proposed.legacy_error_rate,
+                        "disabled_on": proposed.disabled_on,
+                    },
+                )
             )
+            mirrors_to_enable = list(mirrors_to_enable) + [
+                (mirror.src_id, mirror.dest_id) for mirror in restored_mirrors
+            ]
+
+        await ConfigVersion.bump_mirrors(
+            [src_id for src_id, _ in mirrors_to_enable], session=session
         )
 
         # Add reenabled mirrors to the cache
-        cls._legacy_srcs_cache.update(set([src_id for src_id, _ in mirrors_to_enable]))
+        cls._update_legacy_srcs(add=[src_id for src_id, _ in mirrors_to_enable])
 
         return mirrors_to_enable
 
+    @classmethod
+    @utils.ensure_session(db_session)
+    async def reload_changed_srcs(
+        cls, session: Optional[AsyncSession] = None
+    ) -> List[int]:
+        """Reload cached routing for srcs changed since the last reload
+
+        Changes are detected through the config_version table, so this picks up
+        mirror changes made by other processes or directly in the db
+        Returns the src_ids that were reloaded
+        """
+        versions = await ConfigVersion.fetch_mirror_versions(session=session)
+        changed = [
+            src_id
+            for src_id, version in versions.items()
+            if cls._src_versions.get(src_id) != version
+        ]
+        if not changed:
+            return []
+
+        legacy_srcs = set()
+        for batch in batched(changed, PAIR_BATCH_SIZE):
+            legacy_srcs.update(
+                (
+                    await session.execute(
+                        select(cls.src_id)
+                        .distinct()
+                        .where(and_(cls.src_id.in_(batch), cls.legacy == True))
+                    )
+                ).scalars()
+            )
+
+        cls._update_legacy_srcs(add=legacy_srcs, remove=set(changed) - legacy_srcs)
+
+        cls._src_versions.update(versions)
+        return changed
+
+    @classmethod
+    async def compact_disabled(
+        cls, age: dt.timedelta = dt.timedelta(days=30), batch_size: int = 1000
+    ) -> int:
+        """Move mirrors disabled for longer than <age> to mirrored_channel_history
+
+        Mirrors are moved <batch_size> at a time, each batch in its own
+        transaction to keep locks short. Returns the number of mirrors moved"""
+        await cls._stamp_disabled_on()
+        cutoff = dt.datetime.now(tz=utc) - age
+        moved = 0
+        while moved_in_batch := await cls._compact_disabled_batch(cutoff, batch_size):
+            moved += moved_in_batch
+        return moved
+
+    @classmethod
+    @utils.ensure_session(db_session)
+    async def _stamp_disabled_on(cls, session: Optional[AsyncSession] = None):
+        """Set disabled_on for mirrors disabled before it was tracked
+
+        This starts their compaction clock now"""
+        await session.execute(
+            update(cls)
+            .where(and_(cls.enabled == False, cls.disabled_on == None))
+            .values(disabled_on=dt.datetime.now(tz=utc))
+        )
+
+    @classmethod
+    @utils.ensure_session(db_session)
+    async def _compact_disabled_batch(
+        cls,
+        cutoff: dt.datetime,
+        batch_size: int,
+        session: Optional[AsyncSession] = None,
+    ) -> int:
+        columns = [
+            getattr(cls, column.key) for column in MirroredChannelHistory.__mapper__.columns
+        ]
+        mirrors = (
+            await session.execute(
+                select(*columns)
+                .where(and_(cls.enabled == False, cutoff > cls.disabled_on))
+                .order_by(cls.src_id, cls.dest_id)
+                .limit(batch_size)
+            )
+        ).fetchall()
+        if not mirrors:
+            return 0
+
+        await session.execute(
+            upsert(
+                MirroredChannelHistory,
+                [mirror._asdict() for mirror in mirrors],
+                lambda proposed: {
+                    column.name: getattr(proposed, column.name)
+                    for column in MirroredChannelHistory.__table__.columns
+                    if not column.primary_key
+                },
+            )
+        )
+        pairs = [(mirror.src_id, mirror.dest_id) for mirror in mirrors]
+        for pairs_match in cls._match_pairs(pairs):
+            await session.execute(
+                delete(cls).where(and_(pairs_match, cls.enabled == False))
+            )
+        # Deleting the last legacy row of a src changes the legacy srcs
+        await ConfigVersion.bump_mirrors(
+            set(src_id for src_id, _ in pairs), session=session
+        )
+
+        return len(mirrors)
+
+
+class MirroredChannelHistory(Base):
+    """Mirrors compacted out of mirrored_channel after being disabled for a while
+
+    Has the same columns as MirroredChannel so rows can be moved back"""
+
+    __tablename__ = "mirrored_channel_history"
+    __mapper_args__ = {"eager_defaults": True}
+    src_id = Column("src_id", BigInteger, primary_key=True)
+    dest_id = Column("dest_id", BigInteger, primary_key=True)
+    dest_server_id = Column("dest_server_id", BigInteger)
+    legacy = Column("legacy", Boolean)
+    enabled = Column("enabled", Boolean)
+    legacy_error_rate = Column("legacy_error_rate", Integer)
+    legacy_disable_for_failure_on_date = Column(
+        "legacy_disable_for_failure_on_date", DateTime
+    )
+    disabled_on = Column("disabled_on", DateTime)
+
+    @classmethod
+    @utils.ensure_session(db_session)
+    async def pop_disabled_for_failure(
+        cls, since: Optional[dt.datetime], session: Optional[AsyncSession] = None
+    ) -> list:
+        """Remove and return legacy mirrors disabled for failure since <since>"""
+        disabled_for_failure = and_(
+            cls.legacy == True,
+            cls.legacy_disable_for_failure_on_date >= since,
+        )
+        mirrors = (
+            await session.execute(
+                select(
+                    *[getattr(cls, column.key) for column in cls.__mapper__.columns]
+                ).where(disabled_for_failure)
+            )
+        ).fetchall()
+        await session.execute(delete(cls).where(disabled_for_failure))
+        return mirrors
+
 
 class MirroredMessage(Base):
     __tablename__ = "mirrored_message"
@@ -600,6 +1254,28 @@ class MirroredMessage(Base):
         source_msg = int(source_msg)
         source_channel = int(source_channel)
 
+        if use_postgres_bulk():
+            # One statement with two array parameters however large the batch
+            await session.execute(
+                insert(cls).from_select(
+                    [
+                        cls.dest_msg,
+                        cls.dest_channel,
+                        cls.source_msg,
+                        cls.source_channel,
+                        cls.creation_datetime,
+                    ],
+                    select(
+                        func.unnest(bigint_array(dest_msgs)),
+                        func.unnest(bigint_array(dest_channels)),
+                        literal(source_msg, BigInteger),
+                        literal(source_channel, BigInteger),
+                        literal(dt.datetime.utcnow(), DateTime),
+                    ),
+                )
+            )
+            return
+
         await session.execute(
             insert(cls).values(
                 [
@@ -616,12 +1292,48 @@ class MirroredMessage(Base):
 
     @classmethod
     @utils.ensure_session(db_session)
+    async def upsert_msgs(
+        cls,
+        msgs: Iterable[dict],
+        batch_size: int = 5000,
+        session: Optional[AsyncSession] = None,
+    ) -> int:
+        """Add message pairs, skipping pairs that already exist
+
+        msgs is an iterable of dicts with the dest_msg, dest_channel, source_msg,
+        source_channel and creation_datetime of each pair. Unlike
+        add_msgs_in_batch this is safe to repeat, eg when replaying spooled writes
+
+        Returns the number of rows written"""
+        rows_written = 0
+        for batch in batched(msgs, batch_size):
+            batch = [
+                {
+                    "dest_msg": int(msg["dest_msg"]),
+                    "dest_channel": int(msg["dest_channel"]),
+                    "source_msg": int(msg["source_msg"]),
+                    "source_channel": int(msg["source_channel"]),
+                    "creation_datetime": msg["creation_datetime"],
+                }
+                for msg in batch
+            ]
+            await session.execute(
+                upsert(cls, batch, lambda proposed: {"source_msg": proposed.source_msg})
+            )
+            rows_written += len(batch)
+
+        return rows_written
+
+    @classmethod
+    @utils.ensure_session(db_session, db_replica_session)
     async def get_dest_msgs_and_channels(
         cls,
         source_msg: int,
         session: Optional[AsyncSession] = None,
     ):
-        """Return dest message and channel ids from source message id"""
+        """Return dest message and channel ids from source message id
+
+        Falls back to the message archive for messages that have been pruned"""
         source_msg = int(source_msg)
         dest_msgs = (
             await session.execute(
@@ -632,6 +1344,22 @@ class MirroredMessage(Base):
         ).fetchall()
         # Handle source_id not found
         dest_msgs = [] if dest_msgs is None else dest_msgs
+        if not dest_msgs and message_archive is not None:
+            dest_msgs = await message_archive.lookup(source_msg)
+        return dest_msgs
+
+    @classmethod
+    async def get_recent_dest_msgs_and_channels(cls, source_msg: int):
+        """get_dest_msgs_and_channels for a message that may have just been mirrored
+
+        The read replica may lag behind the fan out that wrote the pairs, so a
+        miss there is retried on the primary. Without a replica this is a
+        single lookup"""
+        dest_msgs = await cls.get_dest_msgs_and_channels(source_msg)
+        if not dest_msgs and db_replica_session is not None:
+            dest_msgs = await cls.get_dest_msgs_and_channels(
+                source_msg, use_primary=True
+            )
         return dest_msgs
 
     @classmethod
@@ -641,10 +1369,34 @@ class MirroredMessage(Base):
         age: None | dt.timedelta = dt.timedelta(days=21),
         session: Optional[AsyncSession] = None,
     ):
-        """Delete entries older than <age>"""
-        await session.execute(
-            delete(cls).where(dt.datetime.now(tz=utc) - age > cls.creation_datetime)
-        )
+        """Delete entries older than <age>, archiving them first if enabled"""
+        cutoff = dt.datetime.now(tz=utc) - age
+        if message_archive is None:
+            await session.execute(delete(cls).where(cutoff > cls.creation_datetime))
+            return
+
+        rows = (
+            await session.execute(
+                select(
+                    cls.source_msg,
+                    cls.source_channel,
+                    cls.dest_msg,
+                    cls.dest_channel,
+                ).where(cutoff > cls.creation_datetime)
+            )
+        ).fetchall()
+        # Archive before deleting so that a failed archive keeps the rows
+        await message_archive.append(rows)
+        # Only delete the rows archived, rows committed since the select (eg by
+        # a spool replay of old messages) are left for the next prune
+        for batch in batched((row.dest_msg for row in rows), PAIR_BATCH_SIZE):
+            await session.execute(delete(cls).where(in_bigints(cls.dest_msg, batch)))
+
+
+# Number of power of 10 population bins in ServerStatistics histograms, above
+# the bin for 0. Populations of servers not counted yet default to 10**12 which
+# falls in the last (open ended) bin
+POPULATION_LOG_BINS = 13
 
 
 class ServerStatistics(Base):
@@ -695,6 +1447,39 @@ class ServerStatistics(Base):
             ],
         )
 
+    @classmethod
+    @utils.ensure_session(db_session)
+    async def upsert_populations(
+        cls,
+        populations: Iterable[Tuple[int, int]],
+        batch_size: int = 5000,
+        session: Optional[AsyncSession] = None,
+    ) -> int:
+        """Add or update the populations of servers in bulk
+
+        populations is an iterable (eg a generator) of (server id, population)
+        tuples and is consumed <batch_size> rows at a time, each batch being
+        written with a single multi row upsert statement
+
+        Returns the number of rows written"""
+        populations = iter(populations)
+        rows_written = 0
+
+        def update_existing(proposed) -> dict:
+            return {"population": proposed.population}
+
+        while batch := [
+            {"id": int(id), "population": int(population)}
+            for id, population in islice(populations, batch_size)
+        ]:
+            if use_postgres_bulk():
+                await copy_upsert(session, cls, batch, update_existing)
+            else:
+                await session.execute(upsert(cls, batch, update_existing))
+            rows_written += len(batch)
+
+        return rows_written
+
     @classmethod
     @utils.ensure_session(db_session)
     async def fetch_server_ids(
@@ -707,7 +1492,7 @@ class ServerStatistics(Base):
         return ids
 
     @classmethod
-    @utils.ensure_session(db_session)
+    @utils.ensure_session(db_session, db_replica_session)
     async def fetch_server_populations(
         cls, session: Optional[AsyncSession] = None
     ) -> Tuple[int, int]:
@@ -716,6 +1501,59 @@ class ServerStatistics(Base):
         populations = populations if populations else []
         return populations
 
+    @classmethod
+    @utils.ensure_session(db_session, db_replica_session)
+    async def fetch_top_populations(
+        cls, limit: int = 7, session: Optional[AsyncSession] = None
+    ) -> List[Tuple[int, int]]:
+        """Returns (server id, population) of the most populous servers"""
+        return (
+            await session.execute(
+                select(cls.id, cls.population)
+                .order_by(cls.population.desc())
+                .limit(limit)
+            )
+        ).fetchall()
+
+    @classmethod
+    @utils.ensure_session(db_session, db_replica_session)
+    async def fetch_population_histogram(
+        cls, session: Optional[AsyncSession] = None
+    ) -> Tuple[int, List[Tuple[int, int]]]:
+        """Returns the total population and a logarithmic histogram of server
+        populations, binned in the db in one query
+
+        The histogram is a list of (lower bound, number of servers) for bins
+        [0, 1), [1, 10), [10, 100) ... with the last bin open ended"""
+        lower_bounds = [0] + [10**exponent for exponent in range(POPULATION_LOG_BINS)]
+        upper_bounds = lower_bounds[1:] + [None]
+        bins = [
+            func.coalesce(
+                func.sum(
+                    case(
+                        (
+                            and_(
+                                cls.population >= lower,
+                                (cls.population < upper) if upper else True,
+                            ),
+                            1,
+                        ),
+                        else_=0,
+                    )
+                ),
+                0,
+            )
+            for lower, upper in zip(lower_bounds, upper_bounds)
+        ]
+        total, *counts = (
+            await session.execute(
+                select(func.coalesce(func.sum(cls.population), 0), *bins)
+            )
+        ).one()
+        return int(total), [
+            (lower, int(count)) for lower, count in zip(lower_bounds, counts)
+        ]
+
     @classmethod
     @utils.ensure_session(db_session)
     async def update_population(
@@ -748,6 +1586,96 @@ class ServerStatistics(Base):
         )
 
 
+class UserCommandCatalog:
+    """In memory snapshot of the user_command table
+
+    Serves autocomplete from a prefix trie and name lookups from dicts so that
+    neither needs a db round trip"""
+
+    def __init__(self, commands: Iterable[UserCommand], version: int):
+        self.version = version
+        # (l1_name, l2_name, l3_name) -> command or command group
+        self._by_names: Dict[Tuple[str, str, str], UserCommand] = {}
+        self._trie = cache.PrefixTrie()
+        for command in sorted(
+            commands, key=lambda cmd: (cmd.l1_name, cmd.l2_name, cmd.l3_name)
+        ):
+            self._by_names[command.l1_name, command.l2_name, command.l3_name] = command
+            self._trie.insert(
+                command.l1_name + command.l2_name + command.l3_name, command
+            )
+
+    def __len__(self) -> int:
+        return len(self._by_names)
+
+    def fetch_command(self, *ln_names) -> Optional[UserCommand]:
+        utils.check_number_of_layers(ln_names)
+        ln_names = tuple(ln_names) + ("",) * (3 - len(ln_names))
+        command = self._by_names.get(ln_names)
+        return command if command and not command.is_command_group else None
+
+    def fetch_command_group(self, *ln_names) -> Optional[UserCommand]:
+        if len(ln_names) >= 3:
+            raise utils.FriendlyValueError(
+                "Discord does not support slash command groups more than "
+                + "2 layers deep"
+            )
+        elif len(ln_names) == 0:
+            raise ValueError("Too few ln_names provided, need at least 1")
+
+        ln_names = tuple(ln_names) + ("",) * (3 - len(ln_names))
+        command = self._by_names.get(ln_names)
+        return command if command and command.is_command_group else None
+
+    def autocomplete(self, l1_name="", l2_name="", l3_name="") -> List[UserCommand]:
+        return self._trie.find(l1_name + l2_name + l3_name)
+
+    def check_parent_command_groups_exist(
+        self, l1_name: str, l2_name: str = "", l3_name: str = ""
+    ):
+        if l2_name and not self.fetch_command_group(l1_name):
+            raise utils.FriendlyValueError(
+                f"{l1_name} is not an existing command group",
+            )
+        if l3_name and not self.fetch_command_group(l1_name, l2_name):
+            raise utils.FriendlyValueError(
+                f"{l1_name} -> {l2_name} is not an existing command group",
+            )
+        return True
+
+    def fetch_subcommands(self, l1_name, l2_name: str = "") -> List[Tuple[UserCommand]]:
+        # Rows as returned by the db query, ie 1-tuples of commands
+        return [
+            (command,)
+            for (ln1, ln2, _), command in self._by_names.items()
+            if ln1 == l1_name
+            and (ln2 == l2_name or not l2_name)
+            and not command.is_command_group
+        ]
+
+
+def _served_from_catalog(catalog_method: str):
+    """Serve calls that are not part of a transaction from the UserCommand catalog
+
+    Calls with an explicit or ambient session go to the db so that they see
+    uncommitted changes made in the same transaction.
+
+    Caution: Put between `@classmethod` and `@utils.ensure_session`"""
+
+    def decorator(f):
+        @functools.wraps(f)
+        async def wrapper(cls, *args, session: Optional[AsyncSession] = None, **kwargs):
+            if session is None and utils.get_ambient_session() is None:
+                kwargs.pop("use_primary", None)
+                catalog = await cls.fetch_catalog()
+                return getattr(catalog, catalog_method)(*args, **kwargs)
+            return await f(cls, *args, session=session, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 class UserCommand(Base):
     __tablename__ = "user_command"
     __mapper_args__ = {"eager_defaults": True}
@@ -778,6 +1706,13 @@ class UserCommand(Base):
     #    as a response
     response_data = Column(Text)
 
+    # Catalog of all commands as of config_version scope catalog_scope, None
+    # until loaded or after a change. _catalog_generation is bumped on each
+    # invalidation so that loads racing a change are discarded
+    catalog_scope = "user_command"
+    _catalog: ClassVar[Optional[UserCommandCatalog]] = None
+    _catalog_generation = 0
+
     def __init__(
         self,
         l1_name: str,
@@ -844,6 +1779,7 @@ class UserCommand(Base):
         return commands
 
     @classmethod
+    @_served_from_catalog("fetch_command")
     @utils.ensure_session(db_session)
     async def fetch_command(
         cls, *ln_names, session: Optional[AsyncSession] = None
@@ -868,6 +1804,7 @@ class UserCommand(Base):
         ).scalar()
 
     @classmethod
+    @_served_from_catalog("fetch_command_group")
     @utils.ensure_session(db_session)
     async def fetch_command_group(
         cls, *ln_names, session: Optional[AsyncSession] = None
@@ -897,7 +1834,8 @@ class UserCommand(Base):
         ).scalar()
 
     @classmethod
-    @utils.ensure_session(db_session)
+    @_served_from_catalog("autocomplete")
+    @utils.ensure_session(db_session, db_replica_session)
     async def _autocomplete(
         cls, l1_name="", l2_name="", l3_name="", session: Optional[AsyncSession] = None
     ) -> List[List[str]]:
@@ -941,6 +1879,7 @@ class UserCommand(Base):
             response_data=response_data,
         )
         session.add(self)
+        await cls._catalog_changed(session)
         return self
 
     @classmethod
@@ -957,6 +1896,7 @@ class UserCommand(Base):
         )
 
     @classmethod
+    @_served_from_catalog("check_parent_command_groups_exist")
     @utils.ensure_session(db_session)
     async def check_parent_command_groups_exist(
         cls,
@@ -1015,6 +1955,7 @@ class UserCommand(Base):
         return True
 
     @classmethod
+    @_served_from_catalog("fetch_subcommands")
     @utils.ensure_session(db_session)
     async def fetch_subcommands(
         cls, l1_name, l2_name: str = "", session: Optional[AsyncSession] = None
@@ -1071,6 +2012,7 @@ class UserCommand(Base):
                 )
             )
         )
+        await cls._catalog_changed(session)
         return commands_to_delete
 
     @classmethod
@@ -1120,10 +2062,73 @@ class UserCommand(Base):
                     )
                 )
             )
+            await cls._catalog_changed(session)
             deleted = [] if not deleted else deleted
             deleted = [item[0] for item in deleted]
             return deleted
 
+    @classmethod
+    @utils.ensure_session(db_session)
+    async def load_catalog(
+        cls, session: Optional[AsyncSession] = None
+    ) -> UserCommandCatalog:
+        """Load all commands into a new catalog and make it current
+
+        The catalog is only made current if no change was committed while it
+        was being loaded"""
+        generation = cls._catalog_generation
+        # Read the version in the same transaction so that it matches the rows
+        version = await ConfigVersion.fetch_version(cls.catalog_scope, session=session)
+        commands = (await session.execute(select(cls))).scalars().all()
+        catalog = UserCommandCatalog(commands, version)
+        if generation == cls._catalog_generation:
+            cls._catalog = catalog
+        return catalog
+
+    @classmethod
+    async def fetch_catalog(cls) -> UserCommandCatalog:
+        """Return the current catalog, loading it from the db if needed"""
+        return cls._catalog or await cls.load_catalog()
+
+    @classmethod
+    @utils.ensure_session(db_session)
+    async def reload_catalog_if_changed(
+        cls, session: Optional[AsyncSession] = None
+    ) -> bool:
+        """Reload the catalog if commands changed since it was loaded, eg in
+        another process. Returns True if it was reloaded"""
+        version = await ConfigVersion.fetch_version(cls.catalog_scope, session=session)
+        if cls._catalog is not None and cls._catalog.version == version:
+            return False
+
+        cls.invalidate_catalog()
+        await cls.load_catalog(session=session)
+        return True
+
+    @classmethod
+    def invalidate_catalog(cls):
+        cls._catalog = None
+        cls._catalog_generation += 1
+
+    @classmethod
+    async def _catalog_changed(cls, session: AsyncSession):
+        """Bump the catalog version and drop the local catalog once the
+        transaction of session commits"""
+        await ConfigVersion.bump([cls.catalog_scope], session=session)
+        if not session.info.get(cls.catalog_scope):
+            session.info[cls.catalog_scope] = True
+            event.listen(
+                session.sync_session,
+                "after_commit",
+                cls._on_catalog_change_commit,
+                once=True,
+            )
+
+    @classmethod
+    def _on_catalog_change_commit(cls, sync_session):
+        sync_session.info.pop(cls.catalog_scope, None)
+        cls.invalidate_catalog()
+
     @property
     def is_command_group(self):
         return self.response_type == 0
@@ -1143,6 +2148,99 @@ class UserCommand(Base):
         ]
 
 
+class ConfigVersion(Base):
+    """Change counters for configuration that processes cache in memory
+
+    Every change to cached configuration bumps the version of its scope, eg
+    mirror:<src_id> for mirrors, in the same transaction as the change.
+    Processes poll this table and reload only the scopes that changed"""
+
+    __tablename__ = "config_version"
+    __mapper_args__ = {"eager_defaults": True}
+    scope = Column("scope", String(64), primary_key=True)
+    version = Column("version", BigInteger, default=1)
+
+    mirror_prefix = "mirror:"
+
+    @classmethod
+    @utils.ensure_session(db_session)
+    async def bump(cls, scopes: Iterable[str], session: Optional[AsyncSession] = None):
+        """Increment the version of each scope, starting new scopes at 1"""
+        for batch in batched(sorted(set(scopes)), PAIR_BATCH_SIZE):
+            await session.execute(
+                upsert(
+                    cls,
+                    [{"scope": scope, "version": 1} for scope in batch],
+                    lambda proposed: {"version": cls.version + 1},
+                )
+            )
+
+    @classmethod
+    @utils.ensure_session(db_session)
+    async def fetch_version(
+        cls, scope: str, session: Optional[AsyncSession] = None
+    ) -> int:
+        """Return the version of scope, 0 if it was never bumped"""
+        return (
+            await session.execute(select(cls.version).where(cls.scope == scope))
+        ).scalar() or 0
+
+    @classmethod
+    @utils.ensure_session(db_session)
+    async def bump_mirrors(
+        cls, src_ids: Iterable[int], session: Optional[AsyncSession] = None
+    ):
+        """Mark the mirrors of each src_id as changed"""
+        await cls.bump(
+            [cls.mirror_prefix + str(int(src_id)) for src_id in src_ids],
+            session=session,
+        )
+
+    @classmethod
+    @utils.ensure_session(db_session)
+    async def fetch_mirror_versions(
+        cls, session: Optional[AsyncSession] = None
+    ) -> Dict[int, int]:
+        """Return the current version for each src_id with changed mirrors"""
+        versions = (
+            await session.execute(
+                select(cls.scope, cls.version).where(
+                    cls.scope.startswith(cls.mirror_prefix)
+                )
+            )
+        ).fetchall()
+        return {
+            int(scope[len(cls.mirror_prefix) :]): version for scope, version in versions
+        }
+
+
+async def upgrade_all():
+    """Create tables and columns that are missing from the db, eg ones added
+    in an update
+
+    Existing tables and columns are left untouched, so new columns must be
+    nullable"""
+    async with db_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+
+
+def _add_missing_columns(conn):
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {
+            column["name"] for column in inspector.get_columns(table.name)
+        }
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(
+                text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+            )
+            logging.info(f"Added column {column.name} to table {table.name}")
+
+
 async def recreate_all():
     # db_engine = create_engine(cfg.db_url, connect_args=cfg.db_connect_args)
     db_engine = create_async_engine(cfg.db_url_async, connect_args=cfg.db_connect_args)
@@ -1154,6 +2252,11 @@ async def recreate_all():
         await conn.run_sync(Base.metadata.create_all)
         logging.info(f"Created tables: {Base.metadata.tables.keys()}")
 
+    await db_engine.dispose()
+    # Drop in memory copies of the tables that were just emptied
+    UserCommand.invalidate_catalog()
+    MirroredChannel.invalidate_legacy_srcs()
+
 
 if __name__ == "__main__":
     asyncio.run(recreate_all())
@@ -0,0 +1,114 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# Snapshot of in memory caches persisted across restarts
+#
+# Parts of the bot register a named section with a dump function returning
+# plain data (None, bools, ints, strs, bytes and lists, tuples and dicts of
+# these) and a load function taking the same data back. The snapshot is a
+# VersionedFile with a payload of zlib(marshal({section name: data}))
+#
+# marshal is used since it is fast, compact and only handles plain data, so
+# loading a snapshot can never run code. Snapshots with a different format
+# version are ignored and the bot starts cold
+
+import asyncio
+import logging
+import marshal
+import os
+import typing as t
+import zlib
+from pathlib import Path
+from time import perf_counter
+
+from .versioned_file import VersionedFile
+
+MAGIC = b"CTSNAP\x00\x00"
+# Bump when the layout of any section changes incompatibly
+FORMAT_VERSION = 1
+# marshal format version, 4 is supported by all python 3 versions in use
+_MARSHAL_VERSION = 4
+
+
+class WarmStartSnapshot:
+    """Saves and restores registered sections of in memory state"""
+
+    def __init__(self, path: os.PathLike | str):
+        self.path = Path(path)
+        self._sections: t.Dict[
+            str, t.Tuple[t.Callable[[], t.Any], t.Callable[[t.Any], None]]
+        ] = {}
+        # Set once load has run, whether or not a snapshot was found
+        self.loaded = asyncio.Event()
+
+    def register(
+        self, name: str, dump: t.Callable[[], t.Any], load: t.Callable[[t.Any], None]
+    ):
+        self._sections[name] = (dump, load)
+
+    async def save(self) -> int:
+        """Write the current state of all sections, returns the bytes written"""
+        sections = {}
+        for name, (dump, _) in self._sections.items():
+            try:
+                sections[name] = dump()
+            except Exception as e:
+                logging.exception(f"Could not snapshot section {name}: {e}")
+
+        return await asyncio.to_thread(
+            self._file().write,
+            zlib.compress(marshal.dumps(sections, _MARSHAL_VERSION)),
+        )
+
+    def _file(self) -> VersionedFile:
+        return VersionedFile(self.path, MAGIC, FORMAT_VERSION)
+
+    async def load(self) -> t.List[str]:
+        """Restore all registered sections found in the snapshot
+
+        Returns the names of the sections restored"""
+        start_time = perf_counter()
+        restored = []
+        try:
+            sections = await asyncio.to_thread(self._read)
+            for name, (_, load) in self._sections.items():
+                if name not in sections:
+                    continue
+                try:
+                    load(sections[name])
+                except Exception as e:
+                    logging.exception(f"Could not restore snapshot section {name}: {e}")
+                else:
+                    restored.append(name)
+        finally:
+            self.loaded.set()
+
+        if restored:
+            logging.info(
+                f"Restored {', '.join(restored)} from snapshot in "
+                + f"{perf_counter() - start_time:.3f}s"
+            )
+        return restored
+
+    def _read(self) -> t.Dict[str, t.Any]:
+        try:
+            payload = self._file().read()
+            if payload is None:
+                logging.info(f"No snapshot at {self.path}, starting cold")
+                return {}
+            return marshal.loads(zlib.decompress(payload))
+        except (zlib.error, EOFError, ValueError, TypeError) as e:
+            logging.warning(f"Ignoring unreadable snapshot {self.path}: {e}")
+            return {}
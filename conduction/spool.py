@@ -0,0 +1,115 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# Local append only spool for db writes that could not be made
+#
+# Records are appended as JSON lines and fsynced, with appends that arrive
+# within flush_interval of each other sharing a single write and fsync. The
+# spool is replayed into the db in bulk once it is reachable again, by
+# renaming the spool file aside, applying its records and deleting it
+
+import asyncio
+import json
+import logging
+import os
+import typing as t
+from pathlib import Path
+
+
+class WriteSpool:
+    """Durable append only JSONL spool of records for the db"""
+
+    def __init__(self, path: str | os.PathLike, flush_interval: float = 0.2):
+        self.path = Path(path)
+        self.replay_path = self.path.with_suffix(self.path.suffix + ".replaying")
+        self.flush_interval = flush_interval
+        self._buffer: t.List[str] = []
+        self._flushed: t.Optional[asyncio.Future] = None
+        self._flush_task: t.Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+        self._replay_lock = asyncio.Lock()
+        # Records left over from a previous run are replayed as well
+        self.pending = self.path.exists() or self.replay_path.exists()
+
+    async def append(self, records: t.Iterable[dict]):
+        """Append records, returning once they have been written and fsynced"""
+        self._buffer.extend(json.dumps(record, default=str) for record in records)
+        self.pending = True
+        if self._flushed is None:
+            self._flushed = asyncio.get_running_loop().create_future()
+            self._flush_task = asyncio.create_task(self._flush())
+        await asyncio.shield(self._flushed)
+
+    async def _flush(self):
+        # Let appends arriving in the meantime join this write
+        await asyncio.sleep(self.flush_interval)
+        lines, self._buffer = self._buffer, []
+        flushed, self._flushed = self._flushed, None
+        try:
+            async with self._write_lock:
+                await asyncio.to_thread(self._write, lines)
+        except Exception as e:
+            flushed.set_exception(e)
+        else:
+            flushed.set_result(None)
+
+    def _write(self, lines: t.List[str]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write("".join(line + "\n" for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read(self) -> t.List[dict]:
+        records = []
+        with open(self.replay_path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Only the last line can be torn, by a crash mid write
+                    logging.warning(f"Skipping corrupt line in {self.replay_path}")
+        return records
+
+    async def replay(self, apply: t.Callable[[t.List[dict]], t.Awaitable]) -> int:
+        """Pass all spooled records to apply and drop them once it returns
+
+        If apply raises, the records are kept and passed again on the next
+        replay, so apply must be idempotent. Returns the number of records
+        replayed"""
+        replayed = 0
+        async with self._replay_lock:
+            # A replay file left by an interrupted replay goes first, then the
+            # current spool file. Records appended meanwhile wait for the next
+            # replay so that a steady stream of appends can't keep this going
+            for _ in range(2):
+                # Appends made from here on go to a fresh spool file
+                async with self._write_lock:
+                    if not self.replay_path.exists() and self.path.exists():
+                        os.replace(self.path, self.replay_path)
+                if not self.replay_path.exists():
+                    break
+
+                records = await asyncio.to_thread(self._read)
+                if records:
+                    await apply(records)
+                await asyncio.to_thread(os.remove, self.replay_path)
+                replayed += len(records)
+
+            # A flush in flight has taken its records out of the buffer but
+            # may not have written them yet
+            flushing = self._flush_task is not None and not self._flush_task.done()
+            self.pending = flushing or bool(self._buffer) or self.path.exists()
+        return replayed
@@ -0,0 +1,156 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# Concurrent startup of modules that need to load data before their commands
+# can respond, eg the navigator pages built from channel history
+#
+# Modules add a start function per component when registering. Once the bot
+# has started, all components are started concurrently, at most
+# max_concurrency at a time so that they do not flood the REST api (and its
+# rate limits) together. Failed components are retried with a backoff while
+# the others carry on, up to MAX_START_ATTEMPTS times. Commands of components
+# that are not ready yet reply that they are warming up instead of failing
+
+import asyncio
+import functools
+import logging
+import typing as t
+from time import perf_counter
+
+import hikari as h
+import lightbulb as lb
+
+from . import utils
+
+WARMING_UP_MESSAGE = (
+    "This command is still warming up after a restart, please try again shortly"
+)
+FAILED_MESSAGE = "This command is unavailable right now, please try again later"
+# Longest wait between retries of a failing component, in seconds
+MAX_RETRY_DELAY = 300
+# Attempts to start a component before giving up on it until the next restart
+MAX_START_ATTEMPTS = 8
+
+StartFunction = t.Callable[[lb.BotApp], t.Coroutine[t.Any, t.Any, None]]
+
+
+class StartupOrchestrator:
+    """Starts components concurrently and tracks which of them are ready"""
+
+    def __init__(self, max_concurrency: int = 3):
+        self._components: t.Dict[str, StartFunction] = {}
+        self._budget = asyncio.Semaphore(max_concurrency)
+        self._started_at: t.Optional[float] = None
+        # Seconds from the start of startup until each component was ready
+        self.ready_after: t.Dict[str, float] = {}
+        self.failures: t.Dict[str, int] = {}
+        # Components given up on after MAX_START_ATTEMPTS failed attempts
+        self.failed: t.Set[str] = set()
+        self.all_ready = asyncio.Event()
+
+    def add(self, name: str, start: StartFunction):
+        if name in self._components:
+            raise ValueError(f"Startup component {name} already added")
+        self._components[name] = start
+
+    def is_ready(self, name: str) -> bool:
+        return name in self.ready_after
+
+    @property
+    def all_ready_after(self) -> t.Optional[float]:
+        """Seconds from the start of startup until all components were ready"""
+        if not self.all_ready.is_set():
+            return None
+        return max(self.ready_after.values(), default=0.0)
+
+    async def run(self, bot: lb.BotApp):
+        self._started_at = perf_counter()
+        await asyncio.gather(
+            *(
+                self._start(bot, name, start)
+                for name, start in self._components.items()
+            )
+        )
+        if self.failed:
+            logging.warning(
+                f"Startup components {', '.join(sorted(self.failed))} failed to start"
+            )
+            return
+
+        self.all_ready.set()
+        logging.info(
+            f"All {len(self._components)} startup components ready in "
+            + f"{self.all_ready_after:.1f}s"
+        )
+
+    async def _start(self, bot: lb.BotApp, name: str, start: StartFunction):
+        while True:
+            try:
+                async with self._budget:
+                    await start(bot)
+            except Exception as e:
+                self.failures[name] = self.failures.get(name, 0) + 1
+                if self.failures[name] >= MAX_START_ATTEMPTS:
+                    self.failed.add(name)
+                    e.add_note(
+                        f"Exception while starting {name}, giving up after "
+                        + f"{self.failures[name]} attempts"
+                    )
+                    await utils.discord_error_logger(bot, e)
+                    return
+
+                e.add_note(f"Exception while starting {name}, retrying")
+                await utils.discord_error_logger(bot, e)
+                await asyncio.sleep(min(2 ** self.failures[name], MAX_RETRY_DELAY))
+            else:
+                break
+
+        self.ready_after[name] = perf_counter() - self._started_at
+        logging.info(f"{name} ready in {self.ready_after[name]:.1f}s")
+
+    def report(self) -> t.List[t.Tuple[str, t.Optional[float], int]]:
+        """(name, seconds until ready or None, failures) of each component"""
+        return [
+            (name, self.ready_after.get(name), self.failures.get(name, 0))
+            for name in self._components
+        ]
+
+    def status(self, name: str) -> str:
+        """"ready", "failed" or "warming" for component <name>"""
+        if self.is_ready(name):
+            return "ready"
+        return "failed" if name in self.failed else "warming"
+
+
+def requires_ready(name: str):
+    """Reply that the command is warming up until component <name> is ready,
+    or that it is unavailable if the component failed to start
+
+    Put directly above the command's callback, below `@lb.implements`"""
+
+    def decorator(callback):
+        @functools.wraps(callback)
+        async def wrapper(ctx: lb.Context, *args, **kwargs):
+            status = ctx.bot.startup.status(name)
+            if status != "ready":
+                return await ctx.respond(
+                    FAILED_MESSAGE if status == "failed" else WARMING_UP_MESSAGE,
+                    flags=h.MessageFlag.EPHEMERAL,
+                )
+            return await callback(ctx, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -17,9 +17,16 @@ import asyncio
 
 import pytest
 
+from .. import schemas
+
 
 @pytest.fixture(scope="session")
 def event_loop():
     loop = asyncio.new_event_loop()
     yield loop
+    # Close pooled connections before the loop they were opened on goes away
+    # (aiosqlite connections otherwise keep their threads, and the process, alive)
+    loop.run_until_complete(schemas.db_engine.dispose())
+    if schemas.db_replica_engine is not None:
+        loop.run_until_complete(schemas.db_replica_engine.dispose())
     loop.close()
@@ -0,0 +1,197 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import gc
+
+import pytest
+
+from .. import cache
+from ..cache import (
+    ENTRY_OVERHEAD,
+    MISSING,
+    CachePolicy,
+    PrefixTrie,
+    RecentMirrorCache,
+    SingleFlight,
+    TTLCache,
+    deep_sizeof,
+    estimate_size,
+)
+
+
+def test_recent_mirror_cache():
+    recent = RecentMirrorCache(max_entries=2)
+    assert recent.get(1) is None
+
+    # Pairs are only cached for fan outs that were started
+    recent.extend(1, [10], [100])
+    assert recent.get(1) is None
+
+    recent.start(1)
+    assert [] == recent.get(1)
+    recent.extend(1, [10, 11], [100, 101])
+    recent.extend(1, [12], [102])
+    assert [(10, 100), (11, 101), (12, 102)] == recent.get(1)
+
+    # A repeated fan out keeps the pairs of the earlier ones
+    recent.start(1, first_fan_out=False)
+    recent.extend(1, [13], [103])
+    assert [(10, 100), (11, 101), (12, 102), (13, 103)] == recent.get(1)
+    # and is not cached if the earlier pairs are gone
+    recent.start(4, first_fan_out=False)
+    assert 4 not in recent
+
+    # Least recently used entries are evicted past max_entries
+    recent.start(2)
+    recent.get(1)
+    recent.start(3)
+    assert 2 not in recent
+    assert 1 in recent and 3 in recent
+    assert (4, 2, 1) == (recent.hits, recent.misses, recent.evictions)
+
+
+def test_recent_mirror_cache_byte_bound():
+    recent = RecentMirrorCache(max_bytes=2 * ENTRY_OVERHEAD + 16 * 10)
+    recent.start(1)
+    recent.extend(1, range(10), range(10))
+    recent.start(2)
+    assert 2 == len(recent)
+    assert 2 * ENTRY_OVERHEAD + 16 * 10 == recent.bytes
+
+    # Growing an entry past the byte bound evicts the oldest entry
+    recent.extend(2, [1], [1])
+    assert [2] == [source_msg for source_msg in (1, 2) if source_msg in recent]
+    assert ENTRY_OVERHEAD + 16 == recent.bytes
+
+
+def test_prefix_trie():
+    trie = PrefixTrie()
+    for key in ("ab", "a", "abc", "b", "abd"):
+        trie.insert(key, key)
+    trie.insert("ab", "ab2")
+
+    assert ["a", "ab", "ab2", "abc", "abd"] == trie.find("a")
+    assert ["abc"] == trie.find("abc")
+    assert [] == trie.find("c")
+    assert 6 == len(trie.find(""))
+
+
+def test_ttl_cache(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(cache, "monotonic", lambda: now[0])
+    ttl_cache = TTLCache(CachePolicy(max_entries=2, ttl=10, negative_ttl=5))
+
+    assert ttl_cache.get(1) is MISSING
+    ttl_cache.set(1, "one")
+    ttl_cache.set(2, "two")
+    assert "one" == ttl_cache.get(1)
+    # Least recently used entries are evicted past max_entries
+    ttl_cache.set(3, "three")
+    assert ttl_cache.get(2) is MISSING
+
+    # Cached exceptions are raised as copies
+    error = LookupError("gone")
+    ttl_cache.set_exception(3, error)
+    with pytest.raises(LookupError) as raised:
+        ttl_cache.get(3)
+    assert raised.value is not error and "gone" == str(raised.value)
+
+    # Entries expire after their ttl
+    now[0] = 6
+    assert ttl_cache.get(3) is MISSING
+    assert "one" == ttl_cache.get(1)
+    now[0] = 10
+    assert ttl_cache.get(1) is MISSING
+    assert (2, 1, 4, 1, 2) == (
+        ttl_cache.hits,
+        ttl_cache.negative_hits,
+        ttl_cache.misses,
+        ttl_cache.evictions,
+        ttl_cache.expirations,
+    )
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    flights = SingleFlight()
+    release = asyncio.Event()
+    calls = []
+
+    async def call():
+        calls.append(None)
+        await release.wait()
+        return len(calls)
+
+    waiters = [asyncio.create_task(flights.do("key", call)) for _ in range(5)]
+    await asyncio.sleep(0)
+    # Cancelling one caller does not cancel the shared call
+    waiters.pop().cancel()
+    release.set()
+    assert [1] * 4 == await asyncio.gather(*waiters)
+    assert (1, 4, 0) == (flights.calls, flights.coalesced, len(flights))
+
+    async def failing_call():
+        raise LookupError
+
+    # Once landed, the next call for the key starts a new flight
+    with pytest.raises(LookupError):
+        await flights.do("key", failing_call)
+    assert 2 == flights.calls
+
+
+@pytest.mark.asyncio
+async def test_single_flight_all_callers_cancelled():
+    loop = asyncio.get_running_loop()
+    unhandled = []
+    previous_handler = loop.get_exception_handler()
+    loop.set_exception_handler(lambda loop, context: unhandled.append(context))
+
+    flights = SingleFlight()
+    release = asyncio.Event()
+
+    async def failing_call():
+        await release.wait()
+        raise LookupError
+
+    caller = asyncio.create_task(flights.do("key", failing_call))
+    await asyncio.sleep(0)
+    caller.cancel()
+    release.set()
+    # Let the flight land with nobody waiting on it
+    for _ in range(3):
+        await asyncio.sleep(0)
+    assert 0 == len(flights)
+
+    del caller
+    gc.collect()
+    loop.set_exception_handler(previous_handler)
+    assert [] == unhandled
+
+
+def test_deep_sizeof():
+    class Entity:
+        __slots__ = ("name", "app")
+
+        def __init__(self, name, app):
+            self.name = name
+            self.app = app
+
+    app = ["x" * 10_000]
+    small, large = Entity("a", app), Entity("a" * 1000, app)
+    # References back to the app are not followed
+    assert deep_sizeof(small) < 1000 < deep_sizeof(large) < 2000
+    assert 10 * deep_sizeof(small) == estimate_size([small] * 10, 10)
+    assert 0 == estimate_size([], 0)
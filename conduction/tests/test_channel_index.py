@@ -0,0 +1,94 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+from types import SimpleNamespace as Fake
+
+import hikari as h
+import pytest
+
+from ..cache import MISSING, CachePolicy, TTLCache
+from ..channel_index import ChannelIndex
+
+GUILD_ID = 1
+ME = 2
+ROLE_ID = 3
+P = h.Permissions
+
+
+def fake_channel(id, type=h.ChannelType.GUILD_TEXT, overwrites={}):
+    return Fake(id=id, guild_id=GUILD_ID, type=type, permission_overwrites=overwrites)
+
+
+def fake_guild_available(*channels, role_permissions=P.SEND_MESSAGES):
+    return Fake(
+        app=Fake(get_me=lambda: Fake(id=ME)),
+        guild_id=GUILD_ID,
+        guild=Fake(owner_id=0),
+        members={ME: Fake(role_ids=[ROLE_ID])},
+        roles={
+            GUILD_ID: Fake(permissions=P.VIEW_CHANNEL),
+            ROLE_ID: Fake(permissions=role_permissions),
+        },
+        channels={channel.id: channel for channel in channels},
+        threads={},
+    )
+
+
+@pytest.mark.asyncio
+async def test_channel_index():
+    index = ChannelIndex()
+    deny_role = {ROLE_ID: Fake(allow=P.NONE, deny=P.SEND_MESSAGES)}
+    await index.on_guild_available(
+        fake_guild_available(
+            fake_channel(10),
+            fake_channel(11, h.ChannelType.GUILD_NEWS),
+            fake_channel(12, overwrites=deny_role),
+            fake_channel(13, h.ChannelType.GUILD_CATEGORY),
+        )
+    )
+
+    assert 4 == len(index)
+    assert index.get(10).can_send and not index.get(10).is_news
+    assert index.get(11).is_news and index.get(11).is_textable
+    assert not index.get(12).can_send
+    assert not index.get(13).is_textable
+    assert index.get(14) is None
+
+    # Channel events update the index
+    await index.on_channel(Fake(channel=fake_channel(12)))
+    assert index.get(12).can_send
+    await index.on_channel_delete(Fake(channel_id=12))
+    assert index.get(12) is None
+
+    # Permissions become unknown when the bot's roles change
+    await index.on_role_change(Fake(guild_id=GUILD_ID, role_id=ROLE_ID))
+    assert index.get(10).permissions is None and index.get(10).can_send
+
+    await index.on_guild_leave(Fake(guild_id=GUILD_ID))
+    assert 0 == len(index)
+
+
+@pytest.mark.asyncio
+async def test_channel_events_discard_fetched_channels():
+    rest_cache = TTLCache(CachePolicy(max_entries=10, ttl=60, negative_ttl=60))
+    index = ChannelIndex(rest_cache)
+    rest_cache.set(10, "channel 10")
+    rest_cache.set_exception(11, LookupError("forbidden"))
+    rest_cache.set(12, "channel 12")
+
+    await index.on_channel(Fake(channel=fake_channel(10)))
+    await index.on_channel_delete(Fake(channel_id=11))
+    assert rest_cache.get(10) is MISSING and rest_cache.get(11) is MISSING
+    assert "channel 12" == rest_cache.get(12)
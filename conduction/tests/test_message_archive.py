@@ -0,0 +1,93 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime as dt
+
+import pytest
+from sqlalchemy import select
+
+from .. import schemas, utils
+from ..archive import MessageArchive
+from ..schemas import MirroredMessage
+
+
+def setup_function(function):
+    asyncio.run(schemas.recreate_all())
+
+
+@pytest.mark.asyncio
+async def test_lookup_across_blocks_and_segments(tmp_path):
+    archive = MessageArchive(tmp_path, block_rows=4)
+    src_msg = 10
+
+    # Rows for src_msg straddle blocks in the first segment
+    assert 9 == await archive.append(
+        [(src_msg, 1, dest_msg, dest_msg + 1000) for dest_msg in range(100, 106)]
+        + [(src_msg - 1, 1, 1, 1), (src_msg + 1, 1, 2, 2), (src_msg + 2, 1, 3, 3)]
+    )
+    assert 2 == await archive.append(
+        [(src_msg, 1, 200, 1200), (src_msg, 1, 100, 1100)]
+    )
+
+    expected = [(dest_msg, dest_msg + 1000) for dest_msg in range(100, 106)] + [
+        (200, 1200)
+    ]
+    assert sorted(await archive.lookup(src_msg)) == expected
+    assert await archive.lookup(src_msg + 100) == []
+    assert await archive.lookup(0) == []
+
+    # Segments are read back from disk by a fresh archive
+    assert sorted(await MessageArchive(tmp_path).lookup(src_msg)) == expected
+
+
+@pytest.mark.asyncio
+async def test_prune_archives_messages(tmp_path, monkeypatch):
+    monkeypatch.setattr(schemas, "message_archive", MessageArchive(tmp_path))
+    src_msg = 1
+    src_ch = 2
+
+    await MirroredMessage.add_msgs_in_batch([3, 4], [5, 6], src_msg, src_ch)
+    await MirroredMessage.prune(age=dt.timedelta(days=-1))
+
+    async with schemas.db_session() as session:
+        assert not (await session.execute(select(MirroredMessage))).all()
+
+    assert sorted(await MirroredMessage.get_dest_msgs_and_channels(src_msg)) == [
+        (3, 5),
+        (4, 6),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_prune_deletes_only_archived_messages(tmp_path, monkeypatch):
+    message_archive = MessageArchive(tmp_path)
+    monkeypatch.setattr(schemas, "message_archive", message_archive)
+    archive_append = message_archive.append
+
+    async def append_then_add(rows):
+        await archive_append(rows)
+        # Added between the archive and the delete
+        await MirroredMessage.add_msgs_in_batch([7], [8], 1, 2)
+
+    monkeypatch.setattr(message_archive, "append", append_then_add)
+
+    await MirroredMessage.add_msgs_in_batch([3, 4], [5, 6], 1, 2)
+    async with utils.unit_of_work(schemas.db_session):
+        await MirroredMessage.prune(age=dt.timedelta(days=-1))
+
+    async with schemas.db_session() as session:
+        remaining = await session.execute(select(MirroredMessage.dest_msg))
+        assert [7] == remaining.scalars().all()
@@ -0,0 +1,99 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+import datetime as dt
+from types import SimpleNamespace as Fake
+
+import hikari as h
+import pytest
+
+from ..nav_store import NavPagesStore, StoredPages
+
+PERIOD_START = dt.datetime(2024, 1, 5, 17, tzinfo=dt.timezone.utc)
+
+
+def fake_message(entity_factory: h.api.EntityFactory) -> h.Message:
+    return entity_factory.deserialize_message(
+        {
+            "id": "1000",
+            "channel_id": "2",
+            "guild_id": "3",
+            "author": {
+                "id": "4",
+                "username": "kyber",
+                "discriminator": "0",
+                "global_name": None,
+                "avatar": None,
+            },
+            "content": "Xur is at https://kyberscorner.com/xur",
+            "timestamp": PERIOD_START.isoformat(),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [
+                {
+                    "id": "5",
+                    "filename": "xur.png",
+                    "size": 10,
+                    "url": "https://cdn.discordapp.com/xur.png",
+                    "proxy_url": "https://media.discordapp.net/xur.png",
+                }
+            ],
+            "embeds": [{"title": "Xur", "description": "Tower hangar"}],
+            "reactions": [],
+            "components": [],
+            "sticker_items": [],
+            "pinned": False,
+            "type": 0,
+            "flags": 0,
+        }
+    )
+
+
+@pytest.mark.asyncio
+async def test_stores_preprocessed_pages(tmp_path):
+    pytest.importorskip("hmessage")
+    from ..nav import NavPages
+
+    pages = NavPages(
+        Fake(app=None),
+        period=dt.timedelta(days=7),
+        reference_date=PERIOD_START,
+    )
+    page = pages.preprocess_messages(
+        [fake_message(h.impl.EntityFactoryImpl(Fake()))]
+    )
+
+    store = NavPagesStore(tmp_path)
+    await store.save(
+        "NavPages", 2, pages._render_key, StoredPages(1000, {PERIOD_START: page})
+    )
+
+    stored = await store.load("NavPages", 2, pages._render_key)
+    assert 1000 == stored.last_message_id
+    restored = stored.pages[PERIOD_START]
+    assert page.content == restored.content
+    assert ["Tower hangar"] == [embed.description for embed in restored.embeds]
+    # The attachment made it through as well
+    kwargs = restored.to_message_kwargs()
+    assert kwargs.get("attachments") or kwargs.get("attachment")
+
+    # Pages are stored per NavPages class and channel, and are not served
+    # once the code or settings that rendered them change
+    assert await store.load("NavPages", 3, pages._render_key) is None
+    assert await store.load("XurPages", 2, pages._render_key) is None
+    assert await store.load("NavPages", 2, "another render key") is None
@@ -0,0 +1,86 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+from types import SimpleNamespace as Fake
+
+import hikari as h
+import pytest
+
+from ..router import MessageRouter
+
+
+class FakeBot:
+    def __init__(self):
+        self.listeners = {}
+
+    def subscribe(self, event_type, callback):
+        self.listeners.setdefault(event_type, []).append(callback)
+
+
+def fake_create_event(channel_id, reference_channel_id=None):
+    reference = reference_channel_id and Fake(channel_id=reference_channel_id)
+    return Fake(channel_id=channel_id, message=Fake(message_reference=reference))
+
+
+@pytest.mark.asyncio
+async def test_routes_by_channel():
+    bot = FakeBot()
+    router = MessageRouter(bot)
+    received = []
+
+    async def handler(event):
+        received.append(("channel", event.channel_id))
+
+    async def crosspost_handler(event):
+        received.append(("crosspost", event.channel_id))
+
+    async def failing_handler(event):
+        raise RuntimeError
+
+    router.subscribe(h.MessageCreateEvent, 1, handler)
+    router.subscribe(h.MessageCreateEvent, 1, failing_handler)
+    router.subscribe(h.MessageUpdateEvent, 2, handler)
+    router.subscribe_crossposts(1, crosspost_handler)
+    # One listener per event type however many handlers there are
+    assert 1 == len(bot.listeners[h.MessageCreateEvent])
+
+    (dispatch,) = bot.listeners[h.MessageCreateEvent]
+    await dispatch(fake_create_event(1))
+    await dispatch(fake_create_event(2))
+    await dispatch(fake_create_event(3, reference_channel_id=1))
+    # A failing handler does not stop the others
+    assert [("channel", 1), ("crosspost", 3)] == received
+    assert (2, 1) == (router.routed, router.dropped)
+
+    router.unsubscribe(h.MessageCreateEvent, 1, handler)
+    router.unsubscribe(h.MessageCreateEvent, 1, failing_handler)
+    await dispatch(fake_create_event(1))
+    assert 2 == len(received)
+
+
+@pytest.mark.asyncio
+async def test_channel_filter():
+    bot = FakeBot()
+    router = MessageRouter(bot)
+    received = []
+
+    async def handler(event):
+        received.append(event.channel_id)
+
+    router.subscribe_all_channels(h.MessageDeleteEvent, handler, {1}.__contains__)
+    (dispatch,) = bot.listeners[h.MessageDeleteEvent]
+    await dispatch(Fake(channel_id=1))
+    await dispatch(Fake(channel_id=2))
+    assert [1] == received
@@ -14,11 +14,20 @@
 # conduction-tines. If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import datetime as dt
+import sqlite3
 
 import pytest
-from .. import schemas
+from sqlalchemy import exc as sql_exc, select, update
+from sqlalchemy.util import greenlet_spawn
 
-from ..schemas import MirroredChannel as _MirroredChannel, ServerStatistics
+from .. import instrumentation, schemas, utils
+
+from ..schemas import (
+    MirroredChannel as _MirroredChannel,
+    MirroredMessage,
+    ServerStatistics,
+)
 
 
 def setup_function():
@@ -28,7 +37,7 @@ def setup_function():
 @pytest.fixture()
 def MirroredChannel():
     # Clear the cache before each test
-    _MirroredChannel._legacy_srcs_cache.clear()
+    _MirroredChannel.invalidate_legacy_srcs()
     yield _MirroredChannel
 
 
@@ -170,6 +179,19 @@ async def test_count_dests(MirroredChannel):
     assert 0 == await MirroredChannel.count_dests(dest_id_2)
 
 
+@pytest.mark.asyncio
+async def test_count_dests_by_src(MirroredChannel):
+    await MirroredChannel.add_mirror(0, 2, 4, legacy=True)
+    await MirroredChannel.add_mirror(0, 3, 4, legacy=True)
+    await MirroredChannel.add_mirror(0, 5, 4, legacy=False)
+    await MirroredChannel.add_mirror(1, 2, 4, legacy=False)
+    await MirroredChannel.add_mirror(6, 2, 4, legacy=False)
+
+    assert {(0, True): 2, (0, False): 1, (1, False): 1} == (
+        await MirroredChannel.count_dests_by_src([0, 1, 2])
+    )
+
+
 @pytest.mark.asyncio
 async def test_order_fetch_by_server_size(MirroredChannel: _MirroredChannel):
     src_id = 0
@@ -284,3 +306,274 @@ async def test_set_legacy_with_mirror_dests_cache(MirroredChannel: _MirroredChan
 
     await MirroredChannel.set_legacy(src_id, dest_id, True)
     await assert_all_srcs_equals([src_id], mirrored_channel=MirroredChannel)
+
+
+@pytest.mark.asyncio
+async def test_disable_only_failing_pairs(MirroredChannel: _MirroredChannel):
+    guild_id = 9
+    # (1, 4) and (2, 3) are healthy but match src_id IN (1, 2) AND dest_id IN (3, 4)
+    for src_id, dest_id in ((1, 3), (1, 4), (2, 3), (2, 4)):
+        await MirroredChannel.add_mirror(src_id, dest_id, guild_id, legacy=True)
+
+    await MirroredChannel.log_legacy_mirror_results([(1, 3), (2, 4)], failures=7)
+    await MirroredChannel.log_legacy_mirror_results([(1, 4)], failures=6)
+    # A success followed by a failure leaves an error rate of 1
+    await MirroredChannel.log_legacy_mirror_results([(2, 3)], failures=1, reset=True)
+
+    # Only the pairs passed in are checked
+    assert [(1, 3)] == await MirroredChannel.disable_legacy_failing_mirrors(
+        pairs=[(1, 3), (1, 4), (2, 3)]
+    )
+    assert [(2, 4)] == await MirroredChannel.disable_legacy_failing_mirrors()
+
+    assert [4] == await MirroredChannel.fetch_dests(1)
+    assert [3] == await MirroredChannel.fetch_dests(2)
+
+
+@pytest.mark.asyncio
+async def test_reload_changed_srcs(MirroredChannel: _MirroredChannel):
+    MirroredChannel._src_versions.clear()
+    await MirroredChannel.add_mirror(1, 2, 9, legacy=True)
+    await MirroredChannel.add_mirror(3, 4, 9, legacy=True)
+    await assert_all_srcs_equals([1, 3], MirroredChannel)
+    assert [1, 3] == sorted(await MirroredChannel.reload_changed_srcs())
+    assert [] == await MirroredChannel.reload_changed_srcs()
+
+    # Simulate another process making src 3 non legacy
+    async with utils.unit_of_work(schemas.db_session) as session:
+        await session.execute(
+            update(MirroredChannel)
+            .where(MirroredChannel.src_id == 3)
+            .values(legacy=False)
+        )
+        await schemas.ConfigVersion.bump_mirrors([3])
+
+    assert {1, 3} == await MirroredChannel.get_or_fetch_all_srcs()
+    assert [3] == await MirroredChannel.reload_changed_srcs()
+    assert {1} == await MirroredChannel.get_or_fetch_all_srcs()
+
+
+@pytest.mark.asyncio
+async def test_legacy_src_filter(MirroredChannel: _MirroredChannel):
+    # Mutations before the srcs are loaded do not make a partial filter
+    await MirroredChannel.add_mirror(1, 2, 9, legacy=True)
+    assert not MirroredChannel.legacy_srcs_loaded()
+    assert not MirroredChannel.is_legacy_src(1)
+
+    # An empty set of srcs is loaded once and not refetched
+    await MirroredChannel.set_legacy(1, 2, legacy=False)
+    assert frozenset() == await MirroredChannel.load_legacy_srcs()
+    assert MirroredChannel.legacy_srcs_loaded()
+
+    await MirroredChannel.add_mirror(3, 4, 9, legacy=True)
+    assert MirroredChannel.is_legacy_src(3) and not MirroredChannel.is_legacy_src(1)
+    await MirroredChannel.set_legacy(3, 4, legacy=False)
+    assert not MirroredChannel.is_legacy_src(3)
+
+
+def test_src_caches_warm_start(MirroredChannel: _MirroredChannel):
+    # Srcs that were never loaded are not restored as an empty set of srcs
+    MirroredChannel.load_src_caches(MirroredChannel.dump_src_caches())
+    assert not MirroredChannel.legacy_srcs_loaded()
+
+    MirroredChannel._set_legacy_srcs([1, 2])
+    src_caches = MirroredChannel.dump_src_caches()
+    MirroredChannel.invalidate_legacy_srcs()
+    MirroredChannel.load_src_caches(src_caches)
+    assert MirroredChannel.legacy_srcs_loaded()
+    assert MirroredChannel.is_legacy_src(2)
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work_shares_session(MirroredChannel: _MirroredChannel):
+    src_id = 0
+    dest_id = 1
+    dest_id_2 = 2
+    guild_id = 3
+
+    async with utils.unit_of_work(schemas.db_session) as session:
+        await MirroredChannel.add_mirror(src_id, dest_id, guild_id, legacy=True)
+        # Uncommitted changes are visible since the same session is used
+        assert [dest_id] == await MirroredChannel.fetch_dests(src_id)
+        assert session is utils.get_ambient_session()
+
+    assert utils.get_ambient_session() is None
+
+    with pytest.raises(RuntimeError):
+        async with utils.unit_of_work(schemas.db_session):
+            await MirroredChannel.add_mirror(src_id, dest_id_2, guild_id, legacy=True)
+            raise RuntimeError
+
+    # The second mirror is rolled back along with the unit of work
+    assert [dest_id] == await MirroredChannel.fetch_dests(src_id)
+
+
+@pytest.mark.asyncio
+async def test_read_only_sessionmaker_routing():
+    used = []
+
+    def tracked(name, sessionmaker):
+        def make_session():
+            used.append(name)
+            return sessionmaker()
+
+        return make_session
+
+    @utils.ensure_session(
+        tracked("primary", schemas.db_session), tracked("replica", schemas.db_session)
+    )
+    async def read(session):
+        return session
+
+    await read()
+    await read(use_primary=True)
+    assert used == ["replica", "primary"]
+
+    # An open unit of work always wins so reads see its own writes
+    async with utils.unit_of_work(schemas.db_session) as session:
+        assert session is await read()
+    assert used == ["replica", "primary"]
+
+
+@pytest.mark.asyncio
+async def test_recent_dest_msgs_retry_on_primary(monkeypatch):
+    lookups = []
+
+    async def get_dest_msgs_and_channels(source_msg, use_primary=False):
+        lookups.append(use_primary)
+        return [(3, 4)] if use_primary else []
+
+    monkeypatch.setattr(
+        MirroredMessage, "get_dest_msgs_and_channels", get_dest_msgs_and_channels
+    )
+
+    # Without a replica a miss is not looked up again
+    monkeypatch.setattr(schemas, "db_replica_session", None)
+    assert [] == await MirroredMessage.get_recent_dest_msgs_and_channels(1)
+    assert [False] == lookups
+
+    monkeypatch.setattr(schemas, "db_replica_session", schemas.db_session)
+    assert [(3, 4)] == await MirroredMessage.get_recent_dest_msgs_and_channels(1)
+    assert [False, False, True] == lookups
+
+
+@pytest.mark.asyncio
+async def test_add_mirrors_in_batch(MirroredChannel: _MirroredChannel):
+    await MirroredChannel.add_mirror(1, 2, 9, legacy=True)
+    await assert_all_srcs_equals([1], MirroredChannel)
+
+    mirrors = [
+        {"src_id": src_id, "dest_id": dest_id, "dest_server_id": 9, "legacy": True}
+        for src_id in (1, 3)
+        for dest_id in range(10, 20)
+    ]
+    # The existing mirror is updated in place
+    mirrors.append(
+        {"src_id": 1, "dest_id": 2, "dest_server_id": 9, "legacy": True, "enabled": 0}
+    )
+    assert 21 == await MirroredChannel.add_mirrors_in_batch(mirrors, batch_size=4)
+
+    assert list(range(10, 20)) == sorted(await MirroredChannel.fetch_dests(1))
+    assert list(range(10, 20)) == sorted(await MirroredChannel.fetch_dests(3))
+    assert {1, 3} == await MirroredChannel.get_or_fetch_all_srcs()
+
+    # Paging goes through every mirror once, in order
+    pages = []
+    last_mirror = None
+    while page := await MirroredChannel.fetch_mirrors_page(last_mirror, limit=6):
+        pages.append(page)
+        last_mirror = page[-1][:2]
+    assert [len(page) for page in pages] == [6, 6, 6, 3]
+    assert [mirror[:2] for page in pages for mirror in page] == sorted(
+        [(1, 2)] + [(mirror["src_id"], mirror["dest_id"]) for mirror in mirrors[:-1]]
+    )
+
+
+@pytest.mark.asyncio
+async def test_compact_disabled(MirroredChannel: _MirroredChannel):
+    guild_id = 9
+    for dest_id in (2, 3, 4):
+        await MirroredChannel.add_mirror(1, dest_id, guild_id, legacy=True)
+    await MirroredChannel.remove_mirror(1, 2)
+    await MirroredChannel.log_legacy_mirror_results([(1, 3)], failures=7)
+    await MirroredChannel.disable_legacy_failing_mirrors()
+
+    # Nothing has been disabled for long enough yet
+    assert 0 == await MirroredChannel.compact_disabled()
+    assert 2 == await MirroredChannel.compact_disabled(
+        age=dt.timedelta(0), batch_size=1
+    )
+
+    async with schemas.db_session() as session:
+        assert [(1, 4)] == (
+            await session.execute(select(MirroredChannel.src_id, MirroredChannel.dest_id))
+        ).all()
+        assert [(1, 2), (1, 3)] == sorted(
+            (
+                await session.execute(
+                    select(
+                        schemas.MirroredChannelHistory.src_id,
+                        schemas.MirroredChannelHistory.dest_id,
+                    )
+                )
+            ).all()
+        )
+
+    # Mirrors disabled for failure are still found in the history
+    assert [(1, 3)] == await MirroredChannel.undo_auto_disable_for_failure(
+        since=dt.datetime.now(tz=dt.timezone.utc) - dt.timedelta(days=1)
+    )
+    assert [3, 4] == sorted(await MirroredChannel.fetch_dests(1))
+
+
+@pytest.mark.asyncio
+async def test_query_instrumentation(MirroredChannel: _MirroredChannel, monkeypatch):
+    query_instrumentation = schemas.query_instrumentation
+    # Report every statement as slow
+    monkeypatch.setattr(query_instrumentation, "slow_threshold", 0)
+    monkeypatch.setattr(query_instrumentation, "_slow_queries", {})
+    monkeypatch.setattr(query_instrumentation, "_last_reported", {})
+
+    await MirroredChannel.fetch_dests(1)
+    await MirroredChannel.fetch_dests(2)
+    await MirroredChannel.add_mirror(1, 2, 3, legacy=True)
+
+    assert query_instrumentation.latencies["MirroredChannel.fetch_dests"].count >= 2
+    slow_queries = query_instrumentation.drain_slow_queries()
+    # Both lookups have the same statement shape so are reported once
+    assert [2] == [
+        query.count
+        for query in slow_queries
+        if query.caller == "MirroredChannel.fetch_dests" and "SELECT" in query.shape
+    ]
+    assert any(query.caller == "MirroredChannel.add_mirror" for query in slow_queries)
+    # and are not reported again within the cooldown
+    await MirroredChannel.fetch_dests(1)
+    assert [] == query_instrumentation.drain_slow_queries()
+
+
+def test_statement_shape():
+    assert instrumentation.statement_shape(
+        "SELECT a FROM t WHERE (a, b) IN ((?, ?), (?, ?))\n  AND c IN (%s, %s)"
+    ) == "SELECT a FROM t WHERE (a, b) IN ((?)) AND c IN (?)"
+
+
+@pytest.mark.asyncio
+async def test_pool_counts_only_waiting_checkouts():
+    pool = schemas.InstrumentedQueuePool(
+        lambda: sqlite3.connect(":memory:"), pool_size=1, max_overflow=1, timeout=0.05
+    )
+    connections = [await greenlet_spawn(pool.connect) for _ in range(2)]
+    # Checkouts with a connection to spare don't wait
+    assert 0 == pool.waiters
+
+    waiting = asyncio.create_task(greenlet_spawn(pool.connect))
+    await asyncio.sleep(0.01)
+    assert 1 == pool.waiters
+    with pytest.raises(sql_exc.TimeoutError):
+        await waiting
+    assert 0 == pool.waiters
+    assert 1 == pool.checkout_timeouts
+
+    for connection in connections:
+        connection.close()
@@ -0,0 +1,100 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# Runs the Postgres only bulk statements (UNNEST / ANY array parameters and
+# COPY), only when the tests are pointed at a Postgres database
+
+import asyncio
+
+import pytest
+
+from .. import cfg, schemas
+
+from ..schemas import MirroredMessage, MirroredChannel, ServerStatistics
+
+pytestmark = pytest.mark.skipif(
+    schemas.db_engine.dialect.name != "postgresql",
+    reason="Postgres only statements",
+)
+
+
+def setup_function():
+    asyncio.run(schemas.recreate_all())
+
+
+@pytest.fixture(autouse=True)
+def postgres_bulk(monkeypatch):
+    monkeypatch.setattr(cfg, "db_postgres_bulk", True)
+    MirroredChannel.invalidate_legacy_srcs()
+    assert schemas.use_postgres_bulk()
+
+
+@pytest.mark.asyncio
+async def test_copy_upsert_mirrors():
+    await MirroredChannel.add_mirror(1, 2, 9, legacy=True)
+    mirrors = [
+        {"src_id": src_id, "dest_id": dest_id, "dest_server_id": 9, "legacy": True}
+        for src_id in (1, 3)
+        for dest_id in range(10, 20)
+    ]
+    # The existing mirror is updated in place
+    mirrors.append(
+        {"src_id": 1, "dest_id": 2, "dest_server_id": 9, "legacy": True, "enabled": 0}
+    )
+    assert 21 == await MirroredChannel.add_mirrors_in_batch(mirrors, batch_size=4)
+
+    assert list(range(10, 20)) == sorted(await MirroredChannel.fetch_dests(1))
+    assert list(range(10, 20)) == sorted(await MirroredChannel.fetch_dests(3))
+
+
+@pytest.mark.asyncio
+async def test_copy_upsert_populations():
+    await ServerStatistics.add_server(1, 10)
+    assert 2 == await ServerStatistics.upsert_populations(
+        iter([(1, 20), (3, 50)]), batch_size=1
+    )
+    assert sorted(await ServerStatistics.fetch_server_populations()) == [
+        (1, 20),
+        (3, 50),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_array_parameter_predicates():
+    guild_id = 9
+    for src_id, dest_id in ((1, 3), (1, 4), (2, 3), (2, 4)):
+        await MirroredChannel.add_mirror(src_id, dest_id, guild_id, legacy=True)
+
+    # ANY(<array>)
+    await MirroredChannel.log_legacy_mirror_failure_in_batch(1, [3, 4])
+    await MirroredChannel.log_legacy_mirror_success_in_batch(1, [4])
+    # UNNEST joined pairs, (2, 4) matches src_id IN (1, 2) AND dest_id IN (3, 4)
+    # but is not one of the pairs
+    await MirroredChannel.log_legacy_mirror_results([(1, 3), (2, 3)], failures=7)
+    assert [(1, 3), (2, 3)] == sorted(
+        await MirroredChannel.disable_legacy_failing_mirrors(
+            pairs=[(1, 3), (2, 3), (2, 4)]
+        )
+    )
+    assert [4] == await MirroredChannel.fetch_dests(1)
+    assert [4] == await MirroredChannel.fetch_dests(2)
+
+
+@pytest.mark.asyncio
+async def test_unnest_insert_message_pairs():
+    await MirroredMessage.add_msgs_in_batch([10, 11, 12], [20, 21, 22], 1, 2)
+    assert [(10, 20), (11, 21), (12, 22)] == sorted(
+        tuple(row) for row in await MirroredMessage.get_dest_msgs_and_channels(1)
+    )
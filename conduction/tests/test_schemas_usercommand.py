@@ -497,3 +497,43 @@ async def test_fetch_all_commands():
     assert cmds[0].l2_name == cmd2.l2_name
     assert cmds[0].l3_name == cmd2.l3_name
     assert cmds[0].response_type != 0
+
+
+@pytest.mark.asyncio
+async def test_catalog_autocomplete_and_invalidation():
+    desc = get_function_name()
+    await UserCommand.add_command_group("testgroup", description=desc)
+    await UserCommand.add_command(
+        "testgroup", "testcmd", description=desc, response_type=1, response_data="a"
+    )
+    await UserCommand.add_command(
+        "testother", description=desc, response_type=1, response_data="b"
+    )
+
+    completions = await UserCommand._autocomplete("test")
+    assert ["testgroup", "testgroup -> testcmd", "testother"] == [
+        repr(command) for command in completions
+    ]
+    assert ["testgroup -> testcmd"] == [
+        repr(command) for command in await UserCommand._autocomplete("testgroup", "t")
+    ]
+    catalog = await UserCommand.fetch_catalog()
+    assert catalog is await UserCommand.fetch_catalog()
+
+    # Changes made elsewhere, eg another process, are picked up on reload
+    async with schemas.db_session() as session:
+        async with session.begin():
+            session.add(UserCommand("testthird", description=desc, response_type=1))
+            await schemas.ConfigVersion.bump(
+                [UserCommand.catalog_scope], session=session
+            )
+    # Simulate the local catalog not being invalidated by the commit
+    UserCommand._catalog = catalog
+    assert not await UserCommand.fetch_command("testthird")
+    assert await UserCommand.reload_catalog_if_changed()
+    assert await UserCommand.fetch_command("testthird")
+    assert not await UserCommand.reload_catalog_if_changed()
+
+    # Deletes invalidate the catalog on commit
+    await UserCommand.delete_command("testother")
+    assert not await UserCommand.fetch_command("testother")
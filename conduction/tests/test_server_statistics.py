@@ -102,3 +102,55 @@ async def test_update_populations_in_batch():
         (server_id_2, server_2_population_2),
         (server_id_3, server_3_population),
     ]
+
+
+@pytest.mark.asyncio
+async def test_upsert_populations():
+    server_id_1 = 1
+    server_1_population = 10
+    server_1_population_2 = 20
+    server_id_2 = 2
+    server_2_population = 30
+    server_id_3 = 3
+    server_3_population = 50
+
+    await ServerStatistics.add_server(server_id_1, server_1_population)
+    await ServerStatistics.add_server(server_id_2, server_2_population)
+
+    # Mix of new and existing servers, streamed from a generator
+    # in batches smaller than the number of rows
+    rows_written = await ServerStatistics.upsert_populations(
+        (
+            row
+            for row in [
+                (server_id_1, server_1_population_2),
+                (server_id_3, server_3_population),
+            ]
+        ),
+        batch_size=1,
+    )
+    assert rows_written == 2
+    assert sorted(await ServerStatistics.fetch_server_populations()) == [
+        (server_id_1, server_1_population_2),
+        (server_id_2, server_2_population),
+        (server_id_3, server_3_population),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_population_aggregates():
+    assert (0, 0) == (
+        (await ServerStatistics.fetch_population_histogram())[0],
+        len(await ServerStatistics.fetch_top_populations()),
+    )
+
+    await ServerStatistics.add_servers_in_batch(
+        (1, 2, 3, 4, 5), (0, 5, 9, 10, 2 * 10**12)
+    )
+    total, bins = await ServerStatistics.fetch_population_histogram()
+    assert total == 2 * 10**12 + 24
+    assert [(0, 1), (1, 2), (10, 1)] == [(lower, n) for lower, n in bins[:3]]
+    assert (10**12, 1) == bins[-1]
+    assert 5 == sum(n for _, n in bins)
+
+    assert [(5, 2 * 10**12), (4, 10)] == await ServerStatistics.fetch_top_populations(2)
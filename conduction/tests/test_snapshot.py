@@ -0,0 +1,77 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+import hikari as h
+import pytest
+
+from ..channel_index import ChannelIndex
+from ..snapshot import WarmStartSnapshot
+from .test_channel_index import fake_channel, fake_guild_available
+
+
+@pytest.mark.asyncio
+async def test_save_and_load(tmp_path):
+    state = {"ids": [1, 2**63], "names": {"a": (1, True)}}
+    restored = {}
+
+    def broken_dump():
+        raise RuntimeError
+
+    saved = WarmStartSnapshot(tmp_path / "warm_start.snapshot")
+    saved.register("state", lambda: state, None)
+    saved.register("broken", broken_dump, None)
+    assert 0 < await saved.save()
+
+    # Sections that failed to dump or are not registered anymore are skipped
+    loaded = WarmStartSnapshot(tmp_path / "warm_start.snapshot")
+    loaded.register("state", None, restored.update)
+    loaded.register("broken", None, restored.update)
+    assert ["state"] == await loaded.load()
+    assert loaded.loaded.is_set()
+    assert state == restored
+
+
+@pytest.mark.asyncio
+async def test_ignores_missing_and_unreadable_snapshots(tmp_path):
+    path = tmp_path / "warm_start.snapshot"
+    restored = []
+
+    missing = WarmStartSnapshot(path)
+    missing.register("state", None, restored.append)
+    assert [] == await missing.load()
+    assert missing.loaded.is_set()
+
+    saved = WarmStartSnapshot(path)
+    saved.register("state", lambda: 1, restored.append)
+    await saved.save()
+    path.write_bytes(path.read_bytes()[:-4])
+    assert [] == await saved.load()
+    assert [] == restored
+
+
+@pytest.mark.asyncio
+async def test_channel_index_round_trip():
+    index = ChannelIndex()
+    await index.on_guild_available(
+        fake_guild_available(
+            fake_channel(10), fake_channel(11, h.ChannelType.GUILD_NEWS)
+        )
+    )
+
+    restored = ChannelIndex()
+    restored.load(index.dump())
+    assert 2 == len(restored)
+    assert restored.get(11).is_news and restored.get(11).is_textable
+    assert restored.get(10).permissions is None and restored.get(10).can_send
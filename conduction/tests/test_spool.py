@@ -0,0 +1,103 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime as dt
+
+import pytest
+
+from .. import schemas
+from ..schemas import MirroredMessage
+from ..spool import WriteSpool
+
+
+def setup_function(function):
+    asyncio.run(schemas.recreate_all())
+
+
+@pytest.mark.asyncio
+async def test_append_and_replay(tmp_path):
+    write_spool = WriteSpool(tmp_path / "spool.jsonl", flush_interval=0.01)
+    assert not write_spool.pending
+
+    # Concurrent appends share a write
+    await asyncio.gather(
+        write_spool.append([{"id": 1}, {"id": 2}]), write_spool.append([{"id": 3}])
+    )
+    assert write_spool.pending
+    assert 3 == len((tmp_path / "spool.jsonl").read_text().splitlines())
+
+    async def failing_apply(records):
+        raise ConnectionError
+
+    with pytest.raises(ConnectionError):
+        await write_spool.replay(failing_apply)
+    await write_spool.append([{"id": 4}])
+
+    # Records are kept until they are applied, including across restarts
+    applied = []
+
+    async def apply(records):
+        applied.extend(record["id"] for record in records)
+
+    write_spool = WriteSpool(tmp_path / "spool.jsonl", flush_interval=0.01)
+    assert write_spool.pending
+    assert 4 == await write_spool.replay(apply)
+    assert [1, 2, 3, 4] == applied
+    assert not write_spool.pending
+    assert 0 == await write_spool.replay(apply)
+
+
+@pytest.mark.asyncio
+async def test_replay_during_flush(tmp_path):
+    write_spool = WriteSpool(tmp_path / "spool.jsonl", flush_interval=0.01)
+
+    async def apply(records):
+        pass
+
+    # Replay checks for records while a flush is waiting to write its own
+    async with write_spool._write_lock:
+        replay = asyncio.create_task(write_spool.replay(apply))
+        await asyncio.sleep(0)
+        append = asyncio.create_task(write_spool.append([{"id": 1}]))
+        await asyncio.sleep(0.05)
+        assert not write_spool._buffer
+    assert 0 == await replay
+    assert write_spool.pending
+
+    await append
+    assert 1 == await write_spool.replay(apply)
+    assert not write_spool.pending
+
+
+@pytest.mark.asyncio
+async def test_upsert_msgs_is_repeatable():
+    msgs = [
+        {
+            "dest_msg": dest_msg,
+            "dest_channel": dest_msg + 100,
+            "source_msg": 1,
+            "source_channel": 2,
+            "creation_datetime": dt.datetime.utcnow(),
+        }
+        for dest_msg in (10, 11)
+    ]
+    await MirroredMessage.add_msgs_in_batch([10], [110], 1, 2)
+    assert 2 == await MirroredMessage.upsert_msgs(msgs)
+    assert 2 == await MirroredMessage.upsert_msgs(msgs)
+
+    assert [(10, 110), (11, 111)] == sorted(
+        await MirroredMessage.get_dest_msgs_and_channels(1)
+    )
@@ -0,0 +1,112 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from types import SimpleNamespace as Fake
+
+import pytest
+
+from .. import startup
+from ..startup import StartupOrchestrator, requires_ready
+
+
+@pytest.mark.asyncio
+async def test_concurrent_startup(monkeypatch):
+    async def log_error(bot, e):
+        pass
+
+    monkeypatch.setattr(startup.utils, "discord_error_logger", log_error)
+    monkeypatch.setattr(startup, "MAX_RETRY_DELAY", 0)
+
+    orchestrator = StartupOrchestrator(max_concurrency=2)
+    running = []
+    max_running = 0
+    attempts = {"flaky": 0}
+
+    def component(name):
+        async def start(bot):
+            nonlocal max_running
+            running.append(name)
+            max_running = max(max_running, len(running))
+            await asyncio.sleep(0.01)
+            running.remove(name)
+            if name == "flaky" and attempts["flaky"] < 2:
+                attempts["flaky"] += 1
+                raise RuntimeError
+
+        return start
+
+    for name in ("xur", "twab", "flaky"):
+        orchestrator.add(name, component(name))
+    with pytest.raises(ValueError):
+        orchestrator.add("xur", component("xur"))
+
+    assert not orchestrator.is_ready("xur")
+    assert orchestrator.all_ready_after is None
+    await orchestrator.run(bot=None)
+
+    # Startup is concurrent but bounded, and retries failing components
+    assert 2 == max_running
+    assert all(orchestrator.is_ready(name) for name in ("xur", "twab", "flaky"))
+    assert ("flaky", orchestrator.ready_after["flaky"], 2) in orchestrator.report()
+    assert orchestrator.all_ready_after == orchestrator.ready_after["flaky"]
+
+
+@pytest.mark.asyncio
+async def test_gives_up_on_failing_component(monkeypatch):
+    alerts = []
+
+    async def log_error(bot, e):
+        alerts.append(e)
+
+    monkeypatch.setattr(startup.utils, "discord_error_logger", log_error)
+    monkeypatch.setattr(startup, "MAX_RETRY_DELAY", 0)
+
+    async def broken(bot):
+        raise RuntimeError
+
+    orchestrator = StartupOrchestrator()
+    orchestrator.add("broken", broken)
+    await orchestrator.run(bot=None)
+
+    assert startup.MAX_START_ATTEMPTS == len(alerts)
+    assert "failed" == orchestrator.status("broken")
+    assert orchestrator.all_ready_after is None
+
+
+@pytest.mark.asyncio
+async def test_requires_ready():
+    orchestrator = StartupOrchestrator()
+    responses = []
+
+    async def respond(content, **kwargs):
+        responses.append(content)
+
+    @requires_ready("xur")
+    async def xur_command(ctx):
+        await ctx.respond("Xur is at the tower")
+
+    ctx = Fake(bot=Fake(startup=orchestrator), respond=respond)
+    await xur_command(ctx)
+    orchestrator.failed.add("xur")
+    await xur_command(ctx)
+    orchestrator.ready_after["xur"] = 0.0
+    await xur_command(ctx)
+    assert [
+        startup.WARMING_UP_MESSAGE,
+        startup.FAILED_MESSAGE,
+        "Xur is at the tower",
+    ] == responses
+    assert "xur_command" == xur_command.__name__
@@ -0,0 +1,39 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from ..versioned_file import VersionedFile
+
+MAGIC = b"CTTEST\x00\x00"
+
+
+def test_versioned_file(tmp_path):
+    path = tmp_path / "state" / "file.bin"
+    assert VersionedFile(path, MAGIC, 1).read() is None
+
+    written = VersionedFile(path, MAGIC, 1).write(b"payload")
+    assert path.stat().st_size == written
+    assert b"payload" == VersionedFile(path, MAGIC, 1).read()
+    assert not path.with_suffix(".bin.tmp").exists()
+
+    # Files of another version, another kind or without a header are rejected
+    with pytest.raises(ValueError):
+        VersionedFile(path, MAGIC, 2).read()
+    with pytest.raises(ValueError):
+        VersionedFile(path, b"CTOTHR\x00\x00", 1).read()
+    path.write_bytes(b"CT")
+    with pytest.raises(ValueError):
+        VersionedFile(path, MAGIC, 1).read()
@@ -16,8 +16,12 @@
 import datetime as dt
 import inspect
 import logging
+import math
 import typing as t
-from asyncio import Semaphore, create_task
+from asyncio import Semaphore, Task, create_task, current_task
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from random import randint
 
 import aiohttp
@@ -29,23 +33,98 @@ from hmessage import HMessage as MessagePrototype
 from . import cfg
 
 
-def ensure_session(sessionmaker):
+# The session of the unit of work currently open in this context, along with the
+# task that opened it. Tasks inherit a copy of the context they are created in,
+# so the owning task is checked before the session is handed out to make sure
+# that a session is never used concurrently by two tasks
+_ambient_session: ContextVar[t.Optional[t.Tuple[Task, t.Any]]] = ContextVar(
+    "_ambient_session", default=None
+)
+
+
+# Qualified name of the innermost ensure_session decorated function running in
+# this context, used to attribute db statements to the schema method behind them
+_db_caller: ContextVar[t.Optional[str]] = ContextVar("_db_caller", default=None)
+
+
+def get_db_caller() -> t.Optional[str]:
+    """Return the name of the ensure_session decorated function running, if any"""
+    return _db_caller.get()
+
+
+def get_ambient_session():
+    """Return the session of the unit of work open in the current task if any"""
+    ambient = _ambient_session.get()
+    if ambient is None:
+        return None
+
+    owner, session = ambient
+    if owner is not current_task():
+        return None
+
+    return session
+
+
+@asynccontextmanager
+async def unit_of_work(sessionmaker):
+    """Open a session and transaction shared by all db calls in this block
+
+    Any function decorated with `ensure_session` that is called (without an
+    explicit session) from within this block picks up this session instead of
+    opening its own. The transaction is committed once when the block exits
+    and rolled back if it raises.
+
+    Nested units of work reuse the outermost session.
+
+    Note: Tasks created inside the block do not share the session, since an
+    sqlalchemy session must not be used concurrently"""
+    session = get_ambient_session()
+    if session is not None:
+        yield session
+        return
+
+    async with sessionmaker() as session:
+        async with session.begin():
+            token = _ambient_session.set((current_task(), session))
+            try:
+                yield session
+            finally:
+                _ambient_session.reset(token)
+
+
+def ensure_session(sessionmaker, read_only_sessionmaker=None):
     """Decorator for functions that optionally want an sqlalchemy async session
 
     Provides an async session via the `session` parameter if one is not already
-    provided via the same.
+    provided via the same. If a unit of work is open in the current task, its
+    session is used, otherwise a new unit of work is opened for the call.
+
+    If read_only_sessionmaker is given (eg for a read replica), calls that are
+    not part of a unit of work use a session from it instead. Pass
+    `use_primary=True` to such a function to read from sessionmaker anyway,
+    for example when reading rows that were just written.
 
     Caution: Always put below `@classmethod` and `@staticmethod`"""
 
     def ensured_session(f: t.Coroutine):
         async def wrapper(*args, **kwargs):
-            session = kwargs.pop("session", None)
-            if session is None:
-                async with sessionmaker() as session:
-                    async with session.begin():
+            use_primary = kwargs.pop("use_primary", False)
+            session = kwargs.pop("session", None) or get_ambient_session()
+            caller_token = _db_caller.set(f.__qualname__)
+            try:
+                if session is not None:
+                    return await f(*args, **kwargs, session=session)
+                elif read_only_sessionmaker is not None and not use_primary:
+                    # Read only sessions never become the ambient session since
+                    # writes must not be routed to them
+                    async with read_only_sessionmaker() as session:
+                        async with session.begin():
+                            return await f(*args, **kwargs, session=session)
+                else:
+                    async with unit_of_work(sessionmaker) as session:
                         return await f(*args, **kwargs, session=session)
-            else:
-                return await f(*args, **kwargs, session=session)
+            finally:
+                _db_caller.reset(caller_token)
 
         return wrapper
 
@@ -118,6 +197,53 @@ async def discord_error_logger(
         await task
 
 
+class LatencyHistogram:
+    """Fixed bucket histogram of latencies in seconds
+
+    Buckets are upper bounds, the last bucket catches everything larger"""
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, math.inf)
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction: float) -> float:
+        """Return the upper bound of the bucket containing the <fraction> percentile
+
+        Returns the max seen latency instead for the unbounded last bucket"""
+        if not self.count:
+            return 0.0
+
+        target = fraction * self.count
+        running = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            running += count
+            if running >= target:
+                return min(bucket, self.max)
+        return self.max
+
+    def __str__(self) -> str:
+        return (
+            f"n={self.count} mean={self.mean * 1000:.1f}ms "
+            + f"p50<={self.percentile(0.5) * 1000:.1f}ms "
+            + f"p99<={self.percentile(0.99) * 1000:.1f}ms "
+            + f"max={self.max * 1000:.1f}ms"
+        )
+
+
 T = t.TypeVar("T")
 
 
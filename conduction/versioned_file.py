@@ -0,0 +1,67 @@
+# Copyright © 2019-present gsfernandes81
+
+# This file is part of "conduction-tines".
+
+# conduction-tines is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Affero General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later version.
+
+# "conduction-tines" is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License along with
+# conduction-tines. If not, see <https://www.gnu.org/licenses/>.
+
+# Local files of state kept across restarts, eg the warm start snapshot
+#
+# Each file is a magic identifying its kind and a uint16 format version,
+# followed by the payload. Files of another kind or version are rejected so
+# that callers start from scratch rather than misreading them. Files are
+# replaced atomically, so a crash while writing never leaves a partial one
+
+import os
+import struct
+import typing as t
+from pathlib import Path
+
+
+class VersionedFile:
+    """A file holding a payload of one format version"""
+
+    def __init__(self, path: str | os.PathLike, magic: bytes, version: int):
+        self.path = Path(path)
+        self.magic = magic
+        self.version = version
+        self._header = struct.Struct(f"<{len(magic)}sH")
+
+    def read(self) -> t.Optional[bytes]:
+        """Return the payload, or None if the file does not exist
+
+        Raises ValueError if the file is not of this kind and version"""
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+        try:
+            magic, version = self._header.unpack_from(data)
+        except struct.error:
+            raise ValueError(f"{self.path} is too short to have a header")
+        if magic != self.magic:
+            raise ValueError(f"{self.path} is not a {self.magic!r} file")
+        if version != self.version:
+            raise ValueError(f"{self.path} has format version {version}")
+        return data[self._header.size :]
+
+    def write(self, payload: bytes) -> int:
+        """Replace the file with payload, returns the bytes written"""
+        data = self._header.pack(self.magic, self.version) + payload
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        return len(data)